@@ -4,63 +4,123 @@ Main application file with UI and business logic
 """
 
 import streamlit as st
-from PIL import Image
+from PIL import Image, ImageOps
 import pandas as pd
+import numpy as np
 from datetime import datetime
-import cv2
-import qrcode
-import base64
 from io import BytesIO
 import streamlit.components.v1 as components
-import requests
+import hashlib
 import html
+import json
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Engine đọc Excel nhanh (Rust/calamine, pandas >= 2.2); fallback về engine mặc định
+try:
+    import python_calamine  # noqa: F401
+    EXCEL_ENGINE = "calamine"
+except ImportError:
+    EXCEL_ENGINE = None
+
+# Chuỗi Arrow (pyarrow đi kèm streamlit): strip/so sánh chạy trong Arrow compute thay vì từng object Python
+try:
+    import pyarrow  # noqa: F401
+    BULK_STRING_DTYPE = "string[pyarrow]"
+except ImportError:
+    BULK_STRING_DTYPE = "string"
+
+# Jinja2 (đi kèm streamlit qua altair): template HTML biên dịch một lần, tự escape giá trị
+try:
+    from jinja2 import Environment
+    JINJA_ENV = Environment(autoescape=True)
+except ImportError:
+    JINJA_ENV = None
 
 # Write service_account.json from secrets/env if missing (for Streamlit Cloud)
 import os
 
-def _write_sa_json(raw: str):
-    """Write service account JSON to file, sanitizing newline issues if needed."""
-    import json
-    import re
+_PK_RE = re.compile(r'"private_key":\s*"([^"]+?)"', re.S)
+_JSON_DECODER = json.JSONDecoder()
+_JSON_STRING_RE = re.compile(r'"(?:[^"\\]|\\.)*"', re.S)
+SERVICE_ACCOUNT_PATH = "service_account.json"
 
-    def try_json(content: str):
-        try:
-            json.loads(content)
-            return True
-        except Exception:
+
+def _escape_pk(match):
+    """Escape actual newlines inside the private_key string."""
+    body = match.group(1)
+    body = body.replace("\r\n", "\n").replace("\n", "\\n")
+    return f'"private_key": "{body}"'
+
+
+def _try_json(content: str) -> bool:
+    """Check that content is a single JSON object (no exception on the happy path)."""
+    stripped = content.strip()
+    if not (stripped.startswith("{") and stripped.endswith("}")):
+        return False
+    try:
+        _, end = _JSON_DECODER.raw_decode(stripped)
+    except ValueError:
+        return False
+    return end == len(stripped)
+
+
+def _is_probably_json(content: str) -> bool:
+    """
+    Cheap pre-check (no full parse): looks like an object and no string literal
+    contains a raw newline, which is the usual way pasted secrets break.
+    """
+    stripped = content.strip()
+    if not (stripped.startswith("{") and stripped.endswith("}")):
+        return False
+    for match in _JSON_STRING_RE.finditer(stripped):
+        literal = match.group()
+        if "\n" in literal or "\r" in literal:
             return False
+    return True
+
 
+def _write_sa_json(raw: str):
+    """Write service account JSON to file, sanitizing newline issues if needed."""
     candidate = raw
     # First attempt: as-is
-    if not try_json(candidate):
+    if not _is_probably_json(candidate):
         # Normalize CRLF
         candidate = candidate.replace("\r\n", "\n")
-    if not try_json(candidate):
+    if not _is_probably_json(candidate):
         # Escape actual newlines inside private_key string if present
-        def _escape_pk(match):
-            body = match.group(1)
-            body = body.replace("\r\n", "\n").replace("\n", "\\n")
-            return f'"private_key": "{body}"'
-
-        candidate = re.sub(r'"private_key":\s*"([^"]+?)"', _escape_pk, candidate, flags=re.S)
+        candidate = _PK_RE.sub(_escape_pk, candidate)
 
-    # Last check
-    if not try_json(candidate):
+    # Last check (the only full parse)
+    if not _try_json(candidate):
         raise ValueError("Service account JSON invalid after sanitization.")
 
-    with open("service_account.json", "w", encoding="utf-8") as f:
+    with open(SERVICE_ACCOUNT_PATH, "w", encoding="utf-8") as f:
         f.write(candidate)
 
 
+@st.cache_resource(show_spinner=False)
+def _write_sa_json_once(digest: str, _raw: str) -> bool:
+    """Write the service account file once per process for a given secret (keyed by its hash)."""
+    _write_sa_json(_raw)
+    return True
+
+
 def ensure_service_account_file():
-    """Rewrite service_account.json from secrets/env on every startup to avoid stale/bad files."""
+    """Rewrite service_account.json from secrets/env once per process (and again if the secret changes)."""
     raw = None
     if st is not None and "SERVICE_ACCOUNT_JSON" in st.secrets:
         raw = st.secrets["SERVICE_ACCOUNT_JSON"]
     if raw is None:
         raw = os.getenv("SERVICE_ACCOUNT_JSON")
     if raw:
-        _write_sa_json(raw)
+        digest = hashlib.blake2b(raw.encode("utf-8"), digest_size=8).hexdigest()
+        _write_sa_json_once(digest, raw)
+        if not os.path.exists(SERVICE_ACCOUNT_PATH):
+            # File bị xóa giữa chừng -> ghi lại ngay
+            _write_sa_json(raw)
 
 # Import modules
 # Ensure local config/database modules take precedence
@@ -69,7 +129,8 @@ import sys
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 from database import (
-    init_database, save_shipment, update_shipment_status, update_shipment,
+    init_database, save_shipment, save_shipments_bulk, existing_qr_codes, update_shipment_status, update_shipment,
+    update_shipments_status_bulk,
     get_all_shipments, get_shipment_by_qr_code, get_suppliers, get_audit_log,
     get_all_suppliers, add_supplier, update_supplier, delete_supplier,
     set_user_password, get_all_users, get_shipment_by_id, create_store,
@@ -78,19 +139,159 @@ from database import (
     get_transfer_slip_items, get_active_transfer_slip, get_all_transfer_slips,
     update_transfer_slip, update_transfer_slip_shipments_status, clear_all_data,
     auto_update_status_after_1hour, get_active_shipments, cleanup_audit_log,
-    add_note_to_history, get_notes_history
+    add_note_to_history, get_notes_history, parse_image_urls, encode_image_urls,
+    get_data_version
 )
-from qr_scanner import decode_qr_from_image
-from auth import require_login, get_current_user, logout, is_admin, is_store_user, get_store_name_from_username, is_kt_sr, is_kt_kho
+from qr_scanner import decode_qr_from_bytes
+from auth import require_login, get_current_user, logout, is_admin, get_store_context, is_kt_sr, is_kt_kho
 try:
     from settings import STATUS_VALUES, REQUEST_TYPES  # type: ignore
 except ModuleNotFoundError:
     from config import STATUS_VALUES, REQUEST_TYPES  # type: ignore
-from google_sheets import push_shipments_to_sheets, test_connection
-from drive_upload import upload_file_to_drive, upload_file_to_transfer_folder, upload_multiple_files_to_drive
-from telegram_notify import send_text, send_photo
+# Vị trí mặc định của ô chọn trạng thái ở màn phiếu chuyển (tính một lần khi nạp module)
+STATUS_IDX_RECEIVED = STATUS_VALUES.index('Đã nhận') if 'Đã nhận' in STATUS_VALUES else 0
+STATUS_IDX_TRANSFER = STATUS_VALUES.index('Chuyển kho') if 'Chuyển kho' in STATUS_VALUES else 0
+from drive_upload import upload_multiple_files_to_drive
 from telegram_helpers import notify_shipment_if_received
 
+# ----------------------- Cached data ----------------------- #
+@st.cache_data(ttl=300, show_spinner=False)
+def _get_suppliers_cached():
+    """Danh sách nhà cung cấp (cache 5 phút, xóa cache khi thêm/sửa/xóa NCC)."""
+    return get_suppliers()
+
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _get_all_suppliers_cached():
+    """Tất cả nhà cung cấp kể cả đã ngừng (màn quản lý NCC), cache 5 phút."""
+    return get_all_suppliers()
+
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _get_all_stores_cached():
+    """Danh sách cửa hàng (cache 5 phút, xóa cache khi tạo cửa hàng)."""
+    return get_all_stores()
+
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _store_choice_options():
+    """Lựa chọn "Gán vào cửa hàng" ("Không gán" + tên cửa hàng), dựng một lần thay vì mỗi lần rerun."""
+    stores_df = _get_all_stores_cached()
+    return ("Không gán",) + (tuple(stores_df['name'].to_numpy().tolist()) if not stores_df.empty else ())
+
+
+def _clear_store_caches():
+    """Xóa cache cửa hàng sau khi tạo cửa hàng / xóa dữ liệu."""
+    _get_all_stores_cached.clear()
+    _store_choice_options.clear()
+
+
+def _clear_supplier_caches():
+    """Xóa cache NCC sau khi thêm/sửa/xóa/khôi phục."""
+    _get_suppliers_cached.clear()
+    _get_all_suppliers_cached.clear()
+
+
+# Cột chữ chỉ dùng để hiển thị/kiểm tra rỗng; điền '' trong DataFrame cache
+SHIPMENT_TEXT_FILL_COLUMNS = (
+    'store_name', 'notes', 'received_time', 'last_updated', 'updated_by', 'image_url'
+)
+
+# Cột ít giá trị khác nhau, lặp lại nhiều: lưu dạng category trong DataFrame cache
+SHIPMENT_CATEGORY_COLUMNS = ('status', 'supplier', 'store_name', 'request_type')
+
+
+@st.cache_data(ttl=60, max_entries=4, show_spinner=False)
+def _get_all_shipments_versioned(data_version):
+    """
+    Toàn bộ phiếu, cache theo phiên bản file DB (data_version).
+    Thêm sẵn cột sent_time_parsed / last_updated_parsed (datetime64) để lọc/sắp xếp
+    không phải parse chuỗi mỗi lần rerun, và qr_code_lower cho tìm kiếm;
+    cột chuỗi gốc giữ nguyên để hiển thị (giá trị rỗng là '' thay vì None/NaN).
+    """
+    df = get_all_shipments()
+    if not df.empty:
+        for col in ('sent_time', 'last_updated'):
+            df[f'{col}_parsed'] = pd.to_datetime(df[col], errors='coerce', format='ISO8601')
+        # Cột chữ hiển thị: điền '' một lần thay vì pd.notna(...) từng dòng khi render
+        df = df.fillna({col: '' for col in SHIPMENT_TEXT_FILL_COLUMNS if col in df.columns})
+        # Mã QR chữ thường cho ô tìm kiếm (không lower() lại mỗi lần gõ phím)
+        df['qr_code_lower'] = df['qr_code'].astype(str).str.lower()
+        # Category cho cột lặp lại, id ép về kiểu số nguyên nhỏ nhất đủ chứa: giảm bộ nhớ cache/so sánh
+        for col in SHIPMENT_CATEGORY_COLUMNS:
+            if col in df.columns:
+                df[col] = df[col].astype('category')
+        df['id'] = pd.to_numeric(df['id'], downcast='integer')
+        # Index theo id (giữ cả cột id, giữ thứ tự sent_time DESC) để tra cứu df.loc[ids] không quét cả bảng
+        df = df.set_index('id', drop=False).rename_axis(None)
+    return df
+
+
+def shipment_records(frame):
+    """
+    Các dòng của DataFrame phiếu (cache) dưới dạng dict giống get_shipment_by_id (NaN -> None),
+    để hiển thị cả trang mà không truy vấn lại DB cho từng phiếu.
+    """
+    return frame.astype(object).where(frame.notna(), None).to_dict('records')
+
+
+@st.cache_data(ttl=60, max_entries=4, show_spinner=False)
+def _get_label_corpus(data_version):
+    """Danh sách chọn phiếu để in tem (id, nhãn 'QR | tên | IMEI', nhãn chữ thường), tính một lần cho mỗi phiên bản DB."""
+    df = _get_all_shipments_versioned(data_version)
+    labels = df['qr_code'].astype(str) + ' | ' + df['device_name'].astype(str) + ' | ' + df['imei'].astype(str)
+    return pd.DataFrame({'id': df['id'].to_numpy(), 'label': labels, 'label_lower': labels.str.lower()})
+
+
+def get_all_shipments_cached():
+    """
+    get_all_shipments() có cache: chỉ query lại khi DB vừa được ghi
+    (mọi thay đổi từ bất kỳ phiên/thread nào đều đổi get_data_version()).
+    """
+    return _get_all_shipments_versioned(get_data_version())
+
+
+@st.cache_data(ttl=60, max_entries=4, show_spinner=False)
+def _get_all_users_versioned(data_version):
+    """Danh sách tài khoản, cache theo phiên bản file DB (data_version)."""
+    return get_all_users()
+
+
+def get_all_users_cached():
+    """get_all_users() có cache: chỉ query lại khi DB vừa được ghi (tạo/sửa/xoá tài khoản...)."""
+    return _get_all_users_versioned(get_data_version())
+
+
+@st.cache_data(ttl=60, max_entries=4, show_spinner=False)
+def _get_all_transfer_slips_versioned(data_version):
+    """Danh sách phiếu chuyển, cache theo phiên bản file DB (data_version)."""
+    return get_all_transfer_slips()
+
+
+def get_all_transfer_slips_cached():
+    """get_all_transfer_slips() có cache: chỉ query lại khi DB vừa được ghi."""
+    return _get_all_transfer_slips_versioned(get_data_version())
+
+
+@st.cache_data(ttl=30, show_spinner=False)
+def _get_audit_log_cached(limit=100, offset=0):
+    """Lịch sử thay đổi (cache 30 giây)."""
+    return get_audit_log(limit=limit, offset=offset)
+
+
+@st.cache_data(ttl=30, show_spinner=False)
+def _get_audit_log_csv(limit=100, offset=0):
+    """CSV của một trang lịch sử, chỉ tạo lại khi trang hoặc dữ liệu thay đổi."""
+    return _get_audit_log_cached(limit=limit, offset=offset).to_csv(index=False).encode('utf-8-sig')
+
+
+def build_status_options(supplier_names):
+    """Danh sách trạng thái cho selectbox: STATUS_VALUES + "Gửi <tên NCC>" (bỏ trùng)."""
+    known = set(STATUS_VALUES)
+    send_statuses = [f"Gửi {name}" for name in dict.fromkeys(supplier_names)]
+    return list(STATUS_VALUES) + [status for status in send_statuses if status not in known]
+
+
 # Label/printing helpers defaults
 LABEL_DEFAULT_WIDTH_MM = 50
 LABEL_DEFAULT_HEIGHT_MM = 30
@@ -104,15 +305,16 @@ def ensure_label_defaults():
         st.session_state['label_height_mm'] = LABEL_DEFAULT_HEIGHT_MM
 
 
-def generate_qr_base64(data: str) -> str:
-    """Generate a base64 PNG for a QR code (larger size for better scanning)."""
-    qr = qrcode.QRCode(box_size=6, border=2)  # Increased box_size from 4 to 6, border from 1 to 2
-    qr.add_data(data or "")
-    qr.make(fit=True)
-    img = qr.make_image(fill_color="black", back_color="white").convert("RGB")
-    buffer = BytesIO()
-    img.save(buffer, format="PNG")
-    return base64.b64encode(buffer.getvalue()).decode()
+def _generate_qr_svg_uncached(data: str) -> str:
+    """Generate an inline SVG for a QR code (vector, sharp at any print DPI)."""
+    # Chỉ cần khi in tem: import tại đây thay vì lúc khởi động app
+    import segno
+    # make_qr để không sinh Micro QR với mã ngắn; omitsize để SVG co giãn theo khung tem
+    return segno.make_qr(data or "", error='m').svg_inline(scale=6, border=2, omitsize=True)
+
+
+# Cache theo nội dung QR: in lại tem / rerun không phải sinh lại QR
+generate_qr_svg = st.cache_data(ttl=3600, max_entries=512, show_spinner=False)(_generate_qr_svg_uncached)
 
 
 def render_label_component(shipment: dict):
@@ -120,20 +322,75 @@ def render_label_component(shipment: dict):
     ensure_label_defaults()
     width = st.session_state.get('label_width_mm', LABEL_DEFAULT_WIDTH_MM)
     height = st.session_state.get('label_height_mm', LABEL_DEFAULT_HEIGHT_MM)
-    qr_b64 = generate_qr_base64(shipment.get('qr_code', ''))
+    qr_svg = generate_qr_svg(shipment.get('qr_code', ''))
     device_name = shipment.get('device_name', '')
     imei = shipment.get('imei', '')
     qr_code = shipment.get('qr_code', '')
     capacity = shipment.get('capacity', '')
 
-    html = build_label_html(qr_b64, qr_code, device_name, imei, capacity, width, height, include_print_button=True, wrapper_id="label-area")
+    html = build_label_html(qr_svg, qr_code, device_name, imei, capacity, width, height, include_print_button=True, wrapper_id="label-area")
     components.html(html, height=220, scrolling=False)
 
 
-def build_label_html(qr_b64: str, qr_code: str, device_name: str, imei: str, capacity: str, width: float, height: float,
+def _label_text(value) -> str:
+    """Escape a shipment field for label HTML."""
+    return html.escape("" if value is None else str(value))
+
+
+def _label_css(width: float, height: float) -> str:
+    """Label CSS, emitted once per print frame instead of once per label."""
+    return f"""
+    <style>
+      .qr-label {{
+        width:{width}mm;
+        height:{height}mm;
+        padding:3mm;
+        box-sizing:border-box;
+        border:1px dashed #d1d5db;
+        display:flex;
+        gap:4px;
+        align-items:center;
+        page-break-inside: avoid;
+      }}
+      .qr-label .qr {{ flex:0 0 50%; line-height:0; }}
+      .qr-label .qr svg {{ width:100%; height:auto; }}
+      .qr-label .info {{ flex:1 1 50%; font-size:9px; line-height:1.2; }}
+      .qr-label .info div {{ margin-bottom:2px; }}
+      .qr-label .info div:last-child {{ margin-bottom:0; }}
+      @media print {{
+        body {{
+          margin:0;
+        }}
+        button {{
+          display:none;
+        }}
+        .qr-label {{
+          border:none !important;
+        }}
+      }}
+    </style>
+    """
+
+
+def _label_inner(qr_svg: str, qr_code: str, device_name: str, imei_short: str, capacity: str, label_id: str) -> str:
+    """One label body; text fields must already be escaped."""
+    return (
+        f'<div id="{label_id}" class="qr-label">'
+        f'<div class="qr">{qr_svg}</div>'
+        f'<div class="info">'
+        f'<div><strong>QR:</strong> {qr_code}</div>'
+        f'<div><strong>TB:</strong> {device_name}</div>'
+        f'<div><strong>IMEI:</strong> {imei_short}</div>'
+        f'<div><strong>Lỗi / Tình trạng:</strong> {capacity}</div>'
+        f'</div></div>'
+    )
+
+
+def build_label_html(qr_svg: str, qr_code: str, device_name: str, imei: str, capacity: str, width: float, height: float,
                      include_print_button: bool, wrapper_id: str) -> str:
     # Chỉ lấy 6 số cuối của IMEI
-    imei_short = imei[-6:] if imei and len(imei) >= 6 else imei
+    imei = "" if imei is None else str(imei)
+    imei_short = imei[-6:] if len(imei) >= 6 else imei
     
     btn_html = ""
     if include_print_button:
@@ -149,73 +406,23 @@ def build_label_html(qr_b64: str, qr_code: str, device_name: str, imei: str, cap
           ">In tem</button>
         </div>
         """
+    label = _label_inner(qr_svg, _label_text(qr_code), _label_text(device_name), _label_text(imei_short),
+                         _label_text(capacity), wrapper_id)
     return f"""
     <div style="font-family:Arial,sans-serif;">
-      <div id="{wrapper_id}" style="
-        width:{width}mm;
-        height:{height}mm;
-        padding:3mm;
-        box-sizing:border-box;
-        border:1px dashed #d1d5db;
-        display:flex;
-        gap:4px;
-        align-items:center;
-        page-break-inside: avoid;
-      ">
-        <div style="flex:0 0 50%;">
-          <img src="data:image/png;base64,{qr_b64}" style="width:100%;height:auto;max-width:100%;" />
-        </div>
-        <div style="flex:1 1 50%; font-size:9px; line-height:1.2;">
-          <div style="margin-bottom:2px;"><strong>QR:</strong> {qr_code}</div>
-          <div style="margin-bottom:2px;"><strong>TB:</strong> {device_name}</div>
-          <div style="margin-bottom:2px;"><strong>IMEI:</strong> {imei_short}</div>
-            <div><strong>Lỗi / Tình trạng:</strong> {capacity}</div>
-        </div>
-      </div>
+      {_label_css(width, height)}
+      {label}
       {btn_html}
-    <style>
-        @media print {{
-          body {{
-            margin:0;
-          }}
-          button {{
-            display:none;
-          }}
-          #{wrapper_id} {{
-            border:none;
-          }}
-        }}
-      </style>
     </div>
     """
 
 
-def render_labels_bulk(shipments):
-    """Render multiple labels at once and trigger a single print dialog."""
-    ensure_label_defaults()
-    width = st.session_state.get('label_width_mm', LABEL_DEFAULT_WIDTH_MM)
-    height = st.session_state.get('label_height_mm', LABEL_DEFAULT_HEIGHT_MM)
-
-    labels_html_parts = []
-    for idx, sh in enumerate(shipments):
-        qr_b64 = generate_qr_base64(sh.get('qr_code', ''))
-        part = build_label_html(
-            qr_b64=qr_b64,
-            qr_code=sh.get('qr_code', ''),
-            device_name=sh.get('device_name', ''),
-            imei=sh.get('imei', ''),
-            capacity=sh.get('capacity', ''),
-            width=width,
-            height=height,
-            include_print_button=False,
-            wrapper_id=f"label-{idx}"
-        )
-        labels_html_parts.append(part)
-
-    full_html = f"""
+_LABELS_BULK_HEADER = """
     <div style="font-family:Arial,sans-serif;">
       <div style="display:flex; flex-direction:column; gap:12px;">
-        {''.join(labels_html_parts)}
+"""
+
+_LABELS_BULK_FOOTER = """
       </div>
       <div style="margin-top:12px;">
         <button onclick="window.print()" style="
@@ -227,182 +434,447 @@ def render_labels_bulk(shipments):
           cursor:pointer;
         ">In tất cả tem đã chọn</button>
       </div>
-      <style>
-        @media print {{
-          body {{
-            margin:0;
-          }}
-          button {{
-            display:none;
-          }}
-          [id^="label-"] {{
-            border:none !important;
-          }}
-        }}
-      </style>
     </div>
-    """
+"""
+
+
+def render_labels_bulk(shipments):
+    """Render multiple labels at once and trigger a single print dialog."""
+    ensure_label_defaults()
+    width = st.session_state.get('label_width_mm', LABEL_DEFAULT_WIDTH_MM)
+    height = st.session_state.get('label_height_mm', LABEL_DEFAULT_HEIGHT_MM)
+
+    if not shipments:
+        return
+    # Tách thành các cột (SoA) một lần, escape cả cột một lượt
+    qrs, names, imeis, caps = zip(*(
+        (sh.get('qr_code', ''), sh.get('device_name', ''), sh.get('imei', ''), sh.get('capacity', ''))
+        for sh in shipments
+    ))
+    imeis = ["" if i is None else str(i) for i in imeis]
+    imei_shorts = [_label_text(i[-6:] if len(i) >= 6 else i) for i in imeis]
+    qr_texts = [_label_text(q) for q in qrs]
+    name_texts = [_label_text(n) for n in names]
+    cap_texts = [_label_text(c) for c in caps]
+
+    # Sinh QR song song cho các mã khác nhau (mã trùng chỉ sinh một lần)
+    payloads = list(dict.fromkeys(qrs))
+    if len(payloads) >= 10:
+        with ThreadPoolExecutor(max_workers=min(8, len(payloads))) as executor:
+            qr_map = dict(zip(payloads, executor.map(generate_qr_svg, payloads)))
+    else:
+        qr_map = {p: generate_qr_svg(p) for p in payloads}
+
+    parts = [
+        _label_inner(qr_map[q], qt, nt, it, ct, f"label-{idx}")
+        for idx, (q, qt, nt, it, ct) in enumerate(zip(qrs, qr_texts, name_texts, imei_shorts, cap_texts))
+    ]
+
+    full_html = _LABELS_BULK_HEADER + _label_css(width, height) + ''.join(parts) + _LABELS_BULK_FOOTER
     components.html(full_html, height=400, scrolling=True)
 
-# ----------------------- UI Helpers ----------------------- #
-@st.cache_data(ttl=3600, show_spinner=False, max_entries=5)  # Cache 1 giờ, tối đa 5 ảnh
-def _get_drive_image_bytes(file_id):
+# ----------------------- Upload helpers ----------------------- #
+# Ký tự không dùng được trong tên file Drive (khoảng trắng, / \ : * ? " < > |) -> '_', một lượt str.translate
+_FILENAME_UNSAFE_TABLE = str.maketrans(dict.fromkeys(' \t\r\n/\\:*?"<>|', '_'))
+UPLOAD_IMAGE_MAX_SIDE = 1600
+UPLOAD_IMAGE_QUALITY = 82
+
+
+def format_timestamp(ts, fmt='%d/%m/%Y %H:%M:%S'):
+    """Định dạng thời gian lưu trong DB; dùng fromisoformat thay vì pd.to_datetime cho từng giá trị."""
+    if not ts:
+        return ""
+    try:
+        return datetime.fromisoformat(str(ts)).strftime(fmt)
+    except ValueError:
+        try:
+            return pd.to_datetime(ts).strftime(fmt)
+        except Exception:
+            return str(ts)
+
+
+def format_time_column(values, fmt='%d/%m/%Y %H:%M'):
+    """Định dạng cả cột thời gian trong một lượt (vectorized); giá trị rỗng/không đọc được -> NaN."""
+    if not pd.api.types.is_datetime64_any_dtype(values):
+        values = pd.to_datetime(values, errors='coerce', format='ISO8601')
+    return values.dt.strftime(fmt)
+
+
+# Excel nhập phiếu: chỉ đọc 4 cột B, Z, AF, AI (0-based: 1, 25, 31, 34)
+BULK_EXCEL_COLUMNS = {1: 'qr_code', 25: 'device_name', 31: 'imei', 34: 'capacity'}
+
+
+def read_bulk_excel(uploaded_file):
     """
-    Tải ảnh từ Drive một lần và cache lại
-    - Cache tối đa 5 ảnh, tự động xóa ảnh cũ nhất khi quá 5
-    - Chỉ tải khi chưa có trong cache, không làm nặng server
+    Đọc file Excel nhập nhiều phiếu: bỏ dòng header, chỉ parse các cột cần thiết, giá trị dạng chuỗi.
+    Dùng engine calamine (Rust) nếu có, ngược lại dùng engine mặc định.
+    Trả về None nếu file không đủ cột.
     """
     try:
-        download_url = f"https://drive.google.com/uc?export=download&id={file_id}"
-        response = requests.get(download_url, timeout=10, stream=True)
-        if response.status_code == 200:
-            return response.content
-    except Exception as e:
-        print(f"Error loading image {file_id}: {e}")
-    return None
+        df = pd.read_excel(
+            uploaded_file,
+            header=None,
+            engine=EXCEL_ENGINE,
+            usecols=list(BULK_EXCEL_COLUMNS),
+            skiprows=1,
+            names=list(BULK_EXCEL_COLUMNS.values()),
+            dtype=str,
+        )
+    except ValueError as e:
+        # usecols vượt quá số cột của file
+        print(f"Error reading bulk Excel: {e}")
+        return None
+    # Số dòng theo file gốc (dòng 1 là header)
+    df.index = df.index + 1
+    return df.fillna('')
 
 
-def display_drive_image(image_url, width=300, caption=""):
+def validate_bulk_rows(df):
     """
-    Hiển thị ảnh từ Google Drive tự động (không cần expander)
-    - Tự động tải và hiển thị ảnh khi được gọi
-    - Cache tối đa 5 ảnh, tự động xóa ảnh cũ khi quá giới hạn
+    Kiểm tra dữ liệu Excel nhập nhiều phiếu theo cột, không lặp từng dòng.
+
+    Returns:
+        tuple: (df đã strip, Series lỗi theo dòng - None nếu dòng hợp lệ)
     """
+    df = df.astype(BULK_STRING_DTYPE).apply(lambda col: col.str.strip())
+    row_errors = pd.Series(None, index=df.index, dtype=object)
+    missing_other = df[['imei', 'device_name', 'capacity']].eq('').any(axis=1).to_numpy(dtype=bool)
+    row_errors.loc[missing_other] = "thiếu IMEI/Tên/Lỗi-Tình trạng"
+    row_errors.loc[df['qr_code'].eq('').to_numpy(dtype=bool)] = "thiếu Mã QR"
+    return df, row_errors
+
+
+def sanitize_filename_part(value, default=""):
+    """Chuẩn hóa một phần tên file: thay ký tự không hợp lệ bằng '_'."""
+    return (value or "").strip().translate(_FILENAME_UNSAFE_TABLE) or default
+
+
+def prepare_image_upload(f, max_side=UPLOAD_IMAGE_MAX_SIDE, quality=UPLOAD_IMAGE_QUALITY):
+    """
+    Chuẩn bị ảnh trước khi upload Drive: thu nhỏ cạnh dài <= max_side và nén JPEG
+    - Ảnh điện thoại 4-12MB giảm còn vài trăm KB, upload nhanh hơn tương ứng
+    - Giữ nguyên file nếu đã là JPEG nhỏ, hoặc không đọc được bằng PIL
+
+    Returns:
+        tuple: (file_bytes, mime, ext)
+    """
+    file_bytes = f.getbuffer()
+    mime = f.type or "image/jpeg"
+    orig_name = f.name or "image.jpg"
+    ext = orig_name.split(".")[-1] if "." in orig_name else ""
+    if not ext:
+        ext = "jpg"
     try:
-        # Extract file ID from URL
-        file_id = None
-        if 'uc?export=download&id=' in image_url:
-            file_id = image_url.split('id=')[-1]
-        elif 'id=' in image_url:
-            file_id = image_url.split('id=')[-1].split('&')[0]
-        
-        if file_id:
-            # Tải ảnh với cache (tối đa 5 ảnh)
-            image_bytes = _get_drive_image_bytes(file_id)
-            
-            if image_bytes:
-                img = Image.open(BytesIO(image_bytes))
-                st.image(img, width=width, caption=caption)
-                st.markdown(f"[Mở ảnh trên Drive]({image_url})")
-            else:
-                st.warning("Không thể tải ảnh từ Drive")
-                st.markdown(f"[Mở ảnh trên Drive]({image_url})")
-            return True
-        else:
-            # Fallback: try direct URL
-            try:
-                st.image(image_url, width=width, caption=caption)
-                return True
-            except:
-                st.markdown(f"[Mở ảnh]({image_url})")
-                return False
+        f.seek(0)
+        img = Image.open(f)
+        if max(img.size) <= max_side and img.format == "JPEG":
+            return file_bytes, mime, ext
+        # JPEG: để libjpeg giải mã ở tỉ lệ 1/2, 1/4, 1/8; phải gọi trên ảnh vừa mở (chưa load),
+        # khung vuông nên vẫn đúng sau khi xoay theo EXIF
+        img.draft('RGB', (max_side, max_side))
+        # Giữ đúng chiều ảnh chụp từ điện thoại (EXIF orientation) trước khi bỏ EXIF
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((max_side, max_side))
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        buffer = BytesIO()
+        img.save(buffer, format="JPEG", quality=quality, optimize=True)
+        if buffer.tell() >= len(file_bytes):
+            return file_bytes, mime, ext
+        return buffer.getvalue(), "image/jpeg", "jpg"
     except Exception as e:
-        st.warning(f"Không thể hiển thị ảnh: {str(e)}")
-        st.markdown(f"[Mở ảnh trên Drive]({image_url})")
-        return False
+        print(f"Warning: could not shrink image {orig_name}: {e}")
+        return file_bytes, mime, ext
+
+
+def build_upload_files_data(files, qr_code, status, status_default=""):
+    """
+    Chuẩn bị danh sách ảnh cho upload_multiple_files_to_drive
+    - Tên file: mã QR + trạng thái + stt (phần tên được làm sạch một lần cho cả lô)
+    """
+    sanitized_qr = sanitize_filename_part(qr_code, "qr_image")
+    sanitized_status = sanitize_filename_part(status, status_default)
+    files_data = []
+    for idx, f in enumerate(files, start=1):
+        file_bytes, mime, ext = prepare_image_upload(f)
+        files_data.append({
+            'file_bytes': file_bytes,
+            'filename': f"{sanitized_qr}_{sanitized_status}_{idx}.{ext}",
+            'mime_type': mime,
+            'index': idx
+        })
+    return files_data
+
+
+def upload_images_or_stop(files, qr_code, status, status_default="", show_success=False, transfer_folder=False):
+    """
+    Upload song song nhiều ảnh lên Drive, giữ đúng thứ tự.
+    Nếu có ảnh lỗi: báo lỗi từng ảnh và dừng (st.stop) như luồng upload tuần tự trước đây.
+    - transfer_folder: ảnh phiếu chuyển (thư mục Drive riêng)
+
+    Returns:
+        list: URL các ảnh theo thứ tự chọn
+    """
+    upload_results = upload_multiple_files_to_drive(
+        build_upload_files_data(files, qr_code, status, status_default),
+        max_workers=min(8, len(files)),
+        transfer_folder=transfer_folder
+    )
+    failed = [r for r in upload_results if not r['success']]
+    for result in failed:
+        st.error(f"❌ Upload ảnh {result['index']} thất bại: {result['error']}")
+    if failed:
+        st.stop()
+    if show_success:
+        for result in upload_results:
+            st.success(f"✅ Upload ảnh {result['index']} thành công: {result['url'][:50]}...")
+    return [result['url'] for result in upload_results]
 
 
-def inject_sidebar_styles():
-    """Apply custom styles for a cleaner, more professional sidebar."""
+# ----------------------- UI Helpers ----------------------- #
+def _extract_drive_file_id(image_url):
+    """Lấy file ID từ link Google Drive (None nếu không phải link Drive)."""
+    if not image_url:
+        return None
+    if 'uc?export=download&id=' in image_url:
+        return image_url.split('id=')[-1]
+    if 'id=' in image_url:
+        return image_url.split('id=')[-1].split('&')[0]
+    return None
+
+
+def _browser_image_src(image_url, width):
+    """Link ảnh cho trình duyệt tự tải: ảnh Drive dùng endpoint thumbnail theo độ rộng hiển thị."""
+    file_id = _extract_drive_file_id(image_url)
+    if file_id:
+        return f"https://drive.google.com/thumbnail?id={file_id}&sz=w{min(max(int(width or 300) * 2, 300), 1200)}"
+    return image_url
+
+
+def show_image_urls(image_urls, width=300, caption_prefix=None):
+    """
+    Hiển thị danh sách ảnh trong một lưới HTML duy nhất.
+    Trình duyệt tải các ảnh song song, server không phải tải/render từng ảnh bằng st.image.
+    """
+    image_urls = [u.strip() for u in image_urls if u and u.strip()]
+    if not image_urls:
+        return
+    items = []
+    for idx, img_url in enumerate(image_urls, 1):
+        label = f"{caption_prefix} {idx}" if caption_prefix else f"Ảnh {idx}"
+        href = html.escape(img_url, quote=True)
+        src = html.escape(_browser_image_src(img_url, width), quote=True)
+        items.append(
+            f'<figure style="margin:0;width:{int(width)}px">'
+            f'<a href="{href}" target="_blank" rel="noopener">'
+            f'<img src="{src}" loading="lazy" alt="{html.escape(label)}" '
+            f'style="max-width:100%;border-radius:6px;display:block"/></a>'
+            f'<figcaption style="font-size:0.8rem;color:#6b7280">{html.escape(label)}</figcaption>'
+            f'</figure>'
+        )
     st.markdown(
-        """
-        <style>
-        /* Sidebar container */
-        [data-testid="stSidebar"] {
-            background: linear-gradient(180deg, #f7f9fc 0%, #eef2f7 100%);
-            border-right: 1px solid #e5e7eb;
-            padding-top: 12px;
-        }
-        /* Title and user info */
-        [data-testid="stSidebar"] .sidebar-title {
-            font-size: 20px;
-            font-weight: 700;
-            color: #111827;
-            margin-bottom: 12px;
-        }
-        [data-testid="stSidebar"] .sidebar-user {
-            font-size: 14px;
-            color: #4b5563;
-            margin-bottom: 6px;
-        }
-        [data-testid="stSidebar"] .sidebar-label {
-            font-size: 13px;
-            font-weight: 600;
-            color: #111827;
-            margin: 12px 0 6px 0;
-        }
-        /* Nav buttons - base */
-        [data-testid="stSidebar"] .stButton>button {
-            width: 100%;
-            border: 1px solid #e5e7eb;
-            background: #ffffff;
-            color: #111827;
-            border-radius: 10px;
-            padding: 10px 12px;
-            font-weight: 600;
-            box-shadow: 0 1px 2px rgba(0,0,0,0.04);
-            transition: all 0.15s ease;
-        }
-        /* Secondary (default) */
-        [data-testid="stSidebar"] .stButton>button[data-testid="baseButton-secondary"] {
-            background: #ffffff;
-            color: #111827;
-            border: 1px solid #e5e7eb;
-        }
-        [data-testid="stSidebar"] .stButton>button:hover {
-            border-color: #3b82f6;
-            box-shadow: 0 4px 10px rgba(59,130,246,0.16);
-            transform: translateY(-1px);
-        }
-        /* Primary (selected) */
-        [data-testid="stSidebar"] .stButton>button[data-testid="baseButton-primary"] {
-            background: linear-gradient(135deg, #2563eb, #1d4ed8);
-            color: #fff;
-            border: 1px solid #1d4ed8;
-            box-shadow: 0 6px 16px rgba(37,99,235,0.28);
+        '<div style="display:flex;gap:8px;flex-wrap:wrap">' + ''.join(items) + '</div>',
+        unsafe_allow_html=True
+    )
+
+
+# CSS cố định: hằng số cấp module, gộp sidebar + main thành một phần tử markdown.
+# Lưu ý: vẫn phải st.markdown mỗi lần chạy script vì Streamlit xóa các phần tử
+# không được render lại ở lần rerun sau (chặn bằng session_state sẽ làm mất CSS).
+_SIDEBAR_CSS = """
+<style>
+/* Sidebar container */
+[data-testid="stSidebar"] {
+    background: linear-gradient(180deg, #f7f9fc 0%, #eef2f7 100%);
+    border-right: 1px solid #e5e7eb;
+    padding-top: 12px;
+}
+/* Title and user info */
+[data-testid="stSidebar"] .sidebar-title {
+    font-size: 20px;
+    font-weight: 700;
+    color: #111827;
+    margin-bottom: 12px;
+}
+[data-testid="stSidebar"] .sidebar-user {
+    font-size: 14px;
+    color: #4b5563;
+    margin-bottom: 6px;
+}
+[data-testid="stSidebar"] .sidebar-label {
+    font-size: 13px;
+    font-weight: 600;
+    color: #111827;
+    margin: 12px 0 6px 0;
+}
+/* Nav buttons - base */
+[data-testid="stSidebar"] .stButton>button {
+    width: 100%;
+    border: 1px solid #e5e7eb;
+    background: #ffffff;
+    color: #111827;
+    border-radius: 10px;
+    padding: 10px 12px;
+    font-weight: 600;
+    box-shadow: 0 1px 2px rgba(0,0,0,0.04);
+    transition: all 0.15s ease;
+}
+/* Secondary (default) */
+[data-testid="stSidebar"] .stButton>button[data-testid="baseButton-secondary"] {
+    background: #ffffff;
+    color: #111827;
+    border: 1px solid #e5e7eb;
+}
+[data-testid="stSidebar"] .stButton>button:hover {
+    border-color: #3b82f6;
+    box-shadow: 0 4px 10px rgba(59,130,246,0.16);
+    transform: translateY(-1px);
+}
+/* Primary (selected) */
+[data-testid="stSidebar"] .stButton>button[data-testid="baseButton-primary"] {
+    background: linear-gradient(135deg, #2563eb, #1d4ed8);
+    color: #fff;
+    border: 1px solid #1d4ed8;
+    box-shadow: 0 6px 16px rgba(37,99,235,0.28);
+}
+[data-testid="stSidebar"] .stButton>button[data-testid="baseButton-primary"]:hover {
+    filter: brightness(1.02);
+    transform: translateY(-1px);
+}
+/* Logout button */
+[data-testid="stSidebar"] .logout-btn>button {
+    width: 100%;
+    border-radius: 8px;
+    border: 1px solid #fca5a5;
+    background: #fff1f2;
+    color: #b91c1c;
+    font-weight: 600;
+}
+[data-testid="stSidebar"] .logout-btn>button:hover {
+    border-color: #ef4444;
+    background: #ffe4e6;
+}
+</style>
+"""
+
+_MAIN_CSS = """
+<style>
+/* Compact main padding for small screens */
+@media (max-width: 768px) {
+    [data-testid="stAppViewContainer"] .main .block-container {
+        padding-top: 1rem;
+        padding-bottom: 2rem;
+        padding-left: 0.9rem;
+        padding-right: 0.9rem;
+    }
+}
+
+</style>
+"""
+
+_BASE_CSS = _SIDEBAR_CSS + _MAIN_CSS
+
+# Hiệu ứng/tối ưu hiển thị cho trang chính (sau đăng nhập)
+_PAGE_CSS = """
+<style>
+    /* Loading overlay animation */
+    @keyframes spin {
+        0% { transform: rotate(0deg); }
+        100% { transform: rotate(360deg); }
+    }
+    
+    @keyframes fadeIn {
+        from { 
+            opacity: 0; 
+            transform: translateY(10px); 
         }
-        [data-testid="stSidebar"] .stButton>button[data-testid="baseButton-primary"]:hover {
-            filter: brightness(1.02);
-            transform: translateY(-1px);
+        to { 
+            opacity: 1; 
+            transform: translateY(0); 
         }
-        /* Logout button */
-        [data-testid="stSidebar"] .logout-btn>button {
-            width: 100%;
-            border-radius: 8px;
-            border: 1px solid #fca5a5;
-            background: #fff1f2;
-            color: #b91c1c;
-            font-weight: 600;
+    }
+    
+    @keyframes slideIn {
+        from {
+            opacity: 0;
+            transform: translateX(-20px);
         }
-        [data-testid="stSidebar"] .logout-btn>button:hover {
-            border-color: #ef4444;
-            background: #ffe4e6;
+        to {
+            opacity: 1;
+            transform: translateX(0);
         }
-        </style>
-        """,
-        unsafe_allow_html=True,
-    )
+    }
+    
+    .page-content {
+        animation: fadeIn 0.4s ease-out;
+        will-change: opacity, transform;
+    }
+    
+    .loading-spinner {
+        border: 4px solid #f3f3f3;
+        border-top: 4px solid #3498db;
+        border-radius: 50%;
+        width: 40px;
+        height: 40px;
+        animation: spin 1s linear infinite;
+        margin: 20px auto;
+    }
+    
+    /* Smooth transition for navigation buttons */
+    .stButton > button {
+        transition: all 0.2s ease-in-out;
+        will-change: transform, box-shadow;
+    }
+    
+    .stButton > button:hover {
+        transform: translateY(-2px);
+        box-shadow: 0 4px 8px rgba(0,0,0,0.2);
+    }
+    
+    .stButton > button:active {
+        transform: translateY(0);
+    }
+    
+    /* Optimize rendering */
+    .main .block-container {
+        padding-top: 2rem;
+        padding-bottom: 2rem;
+    }
+    
+    /* Smooth transitions for expanders */
+    .streamlit-expanderHeader {
+        transition: background-color 0.2s ease;
+    }
+    
+    /* Loading state */
+    .page-loading {
+        opacity: 0.6;
+        pointer-events: none;
+    }
+    
+    /* Prevent layout shift */
+    [data-testid="stAppViewContainer"] {
+        min-height: 100vh;
+    }
+</style>
+"""
 
+# Thanh tìm kiếm Dashboard / KT kho: nút Tìm và Xóa thẳng hàng với ô nhập
+_SEARCH_BAR_CSS = """
+<style>
+div[data-testid="column"]:nth-of-type(3) button,
+div[data-testid="column"]:nth-of-type(4) button {
+    height: 38px;
+    margin-top: 0px;
+}
+</style>
+"""
+
+
+def inject_styles():
+    """Apply sidebar + main styles in a single markdown element."""
+    st.markdown(_BASE_CSS, unsafe_allow_html=True)
 
-def inject_main_styles():
-    """Apply global spacing tweaks for better mobile experience and dashboard styling."""
-    st.markdown(
-        """
-        <style>
-        /* Compact main padding for small screens */
-        @media (max-width: 768px) {
-            [data-testid="stAppViewContainer"] .main .block-container {
-                padding-top: 1rem;
-                padding-bottom: 2rem;
-                padding-left: 0.9rem;
-                padding-right: 0.9rem;
-            }
-        }
-        
-        </style>
-        """,
-        unsafe_allow_html=True,
-    )
 
 # Function definitions
 def scan_qr_screen():
@@ -458,9 +930,8 @@ def scan_qr_screen():
             # Show processing indicator
             with st.spinner("Đang xử lý và nhận diện QR code..."):
                 try:
-                    # Decode QR code automatically
-                    image = Image.open(picture)
-                    qr_text = decode_qr_from_image(image)
+                    # Decode QR code automatically (OpenCV đọc thẳng bytes ảnh xám)
+                    qr_text = decode_qr_from_bytes(picture.getvalue())
                 except Exception as e:
                     st.error(f"❌ Lỗi khi xử lý ảnh: {str(e)}")
                     qr_text = None
@@ -525,6 +996,208 @@ def scan_qr_screen():
         st.info("Click nút 'Bắt đầu quét' để mở camera và quét QR code")
 
 
+def _fragment(run_every=None):
+    """st.fragment nếu bản Streamlit hỗ trợ, ngược lại chạy như hàm thường."""
+    fragment = getattr(st, 'fragment', None) or getattr(st, 'experimental_fragment', None)
+    if fragment is None:
+        return lambda func: func
+    return fragment(run_every=run_every) if run_every else fragment
+
+
+@st.cache_resource
+def _background_executor():
+    """Thread pool dùng chung cho các tác vụ nền (upload Drive, Telegram)."""
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="bg-job")
+
+
+def _receive_shipment_job(qr_code, updated_by, files_data, reused_urls=None):
+    """
+    Chạy nền: upload ảnh, cập nhật trạng thái 'Đã nhận' và gửi Telegram.
+    Không gọi st.* ở đây; kết quả trả về dict để fragment hiển thị.
+    - reused_urls: [(index, url)] của ảnh đã upload trước đó (trùng nội dung), không upload lại
+    """
+    reused_urls = reused_urls or []
+    job = {
+        'success': False, 'error': None, 'qr_code': qr_code, 'image_url': None,
+        'uploaded': 0, 'total_images': len(files_data) + len(reused_urls), 'upload_errors': [],
+        'uploaded_hashes': {}, 'telegram': None, 'shipment': None
+    }
+    try:
+        image_url = None
+        if files_data or reused_urls:
+            indexed_urls = list(reused_urls)
+            upload_results = upload_multiple_files_to_drive(files_data, max_workers=5) if files_data else []
+            hashes = {data['index']: data.get('hash') for data in files_data}
+            for result in upload_results:
+                if result['success']:
+                    indexed_urls.append((result['index'], result['url']))
+                    if hashes.get(result['index']):
+                        job['uploaded_hashes'][hashes[result['index']]] = result['url']
+                    print(f"✅ Upload ảnh {result['index']} thành công: {result['url']}")
+                else:
+                    job['upload_errors'].append(f"Upload ảnh {result['index']} thất bại: {result['error']}")
+                    print(f"❌ Upload ảnh {result['index']} thất bại: {result['error']}")
+            if not indexed_urls:
+                job['error'] = "Không có ảnh nào được upload thành công!"
+                return job
+            urls = [url for _, url in sorted(indexed_urls)]
+            image_url = encode_image_urls(urls)
+            job['uploaded'] = len(urls)
+            print(f"📸 Image URLs: {image_url}")
+
+        result = update_shipment_status(
+            qr_code=qr_code,
+            new_status='Đã nhận',
+            updated_by=updated_by,
+            notes=None,
+            image_url=image_url
+        )
+        if not result['success']:
+            job['error'] = result['error']
+            return job
+        job['success'] = True
+        job['image_url'] = image_url
+
+        updated_shipment = result.get('shipment')
+        job['shipment'] = updated_shipment
+        if updated_shipment:
+            print(f"📤 Gửi Telegram với {job['uploaded']} ảnh: {updated_shipment.get('image_url', 'N/A')}")
+            job['telegram'] = notify_shipment_if_received(
+                updated_shipment['id'],
+                force=True,
+                is_update_image=bool(image_url)
+            )
+    except Exception as e:
+        print(f"❌ Lỗi xử lý nền cho {qr_code}: {e}")
+        job['error'] = str(e)
+    return job
+
+
+def submit_receive_job(qr_code, updated_by, files_data, reused_urls=None):
+    """Đưa tác vụ 'Đã nhận' vào hàng đợi nền, trả về job_id."""
+    job_id = f"{qr_code}-{datetime.now().strftime('%H%M%S%f')}"
+    future = _background_executor().submit(_receive_shipment_job, qr_code, updated_by, files_data, reused_urls)
+    st.session_state.setdefault('pending_uploads', {})[job_id] = {
+        'future': future,
+        'qr_code': qr_code,
+        'num_images': len(files_data),
+    }
+    return job_id
+
+
+@_fragment(run_every=1.0)
+def render_pending_uploads():
+    """Theo dõi các tác vụ nền; khi xong thì lưu kết quả và rerun toàn trang."""
+    jobs = st.session_state.get('pending_uploads') or {}
+    if not jobs:
+        return
+    finished = []
+    for job_id, job in list(jobs.items()):
+        if job['future'].done():
+            finished.append(job_id)
+        elif job['num_images']:
+            st.info(f"⏳ Đang upload {job['num_images']} ảnh và cập nhật phiếu {job['qr_code']}...")
+        else:
+            st.info(f"⏳ Đang cập nhật phiếu {job['qr_code']}...")
+    if not finished:
+        return
+    results = st.session_state.setdefault('receive_job_results', [])
+    for job_id in finished:
+        job = jobs.pop(job_id)
+        try:
+            outcome = job['future'].result()
+        except Exception as e:
+            outcome = {'success': False, 'error': str(e), 'qr_code': job['qr_code'], 'upload_errors': []}
+        results.append(outcome)
+        # Ghi nhớ hash -> url để lần sau không upload lại cùng một ảnh
+        st.session_state.setdefault('uploaded_hashes', {}).update(outcome.get('uploaded_hashes') or {})
+        found = st.session_state.get('found_shipment')
+        if outcome.get('shipment') and found and found.get('qr_code') == outcome['qr_code']:
+            st.session_state['found_shipment'] = outcome['shipment']
+    st.rerun()
+
+
+def show_receive_job_results():
+    """Hiển thị kết quả các tác vụ 'Đã nhận' đã chạy xong (một lần)."""
+    results = st.session_state.pop('receive_job_results', None)
+    if not results:
+        return
+    for outcome in results:
+        for err in outcome.get('upload_errors') or []:
+            st.error(f"❌ {err}")
+        if not outcome.get('success'):
+            st.error(f"❌ {outcome.get('qr_code')}: {outcome.get('error')}")
+            continue
+        st.success(f"✅ {outcome['qr_code']}: đã cập nhật trạng thái thành **Đã nhận**")
+        if outcome.get('image_url'):
+            st.success(f"📸 Đã upload {outcome['uploaded']}/{outcome['total_images']} ảnh lên Drive")
+        telegram_result = outcome.get('telegram')
+        if telegram_result and telegram_result.get('success'):
+            st.success("✅ Đã gửi thông báo Telegram")
+        elif telegram_result:
+            st.warning(f"⚠️ Gửi Telegram: {telegram_result.get('error', 'Lỗi không xác định')}")
+
+
+def submit_telegram_notify(shipment_id, is_update_image=False, force=True, error_key=None):
+    """
+    Gửi Telegram trong thread nền, không chặn rerun; kết quả xem ở render_telegram_status.
+    error_key: nếu có, lỗi được lưu vào st.session_state[error_key] thay vì danh sách chung.
+    """
+    future = _background_executor().submit(
+        notify_shipment_if_received, shipment_id, force=force, is_update_image=is_update_image
+    )
+    st.session_state.setdefault('telegram_futs', {})[shipment_id] = (future, error_key)
+    return future
+
+
+@_fragment(run_every=2.0)
+def render_telegram_status():
+    """
+    Theo dõi các thông báo Telegram đang gửi nền. Kết quả chuyển vào session_state
+    (hiển thị ở show_telegram_results, ngoài fragment) để không mất sau lần chạy lại kế tiếp;
+    khi tin cuối cùng xong thì rerun toàn trang để gỡ fragment.
+    """
+    futs = st.session_state.get('telegram_futs') or {}
+    if not futs:
+        return
+    for shipment_id, (future, error_key) in list(futs.items()):
+        if not future.done():
+            st.caption("📤 Đang gửi thông báo Telegram...")
+            continue
+        futs.pop(shipment_id)
+        try:
+            telegram_result = future.result()
+        except Exception as e:
+            telegram_result = {'success': False, 'error': str(e)}
+        if telegram_result and telegram_result.get('success'):
+            st.session_state['telegram_sent'] = st.session_state.get('telegram_sent', 0) + 1
+            print(f"✅ Telegram gửi thành công: {telegram_result}")
+        else:
+            error = telegram_result.get('error', 'Lỗi không xác định') if telegram_result else 'Không nhận được phản hồi từ Telegram'
+            if error_key:
+                st.session_state[error_key] = error
+            else:
+                st.session_state.setdefault('telegram_errors', []).append(error)
+            print(f"❌ Telegram lỗi: {error}")
+    if not futs:
+        st.rerun()
+
+
+def show_telegram_results():
+    """Kết quả gửi Telegram nền: báo thành công một lần, lỗi giữ lại đến khi người dùng đóng."""
+    sent = st.session_state.pop('telegram_sent', 0)
+    if sent:
+        st.toast("✅ Đã gửi thông báo Telegram")
+    errors = st.session_state.get('telegram_errors')
+    if not errors:
+        return
+    for error in errors:
+        st.warning(f"⚠️ Gửi Telegram: {error}")
+    if st.button("Đóng thông báo", key="dismiss_telegram_errors"):
+        st.session_state.pop('telegram_errors', None)
+        st.rerun()
+
+
 def show_shipment_info(current_user, shipment):
     """Show existing shipment information with option to mark as received"""
     st.subheader("📦 Thông Tin Phiếu Gửi Hàng")
@@ -561,13 +1234,7 @@ def show_shipment_info(current_user, shipment):
         # Display existing images if any
         if shipment.get('image_url'):
             st.write("### Ảnh Đính Kèm")
-            image_urls = shipment['image_url'].split(';')
-            for idx, img_url in enumerate(image_urls, 1):
-                if img_url.strip():
-                    try:
-                        st.image(img_url.strip(), width=300, caption=f"Ảnh {idx}")
-                    except:
-                        st.markdown(f"[Mở ảnh {idx}]({img_url.strip()})")
+            show_image_urls(parse_image_urls(shipment['image_url']), width=300, caption_prefix="Ảnh")
         
         # Button to scan again
         if st.button("🔄 Quét lại QR code", key="rescan_btn"):
@@ -578,116 +1245,63 @@ def show_shipment_info(current_user, shipment):
     
     with col2:
         st.subheader("Cập Nhật Trạng Thái")
+        show_receive_job_results()
+        show_telegram_results()
+        # Fragment tự rerun định kỳ: chỉ gắn khi có tác vụ nền đang chạy
+        if st.session_state.get('pending_uploads'):
+            render_pending_uploads()
+        if st.session_state.get('telegram_futs'):
+            render_telegram_status()
         
         current_status = shipment['status']
         st.info(f"Trạng thái hiện tại: **{current_status}**")
         
         # Only show "Đã nhận" button if not yet received
-        if current_status != 'Đã nhận':
-            # Quick upload images for "Đã nhận" button
-            quick_upload_images = st.file_uploader(
-                "📷 Thêm ảnh khi đánh dấu 'Đã nhận' (tùy chọn)", 
-                type=["png", "jpg", "jpeg"], 
-                accept_multiple_files=True, 
-                key="upload_image_quick_received"
-            )
-            
-            if st.button("✅ Đã Nhận", type="primary", key="mark_received_btn"):
-                # Upload images if provided
-                image_url = None
-                if quick_upload_images:
-                    with st.spinner(f"Đang upload {len(quick_upload_images)} ảnh lên Google Drive (song song)..."):
-                        # Prepare files data for parallel upload
-                        sanitized_qr = shipment['qr_code'].strip().replace(" ", "_") or "qr_image"
-                        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                        files_data = []
-                        for idx, f in enumerate(quick_upload_images, start=1):
-                            file_bytes = f.getvalue()
-                            mime = f.type or "image/jpeg"
-                            orig_name = f.name or "image.jpg"
-                            ext = ""
-                            if "." in orig_name:
-                                ext = orig_name.split(".")[-1]
-                            if not ext:
-                                ext = "jpg"
-                            drive_filename = f"{sanitized_qr}_received_{timestamp}_anh{idx}.{ext}"
-                            files_data.append({
-                                'file_bytes': file_bytes,
-                                'filename': drive_filename,
-                                'mime_type': mime,
-                                'index': idx
-                            })
-                        
-                        # Upload all files in parallel
-                        upload_results = upload_multiple_files_to_drive(files_data, max_workers=5)
-                        
-                        # Process results
-                        urls = []
-                        success_count = 0
-                        for result in upload_results:
-                            if result['success']:
-                                urls.append(result['url'])
-                                success_count += 1
-                                print(f"✅ Upload ảnh {result['index']} thành công: {result['url']}")
-                            else:
-                                st.error(f"❌ Upload ảnh {result['index']} thất bại: {result['error']}")
-                                print(f"❌ Upload ảnh {result['index']} thất bại: {result['error']}")
-                        
-                        if urls:
-                            image_url = ";".join(urls)
-                            st.success(f"📸 Đã upload {success_count}/{len(quick_upload_images)} ảnh lên Drive")
-                            print(f"📸 Image URLs: {image_url}")
-                        else:
-                            st.error("❌ Không có ảnh nào được upload thành công!")
-                            st.stop()
-                
-                result = update_shipment_status(
-                    qr_code=shipment['qr_code'],
-                    new_status='Đã nhận',
-                    updated_by=current_user,
-                    notes=None,
-                    image_url=image_url if image_url else None
-                )
-                
-                if result['success']:
-                    st.success("✅ Đã cập nhật trạng thái thành: **Đã nhận**")
-                    if image_url:
-                        st.success(f"✅ Đã thêm {len(quick_upload_images)} ảnh vào phiếu")
-                        st.info(f"🔗 Link ảnh: {image_url[:100]}..." if len(image_url) > 100 else f"🔗 Link ảnh: {image_url}")
-                    st.balloons()
-                    # Refresh shipment data first to get updated image_url
-                    updated_shipment = get_shipment_by_qr_code(shipment['qr_code'])
-                    if updated_shipment:
-                        st.session_state['found_shipment'] = updated_shipment
-                        # Notify Telegram with updated shipment data
-                        if image_url:
-                            num_images = len(quick_upload_images) if quick_upload_images else len(image_url.split(';')) if image_url else 0
-                            with st.spinner(f"Đang gửi {num_images} ảnh lên Telegram..."):
-                                print(f"📤 Gửi Telegram với {num_images} ảnh: {updated_shipment.get('image_url', 'N/A')}")
-                                telegram_result = notify_shipment_if_received(
-                                    updated_shipment['id'], 
-                                    force=True, 
-                                    is_update_image=True
-                                )
-                                if telegram_result and telegram_result.get('success'):
-                                    st.success(f"✅ Đã gửi {num_images} ảnh lên Telegram")
-                                    print(f"✅ Telegram gửi thành công: {telegram_result}")
-                                elif telegram_result:
-                                    st.warning(f"⚠️ Gửi Telegram: {telegram_result.get('error', 'Lỗi không xác định')}")
-                                    print(f"❌ Telegram lỗi: {telegram_result.get('error', 'Lỗi không xác định')}")
-                                else:
-                                    st.warning("⚠️ Không nhận được phản hồi từ Telegram")
-                                    print("❌ Telegram không trả về kết quả")
-                        else:
-                            print(f"📤 Gửi Telegram không có ảnh")
-                            notify_shipment_if_received(
-                                updated_shipment['id'], 
-                                force=True, 
-                                is_update_image=False
-                            )
-                    st.rerun()
-                else:
-                    st.error(f"❌ {result['error']}")
+        if current_status != 'Đã nhận':
+            # Quick upload images for "Đã nhận" button
+            quick_upload_images = st.file_uploader(
+                "📷 Thêm ảnh khi đánh dấu 'Đã nhận' (tùy chọn)", 
+                type=["png", "jpg", "jpeg"], 
+                accept_multiple_files=True, 
+                key="upload_image_quick_received"
+            )
+            
+            pending_qrs = {job['qr_code'] for job in (st.session_state.get('pending_uploads') or {}).values()}
+            if shipment['qr_code'] in pending_qrs:
+                st.info("⏳ Đang xử lý 'Đã nhận' cho phiếu này...")
+            elif st.button("✅ Đã Nhận", type="primary", key="mark_received_btn"):
+                # Chuẩn bị dữ liệu ảnh (nhanh), phần upload + cập nhật + Telegram chạy nền
+                files_data = []
+                reused_urls = []
+                if quick_upload_images:
+                    sanitized_qr = sanitize_filename_part(shipment['qr_code'], "qr_image")
+                    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+                    uploaded_hashes = st.session_state.setdefault('uploaded_hashes', {})
+                    seen_hashes = set()
+                    for idx, f in enumerate(quick_upload_images, start=1):
+                        # Hash trên bytes gốc (trước khi thu nhỏ) để nhận ra ảnh trùng
+                        digest = hashlib.blake2b(f.getbuffer(), digest_size=16).hexdigest()
+                        if digest in seen_hashes:
+                            # Cùng một ảnh chọn 2 lần trong một lượt
+                            continue
+                        seen_hashes.add(digest)
+                        if digest in uploaded_hashes:
+                            # Ảnh đã upload trước đó (bấm lại / gửi lại) -> dùng lại link
+                            reused_urls.append((idx, uploaded_hashes[digest]))
+                            continue
+                        file_bytes, mime, ext = prepare_image_upload(f)
+                        drive_filename = f"{sanitized_qr}_received_{timestamp}_anh{idx}.{ext}"
+                        files_data.append({
+                            'file_bytes': file_bytes,
+                            'filename': drive_filename,
+                            'mime_type': mime,
+                            'index': idx,
+                            'hash': digest
+                        })
+                
+                submit_receive_job(shipment['qr_code'], current_user, files_data, reused_urls)
+                st.toast(f"⏳ Đang xử lý 'Đã nhận' cho {shipment['qr_code']}...")
+                st.rerun()
         else:
             st.success("✅ Phiếu đã được tiếp nhận")
         
@@ -715,27 +1329,8 @@ def show_shipment_info(current_user, shipment):
                 image_url = None
                 if uploaded_images:
                     with st.spinner(f"Đang upload {len(uploaded_images)} ảnh lên Google Drive (song song)..."):
-                        # Prepare files data for parallel upload
-                        sanitized_qr = shipment['qr_code'].strip().replace(" ", "_").replace("/", "_") or "qr_image"
-                        sanitized_status = new_status.replace(" ", "_").replace("/", "_") if new_status else "unknown"
-                        files_data = []
-                        for idx, f in enumerate(uploaded_images, start=1):
-                            file_bytes = f.getvalue()
-                            mime = f.type or "image/jpeg"
-                            orig_name = f.name or "image.jpg"
-                            ext = ""
-                            if "." in orig_name:
-                                ext = orig_name.split(".")[-1]
-                            if not ext:
-                                ext = "jpg"
-                            # Tên file: mã QR + trạng thái + stt
-                            drive_filename = f"{sanitized_qr}_{sanitized_status}_{idx}.{ext}"
-                            files_data.append({
-                                'file_bytes': file_bytes,
-                                'filename': drive_filename,
-                                'mime_type': mime,
-                                'index': idx
-                            })
+                        # Prepare files data for parallel upload (tên file làm sạch một lần cho cả lô)
+                        files_data = build_upload_files_data(uploaded_images, shipment['qr_code'], new_status, "unknown")
                         
                         # Upload all files in parallel
                         upload_results = upload_multiple_files_to_drive(files_data, max_workers=5)
@@ -753,7 +1348,7 @@ def show_shipment_info(current_user, shipment):
                                 print(f"❌ Upload ảnh {result['index']} thất bại: {result['error']}")
                         
                         if urls:
-                            image_url = ";".join(urls)
+                            image_url = encode_image_urls(urls)
                             st.success(f"📸 Đã upload {success_count}/{len(uploaded_images)} ảnh lên Drive")
                             print(f"📸 Image URLs: {image_url}")
                         else:
@@ -777,36 +1372,14 @@ def show_shipment_info(current_user, shipment):
                         st.success(f"✅ Đã thêm {len(uploaded_images)} ảnh vào phiếu")
                         st.info(f"🔗 Link ảnh: {image_url[:100]}..." if len(image_url) > 100 else f"🔗 Link ảnh: {image_url}")
                     st.balloons()
-                    # Refresh shipment data first to get updated image_url
-                    updated_shipment = get_shipment_by_qr_code(shipment['qr_code'])
+                    # Dòng đã cập nhật (kèm image_url mới) trả về từ update_shipment_status
+                    updated_shipment = result.get('shipment')
                     if updated_shipment:
                         st.session_state['found_shipment'] = updated_shipment
-                        # Notify Telegram if Đã nhận
+                        # Notify Telegram if Đã nhận (chạy nền, không chặn rerun)
                         if new_status == 'Đã nhận':
-                            if image_url:
-                                with st.spinner("Đang gửi ảnh lên Telegram..."):
-                                    print(f"📤 Gửi Telegram với ảnh: {updated_shipment.get('image_url', 'N/A')}")
-                                    telegram_result = notify_shipment_if_received(
-                                        updated_shipment['id'], 
-                                        force=True, 
-                                        is_update_image=True
-                                    )
-                                    if telegram_result and telegram_result.get('success'):
-                                        st.success("✅ Đã gửi ảnh lên Telegram")
-                                        print(f"✅ Telegram gửi thành công: {telegram_result}")
-                                    elif telegram_result:
-                                        st.warning(f"⚠️ Gửi Telegram: {telegram_result.get('error', 'Lỗi không xác định')}")
-                                        print(f"❌ Telegram lỗi: {telegram_result.get('error', 'Lỗi không xác định')}")
-                                    else:
-                                        st.warning("⚠️ Không nhận được phản hồi từ Telegram")
-                                        print("❌ Telegram không trả về kết quả")
-                            else:
-                                print(f"📤 Gửi Telegram không có ảnh")
-                                notify_shipment_if_received(
-                                    updated_shipment['id'], 
-                                    force=True, 
-                                    is_update_image=False
-                                )
+                            print(f"📤 Gửi Telegram nền: {updated_shipment.get('image_url') or 'không có ảnh'}")
+                            submit_telegram_notify(updated_shipment['id'], is_update_image=bool(image_url))
                     st.rerun()
                 else:
                     st.error(f"❌ {result['error']}")
@@ -818,15 +1391,8 @@ def show_create_shipment_form(current_user, qr_code):
     """Show form to create shipment from scanned QR code"""
     st.subheader("📝 Tạo Phiếu Gửi Hàng")
     
-    # Initialize form data in session state if not exists
-    if 'form_qr_code' not in st.session_state:
-        st.session_state['form_qr_code'] = qr_code
-    if 'form_imei' not in st.session_state:
-        st.session_state['form_imei'] = ''
-    if 'form_device_name' not in st.session_state:
-        st.session_state['form_device_name'] = ''
-    if 'form_capacity' not in st.session_state:
-        st.session_state['form_capacity'] = ''
+    # Giá trị các ô nhập do Streamlit giữ theo key=; chỉ điền sẵn mã QR vừa quét
+    st.session_state.setdefault('form_qr_code', qr_code)
     
     col1, col2 = st.columns([2, 1])
     
@@ -837,35 +1403,27 @@ def show_create_shipment_form(current_user, qr_code):
         # Editable form fields
         qr_code = st.text_input(
             "Mã QR Code:",
-            value=st.session_state['form_qr_code'],
-            key="input_qr_code",
+            key="form_qr_code",
             help="Mã QR code từ phiếu"
         )
-        st.session_state['form_qr_code'] = qr_code
         
         imei = st.text_input(
             "IMEI:",
-            value=st.session_state['form_imei'],
-            key="input_imei",
+            key="form_imei",
             help="IMEI của thiết bị"
         )
-        st.session_state['form_imei'] = imei
         
         device_name = st.text_input(
             "Tên thiết bị:",
-            value=st.session_state['form_device_name'],
-            key="input_device_name",
+            key="form_device_name",
             help="Tên thiết bị (ví dụ: iPhone 15 Pro Max)"
         )
-        st.session_state['form_device_name'] = device_name
         
         capacity = st.text_input(
             "Lỗi / Tình trạng *:",
-            value=st.session_state['form_capacity'],
-            key="input_capacity",
+            key="form_capacity",
             help="Lỗi hoặc tình trạng thiết bị"
         )
-        st.session_state['form_capacity'] = capacity
         
         # Show which fields are empty
         empty_fields = []
@@ -894,10 +1452,8 @@ def show_create_shipment_form(current_user, qr_code):
         st.subheader("Thông Tin Phiếu")
         
         # Kiểm tra user có phải cửa hàng không
-        store_user = is_store_user()
-        store_name = None
+        store_user, store_name = get_store_context()
         if store_user:
-            store_name = get_store_name_from_username(current_user)
             st.info(f"🏪 Tạo phiếu cho: **{store_name}**")
         
         # Trường cửa hàng (chỉ hiện cho user cửa hàng)
@@ -945,29 +1501,10 @@ def show_create_shipment_form(current_user, qr_code):
             else:
                 image_url = None
                 if uploaded_images_create:
-                    urls = []
                     current_status = 'Đã nhận'  # Default status for new shipments
-                    sanitized_qr = qr_code.strip().replace(" ", "_").replace("/", "_") or "qr_image"
-                    sanitized_status = current_status.replace(" ", "_").replace("/", "_")
-                    for idx, f in enumerate(uploaded_images_create, start=1):
-                        file_bytes = f.getvalue()
-                        mime = f.type or "image/jpeg"
-                        orig_name = f.name or "image.jpg"
-                        ext = ""
-                        if "." in orig_name:
-                            ext = orig_name.split(".")[-1]
-                        if not ext:
-                            ext = "jpg"
-                        # Tên file: mã QR + trạng thái + stt
-                        drive_filename = f"{sanitized_qr}_{sanitized_status}_{idx}.{ext}"
-                        upload_res = upload_file_to_drive(file_bytes, drive_filename, mime)
-                        if upload_res['success']:
-                            urls.append(upload_res['url'])
-                        else:
-                            st.error(f"❌ Upload ảnh {idx} thất bại: {upload_res['error']}")
-                            st.stop()
+                    urls = upload_images_or_stop(uploaded_images_create, qr_code, current_status)
                     if urls:
-                        image_url = ";".join(urls)
+                        image_url = encode_image_urls(urls)
 
                 # Set status mặc định: "Đã nhận"
                 default_status = 'Đã nhận'
@@ -975,9 +1512,7 @@ def show_create_shipment_form(current_user, qr_code):
                 # Tự động set nơi tiếp nhận = store_name của user
                 reception_location = store_name if store_name else None
                 if not reception_location:
-                    store_user = is_store_user()
-                    if store_user:
-                        reception_location = get_store_name_from_username(current_user)
+                    _, reception_location = get_store_context()
                 
                 result = save_shipment(
                     qr_code=qr_code.strip(),
@@ -1057,8 +1592,7 @@ def receive_shipment_screen():
             # Show processing indicator
             with st.spinner("Đang xử lý và nhận diện QR code..."):
                 # Decode QR code automatically
-                image = Image.open(picture)
-                qr_text = decode_qr_from_image(image)
+                qr_text = decode_qr_from_bytes(picture.getvalue())
             
             if qr_text:
                 # Chỉ lấy mã QR (toàn bộ chuỗi quét được)
@@ -1141,44 +1675,35 @@ def show_update_shipment_form(current_user, found_shipment):
             st.info("📋 Bạn chỉ có thể xem thông tin phiếu này.")
         else:
             # Tạo danh sách trạng thái động (bao gồm "Gửi + tên NCC")
-            suppliers_df = get_suppliers()
-            status_options = STATUS_VALUES.copy()
-            
-            # Thêm các trạng thái "Gửi + tên NCC" nếu chưa có
-            for _, supplier_row in suppliers_df.iterrows():
-                supplier_name = supplier_row['name']
-                send_status = f"Gửi {supplier_name}"
-                if send_status not in status_options:
-                    status_options.append(send_status)
-            
-            new_status = st.selectbox(
-                "Trạng thái mới:",
-                status_options,
-                index=status_options.index(current_status) if current_status in status_options else 0,
-                key="status_select"
-            )
+            status_options = build_status_options(_get_suppliers_cached()['name'].tolist())
             
-            # Hiển thị selectbox "Người sửa" khi chọn "Đang sửa chữa"
-            repairer = None
-            if new_status == "Đang sửa chữa":
-                users_df = get_all_users()
-                user_list = users_df['username'].tolist() if not users_df.empty else [current_user]
-                current_repairer = found_shipment.get('repairer', current_user)
-                repairer_idx = user_list.index(current_repairer) if current_repairer in user_list else 0
+            # Gom các ô nhập vào st.form: chỉ rerun một lần khi bấm Cập Nhật
+            with st.form("update_ship"):
+                new_status = st.selectbox(
+                    "Trạng thái mới:",
+                    status_options,
+                    index=status_options.index(current_status) if current_status in status_options else 0,
+                    key="status_select"
+                )
+                
+                # "Người sửa" chỉ áp dụng khi chọn "Đang sửa chữa"
+                # (trong form không rerun khi đổi trạng thái nên luôn hiển thị)
+                users_df = get_all_users_cached()
+                user_list = users_df['username'].to_numpy().tolist() if not users_df.empty else [current_user]
                 if current_user not in user_list:
                     user_list.insert(0, current_user)
-                    repairer_idx = 0
-                
+                current_repairer = found_shipment.get('repairer') or current_user
                 repairer = st.selectbox(
-                    "Người sửa:",
+                    "Người sửa (khi chọn 'Đang sửa chữa'):",
                     user_list,
-                    index=repairer_idx if current_repairer in user_list else user_list.index(current_user) if current_user in user_list else 0,
+                    index=user_list.index(current_repairer) if current_repairer in user_list else 0,
                     key="repairer_select"
                 )
+                
+                notes = st.text_area("Ghi chú cập nhật:", key="update_notes")
+                submitted = st.form_submit_button("Cập Nhật", type="primary")
             
-            notes = st.text_area("Ghi chú cập nhật:", key="update_notes")
-            
-            if st.button("Cập Nhật", type="primary", key="update_btn"):
+            if submitted:
                 if new_status != current_status:
                     # Cập nhật repairer nếu trạng thái là "Đang sửa chữa"
                     # Đảm bảo repairer luôn có giá trị (mặc định là current_user nếu không chọn)
@@ -1187,33 +1712,42 @@ def show_update_shipment_form(current_user, found_shipment):
                         repairer_value = repairer if repairer else current_user
                     
                     result = update_shipment(
-                    shipment_id=found_shipment['id'],
-                    status=new_status,
-                    updated_by=current_user,
-                    notes=notes if notes else None,
-                    repairer=repairer_value
-                )
-                
-                if result['success']:
-                    st.success(f"Đã cập nhật trạng thái thành: **{new_status}**")
-                    st.balloons()
-                    # Notify Telegram nếu đã nhận hoặc hoàn thành
-                    if new_status in ['Đã nhận', 'Hoàn thành chuyển cửa hàng']:
-                        res = notify_shipment_if_received(found_shipment['id'], force=True)
-                        if res and not res.get('success'):
-                            st.warning(f"Không gửi được Telegram: {res.get('error')}")
-                    # Clear found shipment
-                    if 'found_shipment' in st.session_state:
-                        del st.session_state['found_shipment']
-                    if 'shipment_found' in st.session_state:
-                        st.session_state['shipment_found'] = False
-                    if 'show_camera_receive' in st.session_state:
-                        st.session_state['show_camera_receive'] = False
-                    st.rerun()
+                        shipment_id=found_shipment['id'],
+                        status=new_status,
+                        updated_by=current_user,
+                        notes=notes if notes else None,
+                        repairer=repairer_value
+                    )
+                    
+                    if result['success']:
+                        st.success(f"Đã cập nhật trạng thái thành: **{new_status}**")
+                        st.balloons()
+                        # Notify Telegram nếu đã nhận hoặc hoàn thành
+                        if new_status in ['Đã nhận', 'Hoàn thành chuyển cửa hàng']:
+                            res = notify_shipment_if_received(found_shipment['id'], force=True)
+                            if res and not res.get('success'):
+                                st.warning(f"Không gửi được Telegram: {res.get('error')}")
+                        # Clear found shipment
+                        if 'found_shipment' in st.session_state:
+                            del st.session_state['found_shipment']
+                        if 'shipment_found' in st.session_state:
+                            st.session_state['shipment_found'] = False
+                        if 'show_camera_receive' in st.session_state:
+                            st.session_state['show_camera_receive'] = False
+                        st.rerun()
+                    else:
+                        st.error(f"❌ {result['error']}")
                 else:
-                    st.error(f"❌ {result['error']}")
-            else:
-                st.warning("⚠️ Vui lòng chọn trạng thái khác với trạng thái hiện tại!")
+                    st.warning("⚠️ Vui lòng chọn trạng thái khác với trạng thái hiện tại!")
+
+
+# Box "Thời gian cập nhật trạng thái" trong popup chi tiết phiếu (HTML cố định, chỉ thay thời gian)
+LAST_UPDATED_BOX_HTML = (
+    '<div style="background:#f0f9ff;border:1px solid #bae6fd;border-radius:0.5rem;padding:0.75rem;margin-top:0.5rem">'
+    '<strong style="color:#0369a1">⏰ Thời gian cập nhật trạng thái:</strong><br>'
+    '<span style="color:#1e40af;font-weight:500">{last_updated}</span>'
+    '</div>'
+)
 
 
 def show_shipment_detail_popup(shipment_id):
@@ -1236,43 +1770,20 @@ def show_shipment_detail_popup(shipment_id):
         
         with col2:
             st.write(f"**Trạng thái:** {shipment.get('status', '')}")
-            sent_time_str = ""
-            if shipment.get('sent_time'):
-                try:
-                    sent_time_str = pd.to_datetime(shipment.get('sent_time')).strftime('%d/%m/%Y %H:%M:%S')
-                except:
-                    sent_time_str = shipment.get('sent_time', '')
+            sent_time_str = format_timestamp(shipment.get('sent_time'))
             st.write(f"**Ngày nhận:** {sent_time_str}")
             
-            completed_time_str = ""
-            if shipment.get('completed_time'):
-                try:
-                    completed_time_str = pd.to_datetime(shipment.get('completed_time')).strftime('%d/%m/%Y %H:%M:%S')
-                except:
-                    completed_time_str = shipment.get('completed_time', '')
+            completed_time_str = format_timestamp(shipment.get('completed_time'))
             st.write(f"**Ngày trả:** {completed_time_str if completed_time_str else '-'}")
             
             # Thời gian cập nhật trạng thái
-            last_updated_str = ""
-            if shipment.get('last_updated'):
-                try:
-                    last_updated_str = pd.to_datetime(shipment.get('last_updated')).strftime('%d/%m/%Y %H:%M:%S')
-                except:
-                    last_updated_str = shipment.get('last_updated', '')
+            last_updated_str = format_timestamp(shipment.get('last_updated'))
             
             # Box thời gian update
-            st.markdown(f"""
-            <div style="
-                background: #f0f9ff;
-                border: 1px solid #bae6fd;
-                border-radius: 0.5rem;
-                padding: 0.75rem;
-                margin-top: 0.5rem;
-            ">
-                <strong style="color: #0369a1;">⏰ Thời gian cập nhật trạng thái:</strong><br>
-                <span style="color: #1e40af; font-weight: 500;">{last_updated_str if last_updated_str else 'Chưa có'}</span>
-            </div>
-            """, unsafe_allow_html=True)
+            st.markdown(
+                LAST_UPDATED_BOX_HTML.format(last_updated=html.escape(last_updated_str or 'Chưa có')),
+                unsafe_allow_html=True
+            )
             
             st.write(f"**Cửa hàng:** {shipment.get('store_name', '') or '-'}")
             st.write(f"**Ghi chú:** {shipment.get('notes', '') or '-'}")
@@ -1280,48 +1791,60 @@ def show_shipment_detail_popup(shipment_id):
         # Show images if available
         if shipment.get('image_url'):
             st.subheader("Ảnh")
-            image_urls = shipment['image_url'].split(';')
-            for img_url in image_urls:
-                if img_url.strip():
-                    try:
-                        st.image(img_url.strip(), width=300)
-                    except:
-                        st.write(f"Link ảnh: {img_url.strip()}")
+            show_image_urls(parse_image_urls(shipment['image_url']), width=300)
         
         # Show audit log
         st.divider()
         st.subheader("Lịch sử thay đổi")
-        audit_df = get_audit_log()
+        audit_df = get_audit_log(limit=None, shipment_id=shipment_id)
         if not audit_df.empty:
-            audit_df = audit_df[audit_df['shipment_id'] == shipment_id]
-            if not audit_df.empty:
-                audit_df_display = audit_df[['timestamp', 'action', 'old_value', 'new_value', 'changed_by']].copy()
-                audit_df_display = audit_df_display.sort_values('timestamp', ascending=False)
-                st.dataframe(audit_df_display, use_container_width=True, hide_index=True)
-            else:
-                st.info("Chưa có lịch sử thay đổi cho phiếu này.")
+            audit_df_display = audit_df[['timestamp', 'action', 'old_value', 'new_value', 'changed_by']]
+            st.dataframe(audit_df_display, use_container_width=True, hide_index=True)
         else:
-            st.info("Chưa có lịch sử thay đổi.")
+            st.info("Chưa có lịch sử thay đổi cho phiếu này.")
+
+
+AUDIT_LOG_MAX_ROWS = 100
+AUDIT_CLEANUP_INTERVAL_SECONDS = 3600
+
+
+@st.cache_resource
+def _start_audit_cleanup():
+    """
+    Dọn AuditLog ngoài luồng giao diện: một thread nền mỗi process,
+    giữ lại AUDIT_LOG_MAX_ROWS bản ghi mới nhất, chạy lại mỗi giờ.
+    """
+    def _loop():
+        while True:
+            try:
+                cleanup_result = cleanup_audit_log(max_rows=AUDIT_LOG_MAX_ROWS)
+                if cleanup_result['success'] and cleanup_result['deleted_count'] > 0:
+                    _get_audit_log_cached.clear()
+                    _get_audit_log_csv.clear()
+                    print(f"🗑️ Đã tự động xóa {cleanup_result['deleted_count']} bản ghi audit cũ")
+            except Exception as e:
+                print(f"Error cleaning up audit log: {e}")
+            time.sleep(AUDIT_CLEANUP_INTERVAL_SECONDS)
+
+    threading.Thread(target=_loop, name="audit-cleanup", daemon=True).start()
 
 
 def show_audit_log():
     """Show audit log of all changes"""
     st.header("📋 Lịch Sử Thay Đổi")
+    st.caption(f"Hệ thống tự động giữ lại {AUDIT_LOG_MAX_ROWS} bản ghi mới nhất.")
     
-    # Tự động xóa các bản ghi cũ khi vượt quá 100
-    try:
-        cleanup_result = cleanup_audit_log(max_rows=100)
-        if cleanup_result['success'] and cleanup_result['deleted_count'] > 0:
-            st.info(f"🗑️ Đã tự động xóa {cleanup_result['deleted_count']} bản ghi cũ (giữ lại 100 bản ghi mới nhất)")
-    except Exception as e:
-        print(f"Error cleaning up audit log: {e}")
-    
-    # Get audit log
-    limit = st.slider("Số lượng bản ghi:", 10, 500, 100, 10)
-    df = get_audit_log(limit=limit)
+    # Get audit log (phân trang bằng LIMIT/OFFSET trong SQL)
+    col_limit, col_page = st.columns([3, 1])
+    with col_limit:
+        limit = st.slider("Số bản ghi mỗi trang:", 10, 500, 100, 10)
+    with col_page:
+        page = st.number_input("Trang:", min_value=1, value=1, step=1)
+    offset = (int(page) - 1) * limit
+    df = _get_audit_log_cached(limit=limit, offset=offset)
     
     if df.empty:
-        st.info("📭 Chưa có lịch sử thay đổi")
+        st.info("📭 Chưa có lịch sử thay đổi" if offset == 0 else "📭 Không còn bản ghi ở trang này")
         return
     
     # Display audit log
@@ -1333,20 +1856,222 @@ def show_audit_log():
     )
     
     # Export button
-    csv = df.to_csv(index=False).encode('utf-8-sig')
     st.download_button(
         label="📥 Tải Excel (CSV)",
-        data=csv,
+        data=_get_audit_log_csv(limit=limit, offset=offset),
         file_name=f"audit_log_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
         mime="text/csv"
     )
 
 
+# Nhãn "Loại yêu cầu" ở góc phải chi tiết phiếu (HTML cố định, chỉ thay nội dung)
+REQUEST_TYPE_BADGE_HTML = (
+    '<div style="margin-bottom:1rem">'
+    '<div style="font-size:0.875rem;color:#6b7280;margin-bottom:0.25rem">Loại yêu cầu</div>'
+    '<div style="font-size:1.125rem;font-weight:700;color:#3b82f6">{request_type}</div>'
+    '</div>'
+)
+
+
+@_fragment()
+def render_shipment_detail(row, supplier_names, status_options):
+    """
+    Chi tiết phiếu đang mở trong màn Quản lý phiếu (ảnh, tem, form chỉnh sửa).
+    Chạy dạng fragment: bấm in tem / chỉnh sửa chỉ chạy lại phần này, không dựng lại cả danh sách.
+    """
+    with st.expander(f"{row['qr_code']} - {row['device_name']} ({row['status']})", expanded=True):
+        if st.button("📁 Thu gọn", key=f"close_row_{row['id']}"):
+            st.session_state['manage_open_row_id'] = None
+            st.rerun()
+        col1, col2 = st.columns([2, 1])
+        
+        with col1:
+            st.write("**Thông tin phiếu:**")
+        info_col1, info_col2 = st.columns(2)
+        
+        with info_col1:
+            st.write(f"**Mã QR:** {row['qr_code']}")
+            st.write(f"**IMEI:** {row['imei']}")
+            st.write(f"**Tên thiết bị:** {row['device_name']}")
+            st.write(f"**Lỗi / Tình trạng:** {row['capacity']}")
+        
+        with info_col2:
+            st.write(f"**NCC:** {row['supplier']}")
+            st.write(f"**Trạng thái:** {row['status']}")
+            if row['store_name']:
+                st.write(f"**Cửa hàng:** {row['store_name']}")
+            st.write(f"**Thời gian gửi:** {row['sent_time']}")
+            if row['received_time']:
+                st.write(f"**Thời gian nhận:** {row['received_time']}")
+            if row['last_updated']:
+                st.write(f"**Cập nhật lúc:** {row['last_updated']}")
+            st.write(f"**Người tạo:** {row['created_by']}")
+            if row['updated_by']:
+                st.write(f"**Người cập nhật:** {row['updated_by']}")
+        
+        if row['notes']:
+            st.write(f"**Ghi chú:** {row['notes']}")
+
+        # Print label button
+        print_btn_key = f"print_label_{row['id']}"
+        if st.button("🖨️ In tem QR", key=print_btn_key):
+            st.session_state['label_preview_id'] = row['id']
+        if st.session_state.get('label_preview_id') == row['id']:
+            st.info("Xem trước tem. Bấm 'In tem' trong khung để in (chọn máy in/bkhổ giấy trong hộp thoại).")
+            render_label_component(row)
+        
+    with col2:
+        # Loại yêu cầu - hiển thị to rõ ở góc bên phải
+        request_type = row.get('request_type', 'Chưa xác định')
+        st.markdown(REQUEST_TYPE_BADGE_HTML.format(request_type=html.escape(str(request_type))), unsafe_allow_html=True)
+        
+        # Image upload status
+        if not row.get('image_url'):
+            st.markdown("<span style='color:#b91c1c;font-weight:600'>Chưa upload ảnh</span>", unsafe_allow_html=True)
+        else:
+            # Hỗ trợ nhiều ảnh (mảng JSON, dữ liệu cũ phân tách bằng ';')
+            show_image_urls(parse_image_urls(row.get('image_url')), width=200)
+        
+        edit_key = f'edit_shipment_{row["id"]}'
+        is_editing = st.session_state.get(edit_key, False)
+        
+        if st.button("✏️ Chỉnh sửa" if not is_editing else "❌ Hủy", key=f"btn_edit_{row['id']}"):
+            st.session_state[edit_key] = not is_editing
+            st.rerun(scope="fragment")
+    
+    # Edit form
+    if st.session_state.get(edit_key, False):
+        st.divider()
+        st.write("### ✏️ Chỉnh Sửa Phiếu")
+        
+        with st.form(f"edit_shipment_form_{row['id']}"):
+            col_form1, col_form2 = st.columns(2)
+            
+            with col_form1:
+                edit_qr_code = st.text_input("Mã QR Code:", value=row['qr_code'], key=f"edit_qr_{row['id']}")
+                edit_imei = st.text_input("IMEI:", value=row['imei'], key=f"edit_imei_{row['id']}")
+                edit_device_name = st.text_input("Tên thiết bị:", value=row['device_name'], key=f"edit_device_{row['id']}")
+                edit_capacity = st.text_input("Lỗi / Tình trạng:", value=row['capacity'], key=f"edit_capacity_{row['id']}")
+            
+            with col_form2:
+                current_supplier_idx = 0
+                if row['supplier'] in supplier_names:
+                    current_supplier_idx = supplier_names.index(row['supplier'])
+                
+                edit_supplier = st.selectbox(
+                    "Nhà cung cấp:",
+                    supplier_names,
+                    index=current_supplier_idx,
+                    key=f"edit_supplier_{row['id']}"
+                )
+                
+                current_status_idx = 0
+                if row['status'] in status_options:
+                    current_status_idx = status_options.index(row['status'])
+                
+                edit_status = st.selectbox(
+                    "Trạng thái:",
+                    status_options,
+                    index=current_status_idx,
+                    key=f"edit_status_{row['id']}"
+                )
+                
+                # Loại yêu cầu
+                current_request_type = row.get('request_type', REQUEST_TYPES[0] if REQUEST_TYPES else '')
+                request_type_idx = 0
+                if current_request_type in REQUEST_TYPES:
+                    request_type_idx = REQUEST_TYPES.index(current_request_type)
+                edit_request_type = st.selectbox(
+                    "Loại yêu cầu:",
+                    REQUEST_TYPES,
+                    index=request_type_idx,
+                    key=f"edit_request_type_{row['id']}"
+                )
+                
+                edit_store_name = st.text_input(
+                    "Cửa hàng:",
+                    value=row['store_name'],
+                    key=f"edit_store_{row['id']}",
+                    help="Tên cửa hàng (nếu có)"
+                )
+                
+                edit_notes = st.text_area("Ghi chú:", value=row['notes'], key=f"edit_notes_{row['id']}")
+                uploaded_image = st.file_uploader("Upload ảnh (tùy chọn, chọn nhiều)", type=["png", "jpg", "jpeg"], accept_multiple_files=True, key=f"upload_image_{row['id']}")
+            
+            col_submit1, col_submit2 = st.columns(2)
+            with col_submit1:
+                if st.form_submit_button("💾 Lưu thay đổi", type="primary"):
+                    current_user = get_current_user()
+
+                    image_url = row.get('image_url') or None
+                    if uploaded_image:
+                        urls = upload_images_or_stop(uploaded_image, edit_qr_code, edit_status, "unknown")
+                        if urls:
+                            image_url = encode_image_urls(urls)
+
+                    result = update_shipment(
+                        shipment_id=row['id'],
+                        qr_code=edit_qr_code.strip(),
+                        imei=edit_imei.strip(),
+                        device_name=edit_device_name.strip(),
+                        capacity=edit_capacity.strip(),
+                        supplier=edit_supplier,
+                        status=edit_status,
+                        notes=edit_notes.strip() if edit_notes.strip() else None,
+                        updated_by=current_user,
+                        image_url=image_url,
+                        store_name=edit_store_name.strip() if edit_store_name.strip() else None,
+                        request_type=edit_request_type
+                    )
+                    
+                    if result['success']:
+                        st.success("✅ Đã cập nhật thành công!")
+                        # Notify Telegram (nền) if status is one of: Đã nhận, Chuyển kho, Gửi NCC sửa, Chuyển cửa hàng
+                        if edit_status in ['Đã nhận', 'Chuyển kho', 'Gửi NCC sửa', 'Chuyển cửa hàng']:
+                            submit_telegram_notify(
+                                row['id'],
+                                is_update_image=bool(uploaded_image),
+                                force=not row.get('telegram_message_id'),
+                                error_key='last_telegram_error'
+                            )
+                        edit_key = f'edit_shipment_{row["id"]}'
+                        if edit_key in st.session_state:
+                            del st.session_state[edit_key]
+                        st.rerun()
+                    else:
+                        st.error(f"❌ {result['error']}")
+            
+            with col_submit2:
+                if st.form_submit_button("❌ Hủy"):
+                    edit_key = f'edit_shipment_{row["id"]}'
+                    if edit_key in st.session_state:
+                        del st.session_state[edit_key]
+                    st.rerun(scope="fragment")
+    
+        st.divider()
+
+
 def show_manage_shipments():
     """Show screen to manage all shipments with edit functionality"""
     ensure_label_defaults()
     st.header("📋 Quản Lý Phiếu Gửi Hàng")
     current_user = get_current_user()
+    # Tra cứu tài khoản cửa hàng một lần cho cả màn hình
+    store_user, ctx_store_name = get_store_context()
+    # Lỗi gửi Telegram của lần lưu gần nhất: giữ ở đầu màn hình đến khi người dùng đóng
+    last_telegram_error = st.session_state.get('last_telegram_error')
+    if last_telegram_error:
+        col_err, col_close = st.columns([5, 1])
+        with col_err:
+            st.warning(f"⚠️ Đã lưu phiếu nhưng gửi Telegram lỗi: {last_telegram_error}")
+        with col_close:
+            if st.button("Đóng", key="dismiss_last_telegram_error"):
+                st.session_state.pop('last_telegram_error', None)
+                st.rerun()
+    # Kết quả gửi Telegram nền sau khi lưu form chỉnh sửa (chỉ gắn fragment khi đang có tin chờ gửi)
+    show_telegram_results()
+    if st.session_state.get('telegram_futs'):
+        render_telegram_status()
     
     # Quick actions
     with st.expander("➕ Tạo phiếu (nhập tay)", expanded=False):
@@ -1359,10 +2084,9 @@ def show_manage_shipments():
             uploaded_image_manual = st.file_uploader("Upload ảnh (tùy chọn, chọn nhiều)", type=["png", "jpg", "jpeg"], accept_multiple_files=True, key="upload_image_manual")
             
             # Trường cửa hàng
-            store_user = is_store_user()
             store_name = None
             if store_user:
-                store_name = get_store_name_from_username(current_user)
+                store_name = ctx_store_name
                 store_input = st.text_input("Cửa hàng:", value=store_name, disabled=True)
             else:
                 store_input = st.text_input("Cửa hàng (nếu có):", value="")
@@ -1386,37 +2110,17 @@ def show_manage_shipments():
                 else:
                     image_url = None
                     if uploaded_image_manual:
-                        urls = []
                         current_status = 'Đã nhận'  # Default status for new shipments
-                        sanitized_qr = qr.strip().replace(" ", "_").replace("/", "_") or "qr_image"
-                        sanitized_status = current_status.replace(" ", "_").replace("/", "_")
-                        for idx, f in enumerate(uploaded_image_manual, start=1):
-                            file_bytes = f.getvalue()
-                            mime = f.type or "image/jpeg"
-                            orig_name = f.name or "image.jpg"
-                            ext = ""
-                            if "." in orig_name:
-                                ext = orig_name.split(".")[-1]
-                            if not ext:
-                                ext = "jpg"
-                            # Tên file: mã QR + trạng thái + stt
-                            drive_filename = f"{sanitized_qr}_{sanitized_status}_{idx}.{ext}"
-                            upload_res = upload_file_to_drive(file_bytes, drive_filename, mime)
-                            if upload_res['success']:
-                                urls.append(upload_res['url'])
-                                st.success(f"✅ Upload ảnh {idx} thành công: {upload_res['url'][:50]}...")
-                            else:
-                                st.error(f"❌ Upload ảnh {idx} thất bại: {upload_res['error']}")
-                                st.stop()
+                        urls = upload_images_or_stop(uploaded_image_manual, qr, current_status, show_success=True)
                         if urls:
-                            image_url = ";".join(urls)
+                            image_url = encode_image_urls(urls)
 
                     # Tài khoản cửa hàng: mặc định Đã nhận
                     default_status = 'Đã nhận'
                     # Tự động set nơi tiếp nhận = store_name của user
                     reception_location = store_name if store_name else None
                     if not reception_location and store_user:
-                        reception_location = get_store_name_from_username(current_user)
+                        reception_location = ctx_store_name
                     
                     res = save_shipment(
                         qr.strip(), imei.strip(), device_name.strip(), capacity.strip(), 
@@ -1444,61 +2148,41 @@ def show_manage_shipments():
         if uploaded_file is not None:
             if st.button("Xử lý file", type="primary", key="bulk_process"):
                 try:
-                    df = pd.read_excel(uploaded_file, header=None)
-                    # Column indices: B=1, Z=25, AF=31, AI=34 (0-based). Bỏ dòng 0 (header)
-                    if df.shape[0] > 0:
-                        df = df.iloc[1:]
-                    needed_cols = {1: 'qr_code', 25: 'device_name', 31: 'imei', 34: 'capacity'}
-                    missing_cols = [c for c in needed_cols if c >= df.shape[1]]
-                    if missing_cols:
+                    df = read_bulk_excel(uploaded_file)
+                    if df is None:
                         st.error("File không đủ cột cần thiết (B,Z,AF,AI).")
                     else:
-                        df = df[list(needed_cols.keys())]
-                        df.rename(columns=needed_cols, inplace=True)
-                        success, fail = 0, 0
-                        errors = []
-                        for idx, row in df.iterrows():
-                            qr_val = str(row.get('qr_code') or '').strip()
-                            imei_val = str(row.get('imei') or '').strip()
-                            device_val = str(row.get('device_name') or '').strip()
-                            cap_val = str(row.get('capacity') or '').strip()
-                            if not qr_val:
-                                fail += 1
-                                errors.append(f"Dòng {idx+1}: thiếu Mã QR")
-                                continue
-                            if not imei_val or not device_val or not cap_val:
-                                fail += 1
-                                errors.append(f"Dòng {idx+1}: thiếu IMEI/Tên/Lỗi-Tình trạng")
-                                continue
-                            # Xác định store_name nếu là user cửa hàng
-                            store_user = is_store_user()
-                            store_name = None
-                            if store_user:
-                                store_name = get_store_name_from_username(current_user)
-                            
-                            # Tự động set nơi tiếp nhận = store_name của user
-                            reception_location = store_name if store_name else None
-                            if not reception_location and store_user:
-                                reception_location = get_store_name_from_username(current_user)
-                            
-                            res = save_shipment(
-                                qr_code=qr_val,
-                                imei=imei_val,
-                                device_name=device_val,
-                                capacity=cap_val,
-                                supplier="Chưa chọn",
-                                created_by=current_user,
-                                notes=None,
-                                status="Đã nhận",
-                                store_name=store_name,
-                                request_type=bulk_request_type,
-                                reception_location=reception_location
-                            )
-                            if res['success']:
-                                success += 1
-                            else:
-                                fail += 1
-                                errors.append(f"Dòng {idx+1}: {res['error']}")
+                        # Kiểm tra dữ liệu theo cột (vectorized) thay vì từng dòng
+                        df, row_errors = validate_bulk_rows(df)
+                        # Kiểm tra trùng mã QR bằng một truy vấn IN cho cả file
+                        existing = existing_qr_codes(df.loc[row_errors.isna(), 'qr_code'].tolist())
+                        if existing:
+                            dup_mask = (row_errors.isna() & df['qr_code'].isin(list(existing))).to_numpy(dtype=bool)
+                            row_errors.loc[df.index[dup_mask]] = "Mã QR đã tồn tại"
+                        invalid = row_errors.notna()
+                        valid_df = df[~invalid]
+                        
+                        # Xác định store_name nếu là user cửa hàng
+                        # Tự động set nơi tiếp nhận = store_name của user
+                        store_name = ctx_store_name
+                        reception_location = store_name if store_name else None
+                        res = save_shipments_bulk(
+                            valid_df.to_dict('records'),
+                            created_by=current_user,
+                            status="Đã nhận",
+                            store_name=store_name,
+                            request_type=bulk_request_type,
+                            reception_location=reception_location
+                        )
+                        if res['success']:
+                            # Mã QR không được thêm (đã tồn tại hoặc lặp lại trong file)
+                            not_inserted = (~valid_df['qr_code'].isin(list(res['ids'])) | valid_df['qr_code'].duplicated()).to_numpy(dtype=bool)
+                            row_errors.loc[valid_df.index[not_inserted]] = "Mã QR đã tồn tại"
+                        else:
+                            row_errors.loc[valid_df.index] = res['error']
+                        failed = row_errors.dropna()
+                        success, fail = len(df) - len(failed), len(failed)
+                        errors = [f"Dòng {idx+1}: {msg}" for idx, msg in failed.items()]
                         st.success(f"Đã tạo {success} phiếu. Lỗi: {fail}.")
                         if errors:
                             with st.expander("Chi tiết lỗi", expanded=False):
@@ -1508,7 +2192,8 @@ def show_manage_shipments():
                     st.error(f"Lỗi đọc file: {e}")
 
     # Get all shipments
-    df = get_all_shipments()
+    data_version = get_data_version()
+    df = _get_all_shipments_versioned(data_version)
     
     if df.empty:
         st.info("📭 Chưa có phiếu gửi hàng nào")
@@ -1517,23 +2202,16 @@ def show_manage_shipments():
     # In-tem expander (giống như Tạo nhiều phiếu từ Excel)
     with st.expander("🖨️ In tem (chọn phiếu)", expanded=False):
         st.caption("Tìm kiếm theo mã QR/thiết bị/IMEI, chọn nhiều phiếu, sau đó bấm In.")
-        all_options = df.apply(
-            lambda r: {
-                "id": r['id'],
-                "label": f"{r['qr_code']} | {r['device_name']} | {r['imei']}"
-            },
-            axis=1
-        ).tolist()
+        # Nhãn tìm kiếm được cache theo phiên bản DB, không dựng lại mỗi lần gõ phím
+        label_corpus = _get_label_corpus(data_version)
 
         search_term = st.text_input("Tìm mã QR / thiết bị / IMEI", key="label_search_term")
         if search_term:
             term = search_term.lower().strip()
-            filtered_opts = [o for o in all_options if term in o['label'].lower()]
-        else:
-            filtered_opts = all_options
+            label_corpus = label_corpus[label_corpus['label_lower'].str.contains(term, regex=False, na=False)]
 
-        option_labels = [o['label'] for o in filtered_opts]
-        option_ids = [o['id'] for o in filtered_opts]
+        option_labels = label_corpus['label'].tolist()
+        label_to_id = dict(zip(option_labels, label_corpus['id'].tolist()))
 
         selected_labels = st.multiselect(
             "Chọn phiếu:",
@@ -1544,13 +2222,13 @@ def show_manage_shipments():
 
         # Persist selection
         st.session_state['label_picker_selected'] = selected_labels
-        selected_ids = [option_ids[option_labels.index(lbl)] for lbl in selected_labels] if selected_labels else []
+        selected_ids = [label_to_id[lbl] for lbl in selected_labels if lbl in label_to_id]
 
         st.write(f"Đã chọn: {len(selected_ids)} phiếu")
         col_lp1, col_lp2 = st.columns([1, 3])
         with col_lp1:
             if st.button("🖨️ In các phiếu đã chọn", key="label_picker_print", use_container_width=True):
-                selected_shipments = df[df['id'].isin(selected_ids)].to_dict(orient='records')
+                selected_shipments = df.loc[[i for i in selected_ids if i in df.index]].to_dict(orient='records')
                 if selected_shipments:
                     st.success(f"Đang chuẩn bị {len(selected_shipments)} tem...")
                     render_labels_bulk(selected_shipments)
@@ -1582,230 +2260,484 @@ def show_manage_shipments():
     with col3:
             search_qr = st.text_input("Mã QR:", key="search_qr")
     
-    # Apply filters
-    filtered_df = df[
-        (df['status'].isin(filter_status)) &
-        (df['supplier'].isin(filter_supplier))
-    ]
+    # Apply filters (bỏ qua isin khi đang chọn tất cả - trường hợp thường gặp nhất).
+    # Trạng thái ngoài STATUS_VALUES (vd. "Gửi <NCC>") vẫn bị ẩn như trước, nên chỉ bỏ qua
+    # khi mọi trạng thái có trong dữ liệu đều thuộc STATUS_VALUES.
+    filtered_df = df
+    status_values_in_df = set(df['status'].cat.categories) if isinstance(df['status'].dtype, pd.CategoricalDtype) else set(df['status'].unique())
+    if set(filter_status) != set(STATUS_VALUES) or not status_values_in_df <= set(STATUS_VALUES):
+        filtered_df = filtered_df[filtered_df['status'].isin(filter_status)]
+    if set(filter_supplier) != set(suppliers_list):
+        filtered_df = filtered_df[filtered_df['supplier'].isin(filter_supplier)]
+    
+    qr_term = search_qr.strip().lower()
+    if qr_term:
+        filtered_df = filtered_df[filtered_df['qr_code_lower'].str.contains(qr_term, regex=False, na=False)]
+    
+    # Display shipments
+    st.subheader(f"Tổng số: {len(filtered_df)} phiếu")
+    
+    # NCC và danh sách trạng thái (gồm "Gửi + tên NCC") dùng chung cho form chỉnh sửa của mọi dòng
+    supplier_names = _get_suppliers_cached()['name'].tolist()
+    status_options = build_status_options(supplier_names)
+    
+    # Chỉ render đầy đủ (ảnh Drive, tem, form sửa) cho một phiếu đang mở; các phiếu khác chỉ hiện tóm tắt
+    # Xác định vị trí phiếu đang mở một lần qua index id thay vì so sánh từng dòng
+    open_row_id = st.session_state.get('manage_open_row_id')
+    open_pos = filtered_df.index.get_loc(open_row_id) if open_row_id in filtered_df.index else -1
+    
+    for pos, row in enumerate(filtered_df.to_dict('records')):
+        if pos == open_pos:
+            render_shipment_detail(row, supplier_names, status_options)
+            continue
+        with st.expander(f"{row['qr_code']} - {row['device_name']} ({row['status']})", expanded=False):
+            st.caption(f"IMEI: {row['imei']} | NCC: {row['supplier']} | Gửi: {row['sent_time']}")
+            if st.button("📂 Xem chi tiết", key=f"open_row_{row['id']}"):
+                st.session_state['manage_open_row_id'] = row['id']
+                st.rerun()
+
+
+# Thẻ "Thông tin cơ bản" của phiếu (Dashboard, kết quả tìm kiếm, KT kho)
+# fields: [(nhãn, giá trị, font-weight, màu chữ)]
+BASIC_INFO_CARD_TEMPLATE = (
+    '<div style="background:#f8f9fa;padding:16px;border-radius:8px;margin-bottom:16px;border:1px solid #e5e7eb">'
+    '<div style="display:grid;grid-template-columns:repeat({{ columns }},1fr);gap:16px;align-items:center">'
+    '{% for label, value, weight, color in fields %}'
+    '<div><div style="font-size:0.875rem;color:#6b7280;margin-bottom:4px">{{ label }}</div>'
+    '<div style="font-size:1rem;font-weight:{{ weight }};color:{{ color }}">{{ value }}</div></div>'
+    '{% endfor %}'
+    '</div></div>'
+)
+_BASIC_INFO_CARD = JINJA_ENV.from_string(BASIC_INFO_CARD_TEMPLATE) if JINJA_ENV else None
+
+
+def basic_info_card_html(fields, columns=5):
+    """HTML thẻ thông tin cơ bản; giá trị được escape bởi Jinja2 (hoặc html.escape nếu thiếu jinja2)."""
+    if _BASIC_INFO_CARD is not None:
+        return _BASIC_INFO_CARD.render(fields=fields, columns=columns)
+    cells = ''.join(
+        f'<div><div style="font-size:0.875rem;color:#6b7280;margin-bottom:4px">{html.escape(label)}</div>'
+        f'<div style="font-size:1rem;font-weight:{weight};color:{color}">{html.escape(str(value))}</div></div>'
+        for label, value, weight, color in fields
+    )
+    return (
+        '<div style="background:#f8f9fa;padding:16px;border-radius:8px;margin-bottom:16px;border:1px solid #e5e7eb">'
+        f'<div style="display:grid;grid-template-columns:repeat({columns},1fr);gap:16px;align-items:center">'
+        f'{cells}</div></div>'
+    )
+
+
+# "Người sửa" ở góc phải tab Thông tin của phiếu trên Dashboard
+REPAIRER_BADGE_HTML = (
+    '<div style="text-align:right;font-weight:600;font-size:14px;color:#333;margin-top:0">'
+    '👤 Người sửa: <span style="font-size:16px">{repairer}</span>'
+    '</div>'
+)
+
+
+# Một ghi chú trong lịch sử ghi chú (dạng chat) ở chi tiết phiếu trên Dashboard
+NOTE_BUBBLE_HTML = (
+    '<div style="background-color:#f8f9fa;padding:8px 12px;border-radius:8px;margin-bottom:8px;border-left:3px solid #1f77b4">'
+    '<div style="display:flex;justify-content:space-between;align-items:center;margin-bottom:4px">'
+    '<span style="font-weight:600;color:#1f77b4;font-size:12px">{created_by}</span>'
+    '<span style="color:#999;font-size:10px">{time_str}</span>'
+    '</div>'
+    '<div style="color:#333;font-size:13px;white-space:pre-wrap;word-wrap:break-word;line-height:1.4">{note_text}</div>'
+    '</div>'
+)
+
+
+@_fragment()
+def render_dashboard_shipment(shipment, time_str, sent_str, update_status_options):
+    """
+    Một phiếu trong danh sách Dashboard (thẻ thông tin, tab Thông tin / Cập nhật).
+    Chạy dạng fragment: nhập ghi chú, chọn trạng thái, chọn ảnh chỉ chạy lại phiếu này,
+    không lọc/phân trang lại cả Dashboard. Lưu thành công vẫn rerun toàn trang.
+    - time_str / sent_str: thời gian đã định dạng sẵn cho cả trang
+    - update_status_options: danh sách trạng thái dựng một lần cho cả trang
+    """
+    shipment_id = shipment['id']
+    
+    # Lấy thông tin cơ bản
+    qr_code = str(shipment.get('qr_code', ''))
+    imei = str(shipment.get('imei', 'Chưa có'))
+    status = str(shipment.get('status', ''))
+    
+    # Nơi tiếp nhận (reception_location hoặc store_name)
+    reception_location = shipment.get('reception_location') or shipment.get('store_name') or 'Chưa có'
+    
+    # Tạo label cho expander với thông tin cơ bản (thêm IMEI)
+    expander_label = f"📋 {qr_code} | IMEI: {imei} | {time_str} | {status}"
+    
+    # Tạo expander cho mỗi phiếu với thông tin cơ bản
+    with st.expander(
+        expander_label,
+        expanded=(st.session_state.get('dashboard_detail_id') == shipment_id)
+    ):
+        # Hiển thị thông tin cơ bản: Mã yêu cầu, Thời gian, Nơi tiếp nhận, Trạng thái
+        st.markdown("### Thông tin cơ bản")
+    
+        # Hiển thị dạng bảng đẹp (thêm IMEI)
+        basic_info_html = basic_info_card_html([
+            ('Mã yêu cầu', qr_code, 700, '#111827'),
+            ('IMEI', imei, 700, '#059669'),
+            ('Thời gian', time_str, 600, '#111827'),
+            ('Nơi tiếp nhận', reception_location, 600, '#111827'),
+            ('Trạng thái', status, 700, '#3b82f6'),
+        ])
+        st.markdown(basic_info_html, unsafe_allow_html=True)
+    
+        st.divider()
+    
+        # Tab thông tin
+        tab1, tab2 = st.tabs(["📋 Thông tin", "✏️ Cập nhật"])
+    
+        with tab1:
+            # Hiển thị người sửa ở góc trên phải nếu có
+            if shipment.get('repairer'):
+                col_repairer_left, col_repairer_right = st.columns([1, 1])
+                with col_repairer_left:
+                    st.write("**Thông tin chi tiết:**")
+                with col_repairer_right:
+                    st.markdown(
+                        REPAIRER_BADGE_HTML.format(repairer=html.escape(str(shipment.get('repairer')))),
+                        unsafe_allow_html=True
+                    )
+            else:
+                st.write("**Thông tin chi tiết:**")
+    
+            # Hàng 1: Mã yêu cầu | IMEI
+            col_row1_1, col_row1_2 = st.columns(2)
+            with col_row1_1:
+                st.write(f"**Mã yêu cầu:** {shipment.get('qr_code', '')}")
+            with col_row1_2:
+                st.write(f"**IMEI:** {shipment.get('imei', 'Chưa có')}")
+    
+            # Hàng 2: Thời gian | Ngày cập nhật
+            col_row2_1, col_row2_2 = st.columns(2)
+            with col_row2_1:
+                st.write(f"**Thời gian:** {sent_str}")
+            with col_row2_2:
+                update_date = shipment.get('last_updated', '')[:16] if shipment.get('last_updated') else 'Chưa có'
+                st.write(f"**Ngày cập nhật:** {update_date}")
+    
+            # Hàng 3: Người nhận | Nơi tiếp nhận
+            col_row3_1, col_row3_2 = st.columns(2)
+            with col_row3_1:
+                st.write(f"**Người nhận:** {shipment.get('created_by', '')}")
+            with col_row3_2:
+                reception_location_display = shipment.get('reception_location') or shipment.get('store_name') or 'Chưa có'
+                st.write(f"**Nơi tiếp nhận:** {reception_location_display}")
+    
+            # Hàng 4: Trạng thái
+            st.write(f"**Trạng thái:** {shipment.get('status', '')}")
+    
+            st.divider()
+    
+            # Ghi chú - Chat box style
+            st.write("**Ghi chú:**")
+    
+            # Lấy lịch sử ghi chú
+            notes_history = get_notes_history(shipment_id)
+    
+            # Container cho chat box - nhỏ gọn
+            chat_container = st.container()
+            with chat_container:
+                if not notes_history.empty:
+                    # Hiển thị ghi chú như chat message: gom tất cả ghi chú vào một list rồi ''.join, render bằng một st.markdown
+                    # Escape theo cột (một lượt cho mỗi cột) trước khi ghép template
+                    note_times = format_time_column(notes_history['created_at']).fillna(notes_history['created_at'].astype(str))
+                    escaped = notes_history[['created_by', 'note_text']].astype(str).map(html.escape)
+                    note_parts = [
+                        NOTE_BUBBLE_HTML.format(created_by=created_by, time_str=time_str, note_text=note_text)
+                        for created_by, time_str, note_text in zip(
+                            escaped['created_by'].tolist(),
+                            note_times.map(html.escape).tolist(),
+                            escaped['note_text'].tolist()
+                        )
+                    ]
+                    st.markdown(''.join(note_parts), unsafe_allow_html=True)
+                else:
+                    # Nếu chưa có ghi chú, hiển thị ghi chú cũ (nếu có) hoặc thông báo
+                    old_notes = shipment.get('notes', '') or ''
+                    if old_notes:
+                        # Migrate ghi chú cũ vào history
+                        current_user = get_current_user()
+                        add_note_to_history(shipment_id, old_notes, current_user or shipment.get('created_by', 'System'))
+                        st.rerun()
+                    else:
+                        st.info("💬 Chưa có ghi chú nào. Hãy thêm ghi chú đầu tiên!")
+    
+            st.divider()
+    
+            # Hiển thị quá trình cập nhật phiếu (Audit Log) với expander để có thể thu gọn
+            # Lọc log theo shipment_id ngay trong SQL
+            shipment_logs = get_audit_log(limit=1000, shipment_id=shipment_id)
+    
+            if not shipment_logs.empty:
+                # Đã sắp xếp mới nhất trước trong SQL (ORDER BY timestamp DESC)
+                # Đếm số lượng log entries
+                log_count = len(shipment_logs)
+    
+                # Tạo expander với số lượng log
+                with st.expander(f"📋 Quá trình cập nhật phiếu ({log_count} cập nhật)", expanded=False):
+                    # Hiển thị từng log entry
+                    for idx, log_row in shipment_logs.iterrows():
+                        action = log_row.get('action', '')
+                        old_value = log_row.get('old_value', '')
+                        new_value = log_row.get('new_value', '')
+                        changed_by = log_row.get('changed_by', '')
+                        timestamp = log_row.get('timestamp', '')
+    
+                        # Format timestamp
+                        try:
+                            time_display = pd.to_datetime(timestamp).strftime('%d/%m/%Y %H:%M:%S')
+                        except:
+                            time_display = str(timestamp)[:19] if timestamp else 'N/A'
+    
+                        # Tạo icon và màu sắc theo action - Hiển thị bằng tiếng Việt và chi tiết
+                        if action == 'CREATED':
+                            icon = "🆕"
+                            color = "#10b981"  # Green
+                            action_text = "Tạo phiếu"
+                            # Hiển thị chi tiết thông tin phiếu được tạo
+                            change_text = new_value if new_value else f"Phiếu được tạo bởi **{changed_by}**"
+                        elif action == 'STATUS_CHANGED':
+                            icon = "🔄"
+                            color = "#3b82f6"  # Blue
+                            action_text = "Thay đổi trạng thái"
+                            # Hiển thị rõ ràng trạng thái cũ và mới
+                            if old_value and new_value:
+                                change_text = f"Trạng thái: **{old_value}** → **{new_value}**"
+                            elif new_value:
+                                change_text = f"Trạng thái mới: **{new_value}**"
+                            else:
+                                change_text = "Trạng thái đã được thay đổi"
+                        elif action == 'UPDATED':
+                            icon = "✏️"
+                            color = "#f59e0b"  # Orange
+                            action_text = "Cập nhật thông tin"
+                            # Hiển thị chi tiết những gì đã cập nhật
+                            if new_value:
+                                # new_value chứa thông tin chi tiết về các trường đã thay đổi
+                                change_text = new_value
+                            else:
+                                change_text = "Thông tin phiếu đã được cập nhật"
+                        else:
+                            icon = "📝"
+                            color = "#6b7280"  # Gray
+                            action_text = "Thay đổi"
+                            change_text = f"{old_value} → {new_value}" if old_value and new_value else (new_value or old_value or "Đã cập nhật")
+    
+                        # Hiển thị log entry với styling
+                        log_html = f"""
+                        <div style="background: #f8f9fa; padding: 12px; border-radius: 8px; margin-bottom: 8px; border-left: 4px solid {color};">
+                            <div style="display: flex; justify-content: space-between; align-items: start; margin-bottom: 4px;">
+                                <div style="font-weight: 600; color: {color};">
+                                    {icon} {action_text}
+                                </div>
+                                <div style="font-size: 0.875rem; color: #6b7280;">
+                                    {time_display}
+                                </div>
+                            </div>
+                            <div style="color: #374151; margin-top: 4px;">
+                                {change_text}
+                            </div>
+                            <div style="font-size: 0.875rem; color: #6b7280; margin-top: 4px;">
+                                👤 Người thực hiện: <strong>{changed_by}</strong>
+                            </div>
+                        </div>
+                        """
+                        st.markdown(log_html, unsafe_allow_html=True)
+            else:
+                st.info("📭 Chưa có lịch sử cập nhật nào cho phiếu này")
+    
+            st.divider()
+    
+            # Hiển thị ảnh nếu có
+            if shipment.get('image_url'):
+                st.markdown("### Ảnh đính kèm")
+                show_image_urls(parse_image_urls(shipment.get('image_url')), width=200)
+    
+            # Hiển thị thông tin các trường mới theo sơ đồ
+            st.divider()
+            st.markdown("### 📊 Thông tin chi tiết theo sơ đồ")
+    
+            col_detail1, col_detail2 = st.columns(2)
+    
+            with col_detail1:
+                st.markdown("**Thông tin tiếp nhận:**")
+                if shipment.get('device_status_on_reception'):
+                    st.write(f"• Tình trạng thiết bị lúc nhận: {shipment.get('device_status_on_reception')}")
+                if shipment.get('quotation_notes'):
+                    st.write(f"• Ghi chú báo giá: {shipment.get('quotation_notes')}")
+                if shipment.get('notes'):
+                    st.write(f"• Ghi chú nhận máy: {shipment.get('notes')}")
+    
+            with col_detail2:
+                st.markdown("**Thông tin sửa chữa:**")
+                if shipment.get('repairer'):
+                    st.write(f"• 👤 Người sửa: **{shipment.get('repairer')}**")
+                if shipment.get('repair_start_date'):
+                    try:
+                        repair_start = pd.to_datetime(shipment.get('repair_start_date')).strftime('%d/%m/%Y %H:%M')
+                        st.write(f"• Ngày bắt đầu sửa: {repair_start}")
+                    except:
+                        st.write(f"• Ngày bắt đầu sửa: {shipment.get('repair_start_date')}")
+                if shipment.get('repair_completion_date'):
+                    try:
+                        repair_end = pd.to_datetime(shipment.get('repair_completion_date')).strftime('%d/%m/%Y %H:%M')
+                        st.write(f"• Ngày hoàn thành sửa: {repair_end}")
+                    except:
+                        st.write(f"• Ngày hoàn thành sửa: {shipment.get('repair_completion_date')}")
+                if shipment.get('repair_notes'):
+                    st.write(f"• Ghi chú sửa máy: {shipment.get('repair_notes')}")
+    
+            if shipment.get('quality_check_notes'):
+                st.markdown("**Kiểm tra chất lượng:**")
+                st.write(f"• Ghi chú kiểm tra: {shipment.get('quality_check_notes')}")
+    
+            if shipment.get('ycsc_completion_date'):
+                st.markdown("**Hoàn thành YCSC:**")
+                try:
+                    ycsc_complete = pd.to_datetime(shipment.get('ycsc_completion_date')).strftime('%d/%m/%Y %H:%M')
+                    st.write(f"• Ngày hoàn thành YCSC: {ycsc_complete}")
+                except:
+                    st.write(f"• Ngày hoàn thành YCSC: {shipment.get('ycsc_completion_date')}")
+    
+            if shipment.get('repair_image_url'):
+                st.markdown("**Hình ảnh sửa máy:**")
+                show_image_urls(parse_image_urls(shipment.get('repair_image_url')), width=200, caption_prefix="Ảnh sửa")
+    
+        with tab2:
+            st.markdown("### Cập nhật phiếu")
+    
+            current_status = shipment.get('status', '')
+    
+            # Kiểm tra: Nếu đã hoàn thành YCSC và không phải admin thì không cho cập nhật
+            if current_status == "Hoàn thành YCSC" and not is_admin():
+                st.warning("⚠️ Phiếu này đã hoàn thành YCSC. Chỉ Admin mới có thể chỉnh sửa.")
+                st.info("📋 Bạn chỉ có thể xem thông tin phiếu này.")
+            else:
+                # Danh sách trạng thái động (dựng một lần cho cả trang)
+                status_options = update_status_options
+    
+                current_status_idx = 0
+                if current_status in status_options:
+                    current_status_idx = status_options.index(current_status)
+    
+                col_update1, col_update2 = st.columns([2, 1])
+    
+                with col_update1:
+                    new_status = st.selectbox(
+                    "Trạng thái mới:",
+                    status_options,
+                    index=current_status_idx,
+                    key=f"update_status_{shipment_id}"
+                )
+    
+                    # Hiển thị selectbox "Người sửa" khi chọn "Đang sửa chữa"
+                    repairer_value = None
+                    if new_status == "Đang sửa chữa":
+                        current_user_for_repairer = get_current_user()
+                        users_df = get_all_users_cached()
+                        user_list = users_df['username'].to_numpy().tolist() if not users_df.empty else [current_user_for_repairer]
+                        current_repairer = shipment.get('repairer', current_user_for_repairer)
+                        if current_user_for_repairer not in user_list:
+                            user_list.insert(0, current_user_for_repairer)
     
-    if search_qr:
-        filtered_df = filtered_df[filtered_df['qr_code'].str.contains(search_qr, case=False, na=False)]
+                        repairer_idx = user_list.index(current_repairer) if current_repairer in user_list else user_list.index(current_user_for_repairer) if current_user_for_repairer in user_list else 0
     
-    # Display shipments
-    st.subheader(f"Tổng số: {len(filtered_df)} phiếu")
+                        repairer_value = st.selectbox(
+                            "Người sửa:",
+                            user_list,
+                            index=repairer_idx,
+                            key=f"repairer_select_{shipment_id}"
+                        )
     
-    for idx, row in filtered_df.iterrows():
-        with st.expander(f"{row['qr_code']} - {row['device_name']} ({row['status']})", expanded=False):
-            col1, col2 = st.columns([2, 1])
-            
-            with col1:
-                st.write("**Thông tin phiếu:**")
-            info_col1, info_col2 = st.columns(2)
-            
-            with info_col1:
-                st.write(f"**Mã QR:** {row['qr_code']}")
-                st.write(f"**IMEI:** {row['imei']}")
-                st.write(f"**Tên thiết bị:** {row['device_name']}")
-                st.write(f"**Lỗi / Tình trạng:** {row['capacity']}")
-            
-            with info_col2:
-                st.write(f"**NCC:** {row['supplier']}")
-                st.write(f"**Trạng thái:** {row['status']}")
-                if pd.notna(row.get('store_name')) and row.get('store_name'):
-                    st.write(f"**Cửa hàng:** {row['store_name']}")
-                st.write(f"**Thời gian gửi:** {row['sent_time']}")
-                if pd.notna(row['received_time']):
-                    st.write(f"**Thời gian nhận:** {row['received_time']}")
-                if pd.notna(row.get('last_updated')) and row.get('last_updated'):
-                    st.write(f"**Cập nhật lúc:** {row['last_updated']}")
-                st.write(f"**Người tạo:** {row['created_by']}")
-                if pd.notna(row['updated_by']):
-                    st.write(f"**Người cập nhật:** {row['updated_by']}")
-            
-            if pd.notna(row['notes']) and row['notes']:
-                st.write(f"**Ghi chú:** {row['notes']}")
-
-            # Print label button
-            print_btn_key = f"print_label_{row['id']}"
-            if st.button("🖨️ In tem QR", key=print_btn_key):
-                st.session_state['label_preview_id'] = row['id']
-            if st.session_state.get('label_preview_id') == row['id']:
-                st.info("Xem trước tem. Bấm 'In tem' trong khung để in (chọn máy in/bkhổ giấy trong hộp thoại).")
-                render_label_component(row)
-            
-        with col2:
-            # Loại yêu cầu - hiển thị to rõ ở góc bên phải
-            request_type = row.get('request_type', 'Chưa xác định')
-            st.markdown(f"""
-                <div style="
-                margin-bottom: 1rem;
-            ">
-                <div style="font-size: 0.875rem; color: #6b7280; margin-bottom: 0.25rem;">Loại yêu cầu</div>
-                <div style="font-size: 1.125rem; font-weight: 700; color: #3b82f6;">{request_type}</div>
-            </div>
-            """, unsafe_allow_html=True)
-            
-            # Image upload status
-            if not row.get('image_url'):
-                st.markdown("<span style='color:#b91c1c;font-weight:600'>Chưa upload ảnh</span>", unsafe_allow_html=True)
-            else:
-                # Hỗ trợ nhiều ảnh (phân tách bằng ';')
-                urls = str(row.get('image_url') or '').split(';')
-                urls = [u for u in urls if u.strip()]
-                if urls:
-                    for i, u in enumerate(urls):
-                        display_drive_image(u, width=200, caption=f"Ảnh {i+1}")
-            
-            edit_key = f'edit_shipment_{row["id"]}'
-            is_editing = st.session_state.get(edit_key, False)
-            
-            if st.button("✏️ Chỉnh sửa" if not is_editing else "❌ Hủy", key=f"btn_edit_{row['id']}"):
-                st.session_state[edit_key] = not is_editing
-                st.rerun()
-        
-        # Edit form
-        if st.session_state.get(edit_key, False):
-            st.divider()
-            st.write("### ✏️ Chỉnh Sửa Phiếu")
-            
-            with st.form(f"edit_shipment_form_{row['id']}"):
-                col_form1, col_form2 = st.columns(2)
-                
-                with col_form1:
-                    edit_qr_code = st.text_input("Mã QR Code:", value=row['qr_code'], key=f"edit_qr_{row['id']}")
-                    edit_imei = st.text_input("IMEI:", value=row['imei'], key=f"edit_imei_{row['id']}")
-                    edit_device_name = st.text_input("Tên thiết bị:", value=row['device_name'], key=f"edit_device_{row['id']}")
-                    edit_capacity = st.text_input("Lỗi / Tình trạng:", value=row['capacity'], key=f"edit_capacity_{row['id']}")
-                
-                with col_form2:
-                    suppliers_df = get_suppliers()
-                    current_supplier_idx = 0
-                    if suppliers_df['name'].tolist():
-                        try:
-                            current_supplier_idx = suppliers_df['name'].tolist().index(row['supplier'])
-                        except:
-                            pass
-                    
-                    edit_supplier = st.selectbox(
-                        "Nhà cung cấp:",
-                        suppliers_df['name'].tolist(),
-                        index=current_supplier_idx,
-                        key=f"edit_supplier_{row['id']}"
-                    )
-                    
-                    # Tạo danh sách trạng thái động (bao gồm "Gửi + tên NCC")
-                    status_options = STATUS_VALUES.copy()
-                    for _, supplier_row in suppliers_df.iterrows():
-                        supplier_name = supplier_row['name']
-                        send_status = f"Gửi {supplier_name}"
-                        if send_status not in status_options:
-                            status_options.append(send_status)
-                    
-                    current_status_idx = 0
-                    if row['status'] in status_options:
-                        current_status_idx = status_options.index(row['status'])
-                    
-                    edit_status = st.selectbox(
-                        "Trạng thái:",
-                        status_options,
-                        index=current_status_idx,
-                        key=f"edit_status_{row['id']}"
-                    )
-                    
-                    # Loại yêu cầu
-                    current_request_type = row.get('request_type', REQUEST_TYPES[0] if REQUEST_TYPES else '')
-                    request_type_idx = 0
-                    if current_request_type in REQUEST_TYPES:
-                        request_type_idx = REQUEST_TYPES.index(current_request_type)
-                    edit_request_type = st.selectbox(
-                        "Loại yêu cầu:",
-                        REQUEST_TYPES,
-                        index=request_type_idx,
-                        key=f"edit_request_type_{row['id']}"
+                    update_notes = st.text_area(
+                        "Ghi chú cập nhật:",
+                        value='',
+                        key=f"update_notes_{shipment_id}",
+                        height=100,
+                        placeholder="Nhập ghi chú mới của bạn..."
                     )
-                    
-                    edit_store_name = st.text_input(
-                        "Cửa hàng:",
-                        value=row.get('store_name', '') if pd.notna(row.get('store_name')) else '',
-                        key=f"edit_store_{row['id']}",
-                        help="Tên cửa hàng (nếu có)"
+    
+                    uploaded_image_detail = st.file_uploader(
+                        "Upload ảnh (tùy chọn)",
+                        type=["png", "jpg", "jpeg"],
+                        accept_multiple_files=True,
+                        key=f"upload_image_detail_{shipment_id}"
                     )
-                    
-                    edit_notes = st.text_area("Ghi chú:", value=row['notes'] if pd.notna(row['notes']) else '', key=f"edit_notes_{row['id']}")
-                    uploaded_image = st.file_uploader("Upload ảnh (tùy chọn, chọn nhiều)", type=["png", "jpg", "jpeg"], accept_multiple_files=True, key=f"upload_image_{row['id']}")
-                
-                col_submit1, col_submit2 = st.columns(2)
-                with col_submit1:
-                    if st.form_submit_button("💾 Lưu thay đổi", type="primary"):
-                        current_user = get_current_user()
-
-                        image_url = row.get('image_url')
-                        if uploaded_image:
-                            urls = []
-                            for idx, f in enumerate(uploaded_image, start=1):
-                                file_bytes = f.getvalue()
-                                mime = f.type or "image/jpeg"
-                                orig_name = f.name or "image.jpg"
-                                ext = ""
-                                if "." in orig_name:
-                                    ext = orig_name.split(".")[-1]
-                                if not ext:
-                                    ext = "jpg"
-                                    sanitized_qr = edit_qr_code.strip().replace(" ", "_").replace("/", "_") or "qr_image"
-                                    sanitized_status = edit_status.replace(" ", "_").replace("/", "_") if edit_status else "unknown"
-                                    # Tên file: mã QR + trạng thái + stt
-                                    drive_filename = f"{sanitized_qr}_{sanitized_status}_{idx}.{ext}"
-                                upload_res = upload_file_to_drive(file_bytes, drive_filename, mime)
-                                if upload_res['success']:
-                                    urls.append(upload_res['url'])
-                                else:
-                                    st.error(f"❌ Upload ảnh {idx} thất bại: {upload_res['error']}")
-                                    st.stop()
-                            if urls:
-                                image_url = ";".join(urls)
-
-                        result = update_shipment(
-                            shipment_id=row['id'],
-                            qr_code=edit_qr_code.strip(),
-                            imei=edit_imei.strip(),
-                            device_name=edit_device_name.strip(),
-                            capacity=edit_capacity.strip(),
-                            supplier=edit_supplier,
-                            status=edit_status,
-                            notes=edit_notes.strip() if edit_notes.strip() else None,
-                            updated_by=current_user,
-                            image_url=image_url,
-                            store_name=edit_store_name.strip() if edit_store_name.strip() else None,
-                            request_type=edit_request_type
-                        )
-                        
-                        if result['success']:
-                            st.success("✅ Đã cập nhật thành công!")
-                            # Notify Telegram if status is one of: Đã nhận, Chuyển kho, Gửi NCC sửa, Chuyển cửa hàng
-                            updated = get_shipment_by_qr_code(edit_qr_code.strip())
-                            if updated and updated.get('status') in ['Đã nhận', 'Chuyển kho', 'Gửi NCC sửa', 'Chuyển cửa hàng']:
-                                res = notify_shipment_if_received(
-                                    updated['id'],
-                                    force=not row.get('telegram_message_id'),
-                                    is_update_image=(uploaded_image is not None)
-                                )
-                                if res and not res.get('success'):
-                                    st.warning(f"Không gửi được Telegram: {res.get('error')}")
-                            edit_key = f'edit_shipment_{row["id"]}'
-                            if edit_key in st.session_state:
-                                del st.session_state[edit_key]
+    
+                    col_btn1, col_btn2 = st.columns(2)
+                    with col_btn1:
+                        if st.button("💾 Cập nhật", key=f"update_btn_{shipment_id}", type="primary", use_container_width=True):
+                            current_user = get_current_user()
+    
+                            # Cột chữ trong DataFrame cache đã điền '': đổi lại None để không ghi '' đè NULL trong DB
+                            image_url = shipment.get('image_url') or None
+                            if uploaded_image_detail:
+                                # Upload song song, giữ thứ tự; báo lỗi sau khi tất cả hoàn tất
+                                urls = upload_images_or_stop(uploaded_image_detail, shipment.get('qr_code', ''), new_status, "unknown")
+                                if urls:
+                                    image_url = encode_image_urls(image_url, urls)
+    
+                            # Xử lý ghi chú: nếu có ghi chú mới, lưu vào history
+                            final_notes = shipment.get('notes') or None
+                            if update_notes.strip():
+                                # Có ghi chú mới, lưu vào history
+                                add_note_to_history(shipment_id, update_notes.strip(), current_user)
+                                # Cập nhật notes field với ghi chú mới nhất
+                                final_notes = update_notes.strip()
+    
+                            # Cập nhật repairer nếu trạng thái là "Đang sửa chữa"
+                            # Đảm bảo repairer luôn có giá trị (mặc định là current_user nếu không chọn)
+                            repairer_to_save = None
+                            if new_status == "Đang sửa chữa":
+                                repairer_to_save = repairer_value if repairer_value else current_user
+    
+                            result = update_shipment(
+                                shipment_id=shipment_id,
+                                status=new_status,
+                                notes=final_notes,
+                                updated_by=current_user,
+                                image_url=image_url,
+                                repairer=repairer_to_save
+                            )
+    
+                            if result['success']:
+                                st.success("✅ Đã cập nhật thành công!")
+                                updated = get_shipment_by_id(shipment_id)
+                                if updated and updated.get('status') in ['Đã nhận', 'Chuyển kho', 'Gửi NCC sửa', 'Chuyển cửa hàng']:
+                                    res = notify_shipment_if_received(
+                                        shipment_id,
+                                        force=not shipment.get('telegram_message_id'),
+                                        is_update_image=(uploaded_image_detail is not None)
+                                    )
+                                    if res and not res.get('success'):
+                                        st.warning(f"Không gửi được Telegram: {res.get('error')}")
+                                st.rerun()
+                            else:
+                                st.error(f"❌ {result['error']}")
+    
+                    with col_btn2:
+                        if st.button("❌ Hủy", key=f"cancel_update_{shipment_id}", use_container_width=True):
                             st.rerun()
-                        else:
-                            st.error(f"❌ {result['error']}")
-                
-                with col_submit2:
-                    if st.form_submit_button("❌ Hủy"):
-                        edit_key = f'edit_shipment_{row["id"]}'
-                        if edit_key in st.session_state:
-                            del st.session_state[edit_key]
-                        st.rerun()
-        
-            st.divider()
+    
+                with col_update2:
+                    st.write("**Thông tin hiện tại:**")
+                    st.write(f"**Trạng thái:** {current_status}")
+                    st.write(f"**Người tạo:** {shipment.get('created_by', '')}")
+                    if shipment.get('updated_by'):
+                        st.write(f"**Người cập nhật:** {shipment.get('updated_by', '')}")
+                    if shipment.get('last_updated'):
+                        st.write(f"**Cập nhật lúc:** {shipment.get('last_updated', '')[:16]}")
+    
+                # Hiển thị ảnh hiện có
+                if shipment.get('image_url'):
+                    st.markdown("**Ảnh hiện có:**")
+                    show_image_urls(parse_image_urls(shipment.get('image_url')), width=150)
 
 
 def show_dashboard():
@@ -1825,15 +2757,7 @@ def show_dashboard():
     # Cửa sổ tìm kiếm gọn gàng - buttons thẳng hàng và bằng nhau
     with st.container():
         # CSS để đảm bảo buttons thẳng hàng
-        st.markdown("""
-        <style>
-        div[data-testid="column"]:nth-of-type(3) button,
-        div[data-testid="column"]:nth-of-type(4) button {
-            height: 38px;
-            margin-top: 0px;
-        }
-        </style>
-        """, unsafe_allow_html=True)
+        st.markdown(_SEARCH_BAR_CSS, unsafe_allow_html=True)
         
         col_search1, col_search2, col_search3, col_search4 = st.columns([3, 1.5, 1, 1])
         
@@ -1888,7 +2812,7 @@ def show_dashboard():
         
         st.markdown("---")
         
-        df_all = get_all_shipments()
+        df_all = get_all_shipments_cached()
         
         if not df_all.empty:
             if search_mode == 'Mã yêu cầu':
@@ -1900,76 +2824,60 @@ def show_dashboard():
             
             if not search_results.empty:
                 # Sắp xếp theo thời gian (mới nhất trước)
-                search_results['sent_time_parsed'] = pd.to_datetime(search_results['sent_time'], errors='coerce')
                 search_results = search_results.sort_values('sent_time_parsed', ascending=False)
                 
                 st.success(f"✅ Tìm thấy **{len(search_results)}** phiếu")
+                
+                # Một bộ chọn + một nút mở chi tiết cho cả danh sách (thay vì một nút trong mỗi phiếu)
+                result_ids = search_results['id'].tolist()
+                result_labels = dict(zip(
+                    result_ids,
+                    (search_results['qr_code'].astype(str) + ' | IMEI: ' + search_results['imei'].astype(str)).tolist()
+                ))
+                col_open1, col_open2 = st.columns([3, 1])
+                with col_open1:
+                    open_id = st.selectbox(
+                        "Mở chi tiết phiếu:",
+                        result_ids,
+                        format_func=result_labels.get,
+                        key="dashboard_search_open_id",
+                        label_visibility="collapsed"
+                    )
+                with col_open2:
+                    if st.button("📋 Xem chi tiết đầy đủ", key="view_detail_search", use_container_width=True, type="secondary"):
+                        st.session_state['dashboard_detail_id'] = open_id
+                        st.session_state['dashboard_search_query'] = ''  # Clear search khi xem chi tiết
+                        st.rerun()
                 st.markdown("---")
                 
-                # Hiển thị từng phiếu tìm được
-                for idx, row in search_results.iterrows():
-                    shipment_id = row['id']
-                    shipment = get_shipment_by_id(shipment_id)
+                # Hiển thị từng phiếu tìm được (duyệt list id, thời gian định dạng cả cột trước vòng lặp)
+                time_strs = format_time_column(search_results['sent_time_parsed']).fillna('')
+                for shipment, time_str in zip(shipment_records(search_results), time_strs.tolist()):
+                    # Lấy thông tin cơ bản
+                    qr_code = str(shipment.get('qr_code', ''))
+                    imei = str(shipment.get('imei', 'Chưa có'))
+                    status = str(shipment.get('status', ''))
                     
-                    if shipment:
-                        # Lấy thông tin cơ bản
-                        qr_code = str(shipment.get('qr_code', ''))
-                        imei = str(shipment.get('imei', 'Chưa có'))
-                        status = str(shipment.get('status', ''))
-                        
-                        # Thời gian
-                        time_str = ''
-                        if pd.notna(shipment.get('sent_time')):
-                            try:
-                                time_str = pd.to_datetime(shipment['sent_time']).strftime('%d/%m/%Y %H:%M')
-                            except:
-                                time_str = str(shipment.get('sent_time', ''))[:16]
-                        
-                        # Nơi tiếp nhận
-                        reception_location = shipment.get('reception_location') or shipment.get('store_name') or 'Chưa có'
-                        request_type = shipment.get('request_type', 'Chưa xác định')
-                        
-                        # Tạo label cho expander
-                        expander_label = f"📋 {qr_code} | IMEI: {imei} | {time_str} | {status} | [{request_type}]"
+                    # Nơi tiếp nhận
+                    reception_location = shipment.get('reception_location') or shipment.get('store_name') or 'Chưa có'
+                    request_type = shipment.get('request_type', 'Chưa xác định')
+                    
+                    # Tạo label cho expander
+                    expander_label = f"📋 {qr_code} | IMEI: {imei} | {time_str} | {status} | [{request_type}]"
+                    
+                    # Hiển thị phiếu trong expander
+                    with st.expander(expander_label, expanded=False):
+                        # Hiển thị thông tin cơ bản
+                        st.markdown("### Thông tin cơ bản")
                         
-                        # Hiển thị phiếu trong expander
-                        with st.expander(expander_label, expanded=False):
-                            # Hiển thị thông tin cơ bản
-                            st.markdown("### Thông tin cơ bản")
-                            
-                            basic_info_html = f"""
-                            <div style="background: #f8f9fa; padding: 16px; border-radius: 8px; margin-bottom: 16px; border: 1px solid #e5e7eb;">
-                                <div style="display: grid; grid-template-columns: 1fr 1fr 1fr 1fr 1fr; gap: 16px; align-items: center;">
-                                    <div>
-                                        <div style="font-size: 0.875rem; color: #6b7280; margin-bottom: 4px;">Mã yêu cầu</div>
-                                        <div style="font-size: 1rem; font-weight: 700; color: #111827;">{html.escape(qr_code)}</div>
-                                    </div>
-                                    <div>
-                                        <div style="font-size: 0.875rem; color: #6b7280; margin-bottom: 4px;">IMEI</div>
-                                        <div style="font-size: 1rem; font-weight: 700; color: #059669;">{html.escape(imei)}</div>
-                                    </div>
-                                    <div>
-                                        <div style="font-size: 0.875rem; color: #6b7280; margin-bottom: 4px;">Thời gian</div>
-                                        <div style="font-size: 1rem; font-weight: 600; color: #111827;">{html.escape(time_str)}</div>
-                                    </div>
-                                    <div>
-                                        <div style="font-size: 0.875rem; color: #6b7280; margin-bottom: 4px;">Nơi tiếp nhận</div>
-                                        <div style="font-size: 1rem; font-weight: 600; color: #111827;">{html.escape(reception_location)}</div>
-                                    </div>
-                                    <div>
-                                        <div style="font-size: 0.875rem; color: #6b7280; margin-bottom: 4px;">Trạng thái</div>
-                                        <div style="font-size: 1rem; font-weight: 700; color: #3b82f6;">{html.escape(status)}</div>
-                                    </div>
-                                </div>
-                            </div>
-                            """
-                            st.markdown(basic_info_html, unsafe_allow_html=True)
-                            
-                            # Nút xem chi tiết
-                            if st.button("📋 Xem chi tiết đầy đủ", key=f"view_detail_search_{shipment_id}", use_container_width=True, type="secondary"):
-                                st.session_state['dashboard_detail_id'] = shipment_id
-                                st.session_state['dashboard_search_query'] = ''  # Clear search khi xem chi tiết
-                                st.rerun()
+                        basic_info_html = basic_info_card_html([
+                            ('Mã yêu cầu', qr_code, 700, '#111827'),
+                            ('IMEI', imei, 700, '#059669'),
+                            ('Thời gian', time_str, 600, '#111827'),
+                            ('Nơi tiếp nhận', reception_location, 600, '#111827'),
+                            ('Trạng thái', status, 700, '#3b82f6'),
+                        ])
+                        st.markdown(basic_info_html, unsafe_allow_html=True)
             else:
                 st.warning(f"⚠️ Không tìm thấy phiếu nào với {search_mode.lower()}: **{html.escape(search_query)}**")
         else:
@@ -2052,20 +2960,20 @@ def show_dashboard():
                 # Không cần check và update vì Streamlit tự động sync với session_state qua key
             
             # Lấy dữ liệu
-            df = get_all_shipments()
+            df = get_all_shipments_cached()
             
             if df.empty:
                 st.info("📭 Chưa có phiếu nào")
                 continue
             
-            # Lọc theo loại yêu cầu
-            filtered_df = df[df['request_type'] == request_type].copy()
+            # Lọc theo loại yêu cầu + trạng thái + thời gian: gộp thành một mask, chỉ cắt DataFrame một lần
+            mask = (df['request_type'] == request_type).to_numpy(dtype=bool)
             
             # Lọc theo trạng thái
             status_key = f"status_filter_{request_type}"
             selected_status = st.session_state.get(status_key, 'Toàn bộ')
             if selected_status != 'Toàn bộ':
-                filtered_df = filtered_df[filtered_df['status'] == selected_status]
+                mask &= (df['status'] == selected_status).to_numpy(dtype=bool)
             
             # Lọc theo thời gian
             from datetime import datetime, timedelta
@@ -2074,69 +2982,56 @@ def show_dashboard():
             time_key = f"time_filter_{request_type}"
             selected_time = st.session_state.get(time_key, 'Toàn bộ')
             
-            # Lọc theo thời gian theo sơ đồ
+            # Lọc theo thời gian theo sơ đồ: [time_start, time_end]
+            time_start, time_end = None, None
             if selected_time == 'Trong vòng 3 ngày':
-                three_days_ago = now - timedelta(days=3)
-                filtered_df = filtered_df[
-                    pd.to_datetime(filtered_df['sent_time'], errors='coerce') >= three_days_ago
-                ]
+                time_start = now - timedelta(days=3)
             elif selected_time == 'Trong vòng 7 ngày':
-                seven_days_ago = now - timedelta(days=7)
-                filtered_df = filtered_df[
-                    pd.to_datetime(filtered_df['sent_time'], errors='coerce') >= seven_days_ago
-                ]
+                time_start = now - timedelta(days=7)
             elif selected_time == 'Trong vòng 30 ngày':
-                thirty_days_ago = now - timedelta(days=30)
-                filtered_df = filtered_df[
-                    pd.to_datetime(filtered_df['sent_time'], errors='coerce') >= thirty_days_ago
-                ]
+                time_start = now - timedelta(days=30)
             elif selected_time == 'Tháng này':
-                month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-                filtered_df = filtered_df[
-                    pd.to_datetime(filtered_df['sent_time'], errors='coerce') >= month_start
-                ]
+                time_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
             elif selected_time == 'Tháng trước':
                 # Tháng trước: từ ngày 1 tháng trước đến ngày cuối tháng trước
                 if now.month == 1:
-                    prev_month_start = now.replace(year=now.year-1, month=12, day=1, hour=0, minute=0, second=0, microsecond=0)
+                    time_start = now.replace(year=now.year-1, month=12, day=1, hour=0, minute=0, second=0, microsecond=0)
                 else:
-                    prev_month_start = now.replace(month=now.month-1, day=1, hour=0, minute=0, second=0, microsecond=0)
-                prev_month_end = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0) - timedelta(seconds=1)
-                filtered_df = filtered_df[
-                    (pd.to_datetime(filtered_df['sent_time'], errors='coerce') >= prev_month_start) &
-                    (pd.to_datetime(filtered_df['sent_time'], errors='coerce') <= prev_month_end)
-                ]
+                    time_start = now.replace(month=now.month-1, day=1, hour=0, minute=0, second=0, microsecond=0)
+                time_end = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0) - timedelta(seconds=1)
             # 'Toàn bộ' không cần lọc thêm
             
+            sent_parsed = df['sent_time_parsed']
+            if time_start is not None:
+                mask &= (sent_parsed >= time_start).to_numpy(dtype=bool)
+            if time_end is not None:
+                mask &= (sent_parsed <= time_end).to_numpy(dtype=bool)
+            filtered_df = df[mask]
+            
             # Bảng nhỏ hiển thị số lượng YCSC theo thời gian: trong 3 ngày, 3-7 ngày, trên 7 ngày
             st.markdown("### 📊 Thống kê theo thời gian")
             col_stat1, col_stat2, col_stat3 = st.columns(3)
             
+            # Đếm trực tiếp trên mask, không tạo DataFrame con
+            filtered_sent = filtered_df['sent_time_parsed']
+            three_days_ago = now - timedelta(days=3)
+            seven_days_ago = now - timedelta(days=7)
+            
             with col_stat1:
-                three_days_ago = now - timedelta(days=3)
-                count_3days = len(filtered_df[
-                    pd.to_datetime(filtered_df['sent_time'], errors='coerce') >= three_days_ago
-                ])
+                count_3days = int((filtered_sent >= three_days_ago).sum())
                 st.metric("Trong 3 ngày", count_3days)
             
             with col_stat2:
-                seven_days_ago = now - timedelta(days=7)
-                count_3_7days = len(filtered_df[
-                    (pd.to_datetime(filtered_df['sent_time'], errors='coerce') >= seven_days_ago) &
-                    (pd.to_datetime(filtered_df['sent_time'], errors='coerce') < three_days_ago)
-                ])
+                count_3_7days = int(((filtered_sent >= seven_days_ago) & (filtered_sent < three_days_ago)).sum())
                 st.metric("3-7 ngày", count_3_7days)
             
             with col_stat3:
-                count_over_7days = len(filtered_df[
-                    pd.to_datetime(filtered_df['sent_time'], errors='coerce') < seven_days_ago
-                ])
+                count_over_7days = int((filtered_sent < seven_days_ago).sum())
                 st.metric("Trên 7 ngày", count_over_7days)
             
             st.divider()
             
             # Sắp xếp theo last_updated (mới nhất trước)
-            filtered_df['last_updated_parsed'] = pd.to_datetime(filtered_df['last_updated'], errors='coerce')
             filtered_df = filtered_df.sort_values('last_updated_parsed', ascending=False, na_position='last')
             
             # Phân trang: lấy từ session state (10, 20, hoặc 50)
@@ -2209,521 +3104,15 @@ def show_dashboard():
                 st.subheader("Chi tiết phiếu")
                 
                 # Hiển thị từng phiếu bằng expander
-                for idx, row in page_df.iterrows():
-                    shipment_id = row['id']
-                    shipment = get_shipment_by_id(shipment_id)
-                    
-                    if shipment:
-                        # Lấy thông tin cơ bản
-                        qr_code = str(shipment.get('qr_code', ''))
-                        imei = str(shipment.get('imei', 'Chưa có'))
-                        status = str(shipment.get('status', ''))
-                        
-                        # Thời gian
-                        time_str = ''
-                        if pd.notna(shipment.get('sent_time')):
-                            try:
-                                time_str = pd.to_datetime(shipment['sent_time']).strftime('%d/%m/%Y %H:%M')
-                            except:
-                                time_str = str(shipment.get('sent_time', ''))[:16]
-                        elif pd.notna(shipment.get('received_time')):
-                            try:
-                                time_str = pd.to_datetime(shipment['received_time']).strftime('%d/%m/%Y %H:%M')
-                            except:
-                                time_str = str(shipment.get('received_time', ''))[:16]
-                        
-                        # Nơi tiếp nhận (reception_location hoặc store_name)
-                        reception_location = shipment.get('reception_location') or shipment.get('store_name') or 'Chưa có'
-                        
-                        # Tạo label cho expander với thông tin cơ bản (thêm IMEI)
-                        expander_label = f"📋 {qr_code} | IMEI: {imei} | {time_str} | {status}"
-                        
-                        # Tạo expander cho mỗi phiếu với thông tin cơ bản
-                        with st.expander(
-                            expander_label,
-                            expanded=(st.session_state.get('dashboard_detail_id') == shipment_id)
-                        ):
-                            # Hiển thị thông tin cơ bản: Mã yêu cầu, Thời gian, Nơi tiếp nhận, Trạng thái
-                            st.markdown("### Thông tin cơ bản")
-                            
-                            # Hiển thị dạng bảng đẹp (thêm IMEI)
-                            basic_info_html = f"""
-                            <div style="background: #f8f9fa; padding: 16px; border-radius: 8px; margin-bottom: 16px; border: 1px solid #e5e7eb;">
-                                <div style="display: grid; grid-template-columns: 1fr 1fr 1fr 1fr 1fr; gap: 16px; align-items: center;">
-                                    <div>
-                                        <div style="font-size: 0.875rem; color: #6b7280; margin-bottom: 4px;">Mã yêu cầu</div>
-                                        <div style="font-size: 1rem; font-weight: 700; color: #111827;">{html.escape(qr_code)}</div>
-            </div>
-                                    <div>
-                                        <div style="font-size: 0.875rem; color: #6b7280; margin-bottom: 4px;">IMEI</div>
-                                        <div style="font-size: 1rem; font-weight: 700; color: #059669;">{html.escape(imei)}</div>
-            </div>
-                                    <div>
-                                        <div style="font-size: 0.875rem; color: #6b7280; margin-bottom: 4px;">Thời gian</div>
-                                        <div style="font-size: 1rem; font-weight: 600; color: #111827;">{html.escape(time_str)}</div>
-            </div>
-                                    <div>
-                                        <div style="font-size: 0.875rem; color: #6b7280; margin-bottom: 4px;">Nơi tiếp nhận</div>
-                                        <div style="font-size: 1rem; font-weight: 600; color: #111827;">{html.escape(reception_location)}</div>
-            </div>
-                                    <div>
-                                        <div style="font-size: 0.875rem; color: #6b7280; margin-bottom: 4px;">Trạng thái</div>
-                                        <div style="font-size: 1rem; font-weight: 700; color: #3b82f6;">{html.escape(status)}</div>
-                                    </div>
-                                </div>
-                            </div>
-                            """
-                            st.markdown(basic_info_html, unsafe_allow_html=True)
-                            
-                            st.divider()
-                            
-                            # Tab thông tin
-                            tab1, tab2 = st.tabs(["📋 Thông tin", "✏️ Cập nhật"])
-                            
-                            with tab1:
-                                # Hiển thị người sửa ở góc trên phải nếu có
-                                if shipment.get('repairer'):
-                                    col_repairer_left, col_repairer_right = st.columns([1, 1])
-                                    with col_repairer_left:
-                                        st.write("**Thông tin chi tiết:**")
-                                    with col_repairer_right:
-                                        st.markdown(f"""
-                                        <div style="
-                                            text-align: right;
-                                            font-weight: 600;
-                                            font-size: 14px;
-                                            color: #333;
-                                            margin-top: 0;
-                                        ">
-                                            👤 Người sửa: <span style="font-size: 16px;">{shipment.get('repairer')}</span>
-                                        </div>
-                                        """, unsafe_allow_html=True)
-                                else:
-                                    st.write("**Thông tin chi tiết:**")
-                                
-                                # Hàng 1: Mã yêu cầu | IMEI
-                                col_row1_1, col_row1_2 = st.columns(2)
-                                with col_row1_1:
-                                    st.write(f"**Mã yêu cầu:** {shipment.get('qr_code', '')}")
-                                with col_row1_2:
-                                    st.write(f"**IMEI:** {shipment.get('imei', 'Chưa có')}")
-                                
-                                # Hàng 2: Thời gian | Ngày cập nhật
-                                col_row2_1, col_row2_2 = st.columns(2)
-                                with col_row2_1:
-                                    time_display = ''
-                                    if pd.notna(shipment.get('sent_time')):
-                                        try:
-                                            time_display = pd.to_datetime(shipment['sent_time']).strftime('%d/%m/%Y %H:%M')
-                                        except:
-                                            time_display = str(shipment.get('sent_time', ''))[:16]
-                                    st.write(f"**Thời gian:** {time_display}")
-                                with col_row2_2:
-                                    update_date = shipment.get('last_updated', '')[:16] if shipment.get('last_updated') else 'Chưa có'
-                                    st.write(f"**Ngày cập nhật:** {update_date}")
-                                
-                                # Hàng 3: Người nhận | Nơi tiếp nhận
-                                col_row3_1, col_row3_2 = st.columns(2)
-                                with col_row3_1:
-                                    st.write(f"**Người nhận:** {shipment.get('created_by', '')}")
-                                with col_row3_2:
-                                    reception_location_display = shipment.get('reception_location') or shipment.get('store_name') or 'Chưa có'
-                                    st.write(f"**Nơi tiếp nhận:** {reception_location_display}")
-                                
-                                # Hàng 4: Trạng thái
-                                st.write(f"**Trạng thái:** {shipment.get('status', '')}")
-                                
-                                st.divider()
-                                
-                                # Ghi chú - Chat box style
-                                st.write("**Ghi chú:**")
-                                
-                                # Lấy lịch sử ghi chú
-                                notes_history = get_notes_history(shipment_id)
-                                
-                                # Container cho chat box - nhỏ gọn
-                                chat_container = st.container()
-                                with chat_container:
-                                    if not notes_history.empty:
-                                        # Hiển thị từng ghi chú như chat message
-                                        for idx, row in notes_history.iterrows():
-                                            # Format thời gian
-                                            try:
-                                                timestamp = pd.to_datetime(row['created_at'])
-                                                time_str = timestamp.strftime("%d/%m/%Y %H:%M")
-                                            except:
-                                                time_str = str(row['created_at'])
-                                            
-                                            # Chat message style - nhỏ gọn
-                                            st.markdown(f"""
-                                            <div style="
-                                                background-color: #f8f9fa;
-                                                padding: 8px 12px;
-                                                border-radius: 8px;
-                                                margin-bottom: 8px;
-                                                border-left: 3px solid #1f77b4;
-                                            ">
-                                                <div style="
-                                                    display: flex;
-                                                    justify-content: space-between;
-                                                    align-items: center;
-                                                    margin-bottom: 4px;
-                                                ">
-                                                    <span style="
-                                                        font-weight: 600;
-                                                        color: #1f77b4;
-                                                        font-size: 12px;
-                                                    ">
-                                                        {row['created_by']}
-                                                    </span>
-                                                    <span style="
-                                                        color: #999;
-                                                        font-size: 10px;
-                                                    ">
-                                                        {time_str}
-                                                    </span>
-                                                </div>
-                                                <div style="
-                                                    color: #333;
-                                                    font-size: 13px;
-                                                    white-space: pre-wrap;
-                                                    word-wrap: break-word;
-                                                    line-height: 1.4;
-                                                ">
-                                                    {row['note_text']}
-                                                </div>
-                                            </div>
-                                            """, unsafe_allow_html=True)
-                                    else:
-                                        # Nếu chưa có ghi chú, hiển thị ghi chú cũ (nếu có) hoặc thông báo
-                                        old_notes = shipment.get('notes', '') or ''
-                                        if old_notes:
-                                            # Migrate ghi chú cũ vào history
-                                            current_user = get_current_user()
-                                            add_note_to_history(shipment_id, old_notes, current_user or shipment.get('created_by', 'System'))
-                                            st.rerun()
-                                        else:
-                                            st.info("💬 Chưa có ghi chú nào. Hãy thêm ghi chú đầu tiên!")
-                                
-                                st.divider()
-                                
-                                # Hiển thị quá trình cập nhật phiếu (Audit Log) với expander để có thể thu gọn
-                                audit_logs = get_audit_log(limit=1000)  # Lấy tất cả log
-                                
-                                if not audit_logs.empty:
-                                    # Lọc log theo shipment_id
-                                    shipment_logs = audit_logs[audit_logs['shipment_id'] == shipment_id].copy()
-                                    
-                                    if not shipment_logs.empty:
-                                        # Sắp xếp theo thời gian (mới nhất trước)
-                                        shipment_logs['timestamp_parsed'] = pd.to_datetime(shipment_logs['timestamp'], errors='coerce')
-                                        shipment_logs = shipment_logs.sort_values('timestamp_parsed', ascending=False)
-                                        
-                                        # Đếm số lượng log entries
-                                        log_count = len(shipment_logs)
-                                        
-                                        # Tạo expander với số lượng log
-                                        with st.expander(f"📋 Quá trình cập nhật phiếu ({log_count} cập nhật)", expanded=False):
-                                            # Hiển thị từng log entry
-                                            for idx, log_row in shipment_logs.iterrows():
-                                                action = log_row.get('action', '')
-                                                old_value = log_row.get('old_value', '')
-                                                new_value = log_row.get('new_value', '')
-                                                changed_by = log_row.get('changed_by', '')
-                                                timestamp = log_row.get('timestamp', '')
-                                                
-                                                # Format timestamp
-                                                try:
-                                                    time_display = pd.to_datetime(timestamp).strftime('%d/%m/%Y %H:%M:%S')
-                                                except:
-                                                    time_display = str(timestamp)[:19] if timestamp else 'N/A'
-                                                
-                                                # Tạo icon và màu sắc theo action - Hiển thị bằng tiếng Việt và chi tiết
-                                                if action == 'CREATED':
-                                                    icon = "🆕"
-                                                    color = "#10b981"  # Green
-                                                    action_text = "Tạo phiếu"
-                                                    # Hiển thị chi tiết thông tin phiếu được tạo
-                                                    change_text = new_value if new_value else f"Phiếu được tạo bởi **{changed_by}**"
-                                                elif action == 'STATUS_CHANGED':
-                                                    icon = "🔄"
-                                                    color = "#3b82f6"  # Blue
-                                                    action_text = "Thay đổi trạng thái"
-                                                    # Hiển thị rõ ràng trạng thái cũ và mới
-                                                    if old_value and new_value:
-                                                        change_text = f"Trạng thái: **{old_value}** → **{new_value}**"
-                                                    elif new_value:
-                                                        change_text = f"Trạng thái mới: **{new_value}**"
-                                                    else:
-                                                        change_text = "Trạng thái đã được thay đổi"
-                                                elif action == 'UPDATED':
-                                                    icon = "✏️"
-                                                    color = "#f59e0b"  # Orange
-                                                    action_text = "Cập nhật thông tin"
-                                                    # Hiển thị chi tiết những gì đã cập nhật
-                                                    if new_value:
-                                                        # new_value chứa thông tin chi tiết về các trường đã thay đổi
-                                                        change_text = new_value
-                                                    else:
-                                                        change_text = "Thông tin phiếu đã được cập nhật"
-                                                else:
-                                                    icon = "📝"
-                                                    color = "#6b7280"  # Gray
-                                                    action_text = "Thay đổi"
-                                                    change_text = f"{old_value} → {new_value}" if old_value and new_value else (new_value or old_value or "Đã cập nhật")
-                                                
-                                                # Hiển thị log entry với styling
-                                                log_html = f"""
-                                                <div style="background: #f8f9fa; padding: 12px; border-radius: 8px; margin-bottom: 8px; border-left: 4px solid {color};">
-                                                    <div style="display: flex; justify-content: space-between; align-items: start; margin-bottom: 4px;">
-                                                        <div style="font-weight: 600; color: {color};">
-                                                            {icon} {action_text}
-                                                        </div>
-                                                        <div style="font-size: 0.875rem; color: #6b7280;">
-                                                            {time_display}
-                                                        </div>
-                                                    </div>
-                                                    <div style="color: #374151; margin-top: 4px;">
-                                                        {change_text}
-                                                    </div>
-                                                    <div style="font-size: 0.875rem; color: #6b7280; margin-top: 4px;">
-                                                        👤 Người thực hiện: <strong>{changed_by}</strong>
-                                                    </div>
-                                                </div>
-                                                """
-                                                st.markdown(log_html, unsafe_allow_html=True)
-                                    else:
-                                        st.info("📭 Chưa có lịch sử cập nhật nào cho phiếu này")
-                                else:
-                                    st.info("📭 Chưa có lịch sử cập nhật nào")
-                                
-                                st.divider()
-                                
-                                # Hiển thị ảnh nếu có
-                                if shipment.get('image_url'):
-                                    st.markdown("### Ảnh đính kèm")
-                                    urls = str(shipment.get('image_url', '')).split(';')
-                                    urls = [u for u in urls if u.strip()]
-                                    img_cols = st.columns(min(len(urls), 3))
-                                    for i, u in enumerate(urls):
-                                        with img_cols[i % len(img_cols)]:
-                                            display_drive_image(u, width=200, caption=f"Ảnh {i+1}")
-                                
-                                # Hiển thị thông tin các trường mới theo sơ đồ
-                                st.divider()
-                                st.markdown("### 📊 Thông tin chi tiết theo sơ đồ")
-                                
-                                col_detail1, col_detail2 = st.columns(2)
-                                
-                                with col_detail1:
-                                    st.markdown("**Thông tin tiếp nhận:**")
-                                    if shipment.get('device_status_on_reception'):
-                                        st.write(f"• Tình trạng thiết bị lúc nhận: {shipment.get('device_status_on_reception')}")
-                                    if shipment.get('quotation_notes'):
-                                        st.write(f"• Ghi chú báo giá: {shipment.get('quotation_notes')}")
-                                    if shipment.get('notes'):
-                                        st.write(f"• Ghi chú nhận máy: {shipment.get('notes')}")
-                                
-                                with col_detail2:
-                                    st.markdown("**Thông tin sửa chữa:**")
-                                    if shipment.get('repairer'):
-                                        st.write(f"• 👤 Người sửa: **{shipment.get('repairer')}**")
-                                    if shipment.get('repair_start_date'):
-                                        try:
-                                            repair_start = pd.to_datetime(shipment.get('repair_start_date')).strftime('%d/%m/%Y %H:%M')
-                                            st.write(f"• Ngày bắt đầu sửa: {repair_start}")
-                                        except:
-                                            st.write(f"• Ngày bắt đầu sửa: {shipment.get('repair_start_date')}")
-                                    if shipment.get('repair_completion_date'):
-                                        try:
-                                            repair_end = pd.to_datetime(shipment.get('repair_completion_date')).strftime('%d/%m/%Y %H:%M')
-                                            st.write(f"• Ngày hoàn thành sửa: {repair_end}")
-                                        except:
-                                            st.write(f"• Ngày hoàn thành sửa: {shipment.get('repair_completion_date')}")
-                                    if shipment.get('repair_notes'):
-                                        st.write(f"• Ghi chú sửa máy: {shipment.get('repair_notes')}")
-                                
-                                if shipment.get('quality_check_notes'):
-                                    st.markdown("**Kiểm tra chất lượng:**")
-                                    st.write(f"• Ghi chú kiểm tra: {shipment.get('quality_check_notes')}")
-                                
-                                if shipment.get('ycsc_completion_date'):
-                                    st.markdown("**Hoàn thành YCSC:**")
-                                    try:
-                                        ycsc_complete = pd.to_datetime(shipment.get('ycsc_completion_date')).strftime('%d/%m/%Y %H:%M')
-                                        st.write(f"• Ngày hoàn thành YCSC: {ycsc_complete}")
-                                    except:
-                                        st.write(f"• Ngày hoàn thành YCSC: {shipment.get('ycsc_completion_date')}")
-                                
-                                if shipment.get('repair_image_url'):
-                                    st.markdown("**Hình ảnh sửa máy:**")
-                                    repair_urls = str(shipment.get('repair_image_url', '')).split(';')
-                                    repair_urls = [u for u in repair_urls if u.strip()]
-                                    repair_img_cols = st.columns(min(len(repair_urls), 3))
-                                    for i, u in enumerate(repair_urls):
-                                        with repair_img_cols[i % len(repair_img_cols)]:
-                                            display_drive_image(u, width=200, caption=f"Ảnh sửa {i+1}")
-                            
-                            with tab2:
-                                st.markdown("### Cập nhật phiếu")
-                                
-                                current_status = shipment.get('status', '')
-                                
-                                # Kiểm tra: Nếu đã hoàn thành YCSC và không phải admin thì không cho cập nhật
-                                if current_status == "Hoàn thành YCSC" and not is_admin():
-                                    st.warning("⚠️ Phiếu này đã hoàn thành YCSC. Chỉ Admin mới có thể chỉnh sửa.")
-                                    st.info("📋 Bạn chỉ có thể xem thông tin phiếu này.")
-                                else:
-                                    # Tạo danh sách trạng thái động
-                                    status_options = STATUS_VALUES.copy()
-                                    suppliers_df = get_suppliers()
-                                    for _, supplier_row in suppliers_df.iterrows():
-                                        supplier_name = supplier_row['name']
-                                        send_status = f"Gửi {supplier_name}"
-                                        if send_status not in status_options:
-                                            status_options.append(send_status)
-                                    
-                                    current_status_idx = 0
-                                    if current_status in status_options:
-                                        current_status_idx = status_options.index(current_status)
-                                    
-                                    col_update1, col_update2 = st.columns([2, 1])
-                                    
-                                    with col_update1:
-                                        new_status = st.selectbox(
-                                        "Trạng thái mới:",
-                                        status_options,
-                                        index=current_status_idx,
-                                        key=f"update_status_{shipment_id}"
-                                    )
-                                    
-                                        # Hiển thị selectbox "Người sửa" khi chọn "Đang sửa chữa"
-                                        repairer_value = None
-                                        if new_status == "Đang sửa chữa":
-                                            current_user_for_repairer = get_current_user()
-                                            users_df = get_all_users()
-                                            user_list = users_df['username'].tolist() if not users_df.empty else [current_user_for_repairer]
-                                            current_repairer = shipment.get('repairer', current_user_for_repairer)
-                                            if current_user_for_repairer not in user_list:
-                                                user_list.insert(0, current_user_for_repairer)
-                                            
-                                            repairer_idx = user_list.index(current_repairer) if current_repairer in user_list else user_list.index(current_user_for_repairer) if current_user_for_repairer in user_list else 0
-                                            
-                                            repairer_value = st.selectbox(
-                                                "Người sửa:",
-                                                user_list,
-                                                index=repairer_idx,
-                                                key=f"repairer_select_{shipment_id}"
-                                            )
-                                    
-                                        update_notes = st.text_area(
-                                            "Ghi chú cập nhật:",
-                                            value='',
-                                            key=f"update_notes_{shipment_id}",
-                                            height=100,
-                                            placeholder="Nhập ghi chú mới của bạn..."
-                                        )
-                                        
-                                        uploaded_image_detail = st.file_uploader(
-                                            "Upload ảnh (tùy chọn)",
-                                            type=["png", "jpg", "jpeg"],
-                                            accept_multiple_files=True,
-                                            key=f"upload_image_detail_{shipment_id}"
-                                        )
-                                        
-                                        col_btn1, col_btn2 = st.columns(2)
-                                        with col_btn1:
-                                            if st.button("💾 Cập nhật", key=f"update_btn_{shipment_id}", type="primary", use_container_width=True):
-                                                current_user = get_current_user()
-                                                
-                                                image_url = shipment.get('image_url')
-                                                if uploaded_image_detail:
-                                                    urls = []
-                                                    for idx, f in enumerate(uploaded_image_detail, start=1):
-                                                        file_bytes = f.getvalue()
-                                                        mime = f.type or "image/jpeg"
-                                                        orig_name = f.name or "image.jpg"
-                                                        ext = ""
-                                                        if "." in orig_name:
-                                                            ext = orig_name.split(".")[-1]
-                                                        if not ext:
-                                                            ext = "jpg"
-                                                        sanitized_qr = shipment.get('qr_code', '').strip().replace(" ", "_").replace("/", "_") or "qr_image"
-                                                        sanitized_status = new_status.replace(" ", "_").replace("/", "_") if new_status else "unknown"
-                                                        drive_filename = f"{sanitized_qr}_{sanitized_status}_{idx}.{ext}"
-                                                        upload_res = upload_file_to_drive(file_bytes, drive_filename, mime)
-                                                        if upload_res['success']:
-                                                            urls.append(upload_res['url'])
-                                                        else:
-                                                            st.error(f"❌ Upload ảnh {idx} thất bại: {upload_res['error']}")
-                                                            st.stop()
-                                                    if urls:
-                                                        if image_url:
-                                                            image_url = f"{image_url};{';'.join(urls)}"
-                                                        else:
-                                                            image_url = ";".join(urls)
-                                                
-                                                # Xử lý ghi chú: nếu có ghi chú mới, lưu vào history
-                                                final_notes = shipment.get('notes', '')
-                                                if update_notes.strip():
-                                                    # Có ghi chú mới, lưu vào history
-                                                    add_note_to_history(shipment_id, update_notes.strip(), current_user)
-                                                    # Cập nhật notes field với ghi chú mới nhất
-                                                    final_notes = update_notes.strip()
-                                                
-                                                # Cập nhật repairer nếu trạng thái là "Đang sửa chữa"
-                                                # Đảm bảo repairer luôn có giá trị (mặc định là current_user nếu không chọn)
-                                                repairer_to_save = None
-                                                if new_status == "Đang sửa chữa":
-                                                    repairer_to_save = repairer_value if repairer_value else current_user
-                                                
-                                                result = update_shipment(
-                                                    shipment_id=shipment_id,
-                                                    status=new_status,
-                                                    notes=final_notes,
-                                                    updated_by=current_user,
-                                                    image_url=image_url,
-                                                    repairer=repairer_to_save
-                                                )
-                                                
-                                                if result['success']:
-                                                    st.success("✅ Đã cập nhật thành công!")
-                                                    updated = get_shipment_by_id(shipment_id)
-                                                    if updated and updated.get('status') in ['Đã nhận', 'Chuyển kho', 'Gửi NCC sửa', 'Chuyển cửa hàng']:
-                                                        res = notify_shipment_if_received(
-                                                            shipment_id,
-                                                            force=not shipment.get('telegram_message_id'),
-                                                            is_update_image=(uploaded_image_detail is not None)
-                                                        )
-                                                        if res and not res.get('success'):
-                                                            st.warning(f"Không gửi được Telegram: {res.get('error')}")
-                                                    st.rerun()
-                                                else:
-                                                    st.error(f"❌ {result['error']}")
-                                        
-                                        with col_btn2:
-                                            if st.button("❌ Hủy", key=f"cancel_update_{shipment_id}", use_container_width=True):
-                                                st.rerun()
-                                    
-                                    with col_update2:
-                                        st.write("**Thông tin hiện tại:**")
-                                        st.write(f"**Trạng thái:** {current_status}")
-                                        st.write(f"**Người tạo:** {shipment.get('created_by', '')}")
-                                        if shipment.get('updated_by'):
-                                            st.write(f"**Người cập nhật:** {shipment.get('updated_by', '')}")
-                                        if shipment.get('last_updated'):
-                                            st.write(f"**Cập nhật lúc:** {shipment.get('last_updated', '')[:16]}")
-                                    
-                                    # Hiển thị ảnh hiện có
-                                    if shipment.get('image_url'):
-                                        st.markdown("**Ảnh hiện có:**")
-                                        urls = str(shipment.get('image_url', '')).split(';')
-                                        urls = [u for u in urls if u.strip()]
-                                        img_cols = st.columns(min(len(urls), 3))
-                                        for i, u in enumerate(urls):
-                                            with img_cols[i % len(img_cols)]:
-                                                display_drive_image(u, width=150, caption=f"Ảnh {i+1}")
-                
+                # Dữ liệu phiếu lấy từ DataFrame cache (shipment_records), không truy vấn DB cho từng phiếu
+                # Thời gian hiển thị: định dạng cả cột một lần trước vòng lặp (thiếu sent_time thì dùng received_time)
+                sent_strs = format_time_column(page_df['sent_time_parsed'])
+                time_strs = sent_strs.fillna(format_time_column(page_df['received_time'])).fillna('')
+                sent_strs = sent_strs.fillna('')
+                # Trạng thái cho form cập nhật (STATUS_VALUES + "Gửi <NCC>") dùng chung cho mọi phiếu trong trang
+                update_status_options = build_status_options(_get_suppliers_cached()['name'].tolist())
+                for shipment, time_str, sent_str in zip(shipment_records(page_df), time_strs.tolist(), sent_strs.tolist()):
+                    render_dashboard_shipment(shipment, time_str, sent_str, update_status_options)
 
 
 def show_kt_kho_dashboard():
@@ -2748,15 +3137,7 @@ def show_kt_kho_dashboard():
     
     # Cửa sổ tìm kiếm
     with st.container():
-        st.markdown("""
-        <style>
-        div[data-testid="column"]:nth-of-type(3) button,
-        div[data-testid="column"]:nth-of-type(4) button {
-            height: 38px;
-            margin-top: 0px;
-        }
-        </style>
-        """, unsafe_allow_html=True)
+        st.markdown(_SEARCH_BAR_CSS, unsafe_allow_html=True)
         
         col_search1, col_search2, col_search3, col_search4 = st.columns([3, 1.5, 1, 1])
         
@@ -2791,7 +3172,7 @@ def show_kt_kho_dashboard():
                 st.rerun()
     
     # Lấy tất cả phiếu có repairer = current_user
-    df_all = get_all_shipments()
+    df_all = get_all_shipments_cached()
     if df_all.empty:
         st.info("📭 Không có phiếu nào")
         return
@@ -2837,7 +3218,6 @@ def show_kt_kho_dashboard():
     # Phiếu treo lâu: đang xử lý nhưng last_updated > 7 ngày
     df_stuck = df_processing.copy()
     if not df_stuck.empty:
-        df_stuck['last_updated_parsed'] = pd.to_datetime(df_stuck['last_updated'], errors='coerce')
         df_stuck = df_stuck[df_stuck['last_updated_parsed'].notna()]
         if not df_stuck.empty:
             seven_days_ago = pd.Timestamp.now() - pd.Timedelta(days=7)
@@ -2849,7 +3229,6 @@ def show_kt_kho_dashboard():
     first_day_of_month = datetime(now.year, now.month, 1)
     
     # Lọc phiếu trong tháng hiện tại (dựa trên sent_time)
-    df_filtered['sent_time_parsed'] = pd.to_datetime(df_filtered['sent_time'], errors='coerce')
     df_month = df_filtered[df_filtered['sent_time_parsed'].notna() & 
                           (df_filtered['sent_time_parsed'] >= first_day_of_month)].copy()
     total_month = len(df_month)
@@ -2870,6 +3249,9 @@ def show_kt_kho_dashboard():
     
     st.divider()
     
+    # Trạng thái cho form cập nhật, dựng một lần cho mọi phiếu ở các tab
+    status_options = build_status_options(_get_suppliers_cached()['name'].tolist())
+    
     # Tabs: Đang xử lý, Hoàn thành, Treo lâu
     tab_names = ["⚙️ Đang xử lý", "✅ Hoàn thành"]
     if len(df_stuck) > 0:
@@ -2884,16 +3266,11 @@ def show_kt_kho_dashboard():
             st.info("📭 Không có phiếu đang xử lý")
         else:
             # Sắp xếp theo last_updated (mới nhất trước)
-            df_processing['last_updated_parsed'] = pd.to_datetime(df_processing['last_updated'], errors='coerce')
             df_processing = df_processing.sort_values('last_updated_parsed', ascending=False)
             
             # Hiển thị từng phiếu
-            for idx, row in df_processing.iterrows():
-                shipment_id = row['id']
-                shipment = get_shipment_by_id(shipment_id)
-                
-                if shipment:
-                    _display_shipment_detail_kt_kho(shipment, shipment_id)
+            for shipment in shipment_records(df_processing):
+                _display_shipment_detail_kt_kho(shipment, shipment['id'], status_options)
     
     # Tab Hoàn thành
     with tabs[1]:
@@ -2905,12 +3282,8 @@ def show_kt_kho_dashboard():
             df_completed = df_completed.sort_values('completed_time_parsed', ascending=False)
             
             # Hiển thị từng phiếu
-            for idx, row in df_completed.iterrows():
-                shipment_id = row['id']
-                shipment = get_shipment_by_id(shipment_id)
-                
-                if shipment:
-                    _display_shipment_detail_kt_kho(shipment, shipment_id)
+            for shipment in shipment_records(df_completed):
+                _display_shipment_detail_kt_kho(shipment, shipment['id'], status_options)
     
     # Tab Treo lâu
     if len(df_stuck) > 0:
@@ -2919,16 +3292,15 @@ def show_kt_kho_dashboard():
             df_stuck = df_stuck.sort_values('last_updated_parsed', ascending=True)
             
             # Hiển thị từng phiếu
-            for idx, row in df_stuck.iterrows():
-                shipment_id = row['id']
-                shipment = get_shipment_by_id(shipment_id)
-                
-                if shipment:
-                    _display_shipment_detail_kt_kho(shipment, shipment_id)
+            for shipment in shipment_records(df_stuck):
+                _display_shipment_detail_kt_kho(shipment, shipment['id'], status_options)
 
 
-def _display_shipment_detail_kt_kho(shipment, shipment_id):
-    """Hiển thị chi tiết phiếu cho KT kho (tái sử dụng code từ dashboard)"""
+def _display_shipment_detail_kt_kho(shipment, shipment_id, status_options=None):
+    """
+    Hiển thị chi tiết phiếu cho KT kho (tái sử dụng code từ dashboard)
+    - status_options: danh sách trạng thái dựng sẵn một lần cho cả trang (None thì tự dựng)
+    """
     qr_code = str(shipment.get('qr_code', ''))
     imei = str(shipment.get('imei', 'Chưa có'))
     status = str(shipment.get('status', ''))
@@ -2952,28 +3324,12 @@ def _display_shipment_detail_kt_kho(shipment, shipment_id):
         # Để đơn giản, tôi sẽ gọi lại logic tương tự
         st.markdown("### Thông tin cơ bản")
         
-        basic_info_html = f"""
-        <div style="background: #f8f9fa; padding: 16px; border-radius: 8px; margin-bottom: 16px; border: 1px solid #e5e7eb;">
-            <div style="display: grid; grid-template-columns: 1fr 1fr 1fr 1fr 1fr; gap: 16px; align-items: center;">
-                <div>
-                    <div style="font-size: 0.875rem; color: #6b7280; margin-bottom: 4px;">Mã yêu cầu</div>
-                    <div style="font-size: 1rem; font-weight: 700; color: #111827;">{html.escape(qr_code)}</div>
-                </div>
-                <div>
-                    <div style="font-size: 0.875rem; color: #6b7280; margin-bottom: 4px;">IMEI</div>
-                    <div style="font-size: 1rem; font-weight: 700; color: #059669;">{html.escape(imei)}</div>
-                </div>
-                <div>
-                    <div style="font-size: 0.875rem; color: #6b7280; margin-bottom: 4px;">Thời gian</div>
-                    <div style="font-size: 1rem; font-weight: 600; color: #111827;">{html.escape(time_str)}</div>
-                </div>
-                <div>
-                    <div style="font-size: 0.875rem; color: #6b7280; margin-bottom: 4px;">Trạng thái</div>
-                    <div style="font-size: 1rem; font-weight: 700; color: #3b82f6;">{html.escape(status)}</div>
-                </div>
-            </div>
-        </div>
-        """
+        basic_info_html = basic_info_card_html([
+            ('Mã yêu cầu', qr_code, 700, '#111827'),
+            ('IMEI', imei, 700, '#059669'),
+            ('Thời gian', time_str, 600, '#111827'),
+            ('Trạng thái', status, 700, '#3b82f6'),
+        ])
         st.markdown(basic_info_html, unsafe_allow_html=True)
         
         st.divider()
@@ -2982,14 +3338,18 @@ def _display_shipment_detail_kt_kho(shipment, shipment_id):
         tab1, tab2 = st.tabs(["📋 Thông tin", "✏️ Cập nhật"])
         
         with tab1:
-            st.write("**Thông tin chi tiết:**")
-            st.write(f"**Mã yêu cầu:** {qr_code}")
-            st.write(f"**IMEI:** {imei}")
-            st.write(f"**Tên thiết bị:** {shipment.get('device_name', '')}")
-            st.write(f"**Lỗi/Tình trạng:** {shipment.get('capacity', '')}")
-            st.write(f"**Trạng thái:** {status}")
+            # Các trường cố định của một phiếu: ghép thành một khối markdown thay vì một phần tử cho mỗi dòng
+            detail_lines = [
+                "**Thông tin chi tiết:**",
+                f"**Mã yêu cầu:** {qr_code}",
+                f"**IMEI:** {imei}",
+                f"**Tên thiết bị:** {shipment.get('device_name', '')}",
+                f"**Lỗi/Tình trạng:** {shipment.get('capacity', '')}",
+                f"**Trạng thái:** {status}",
+            ]
             if shipment.get('repairer'):
-                st.write(f"**Người sửa:** {shipment.get('repairer')}")
+                detail_lines.append(f"**Người sửa:** {shipment.get('repairer')}")
+            st.markdown("  \n".join(detail_lines))
         
         with tab2:
             # Copy logic cập nhật từ dashboard
@@ -3000,13 +3360,7 @@ def _display_shipment_detail_kt_kho(shipment, shipment_id):
                 st.warning("⚠️ Phiếu này đã hoàn thành YCSC. Chỉ Admin mới có thể chỉnh sửa.")
                 st.info("📋 Bạn chỉ có thể xem thông tin phiếu này.")
             else:
-                status_options = STATUS_VALUES.copy()
-                suppliers_df = get_suppliers()
-                for _, supplier_row in suppliers_df.iterrows():
-                    supplier_name = supplier_row['name']
-                    send_status = f"Gửi {supplier_name}"
-                    if send_status not in status_options:
-                        status_options.append(send_status)
+                status_options = status_options or build_status_options(_get_suppliers_cached()['name'].tolist())
                 
                 current_status_idx = 0
                 if current_status in status_options:
@@ -3026,8 +3380,8 @@ def _display_shipment_detail_kt_kho(shipment, shipment_id):
                     repairer_value = None
                     if new_status == "Đang sửa chữa":
                         current_user_for_repairer = get_current_user()
-                        users_df = get_all_users()
-                        user_list = users_df['username'].tolist() if not users_df.empty else [current_user_for_repairer]
+                        users_df = get_all_users_cached()
+                        user_list = users_df['username'].to_numpy().tolist() if not users_df.empty else [current_user_for_repairer]
                         current_repairer = shipment.get('repairer', current_user_for_repairer)
                         if current_user_for_repairer not in user_list:
                             user_list.insert(0, current_user_for_repairer)
@@ -3061,35 +3415,16 @@ def _display_shipment_detail_kt_kho(shipment, shipment_id):
                         if st.button("💾 Cập nhật", key=f"kt_kho_update_btn_{shipment_id}", type="primary", use_container_width=True):
                             current_user = get_current_user()
                             
-                            image_url = shipment.get('image_url')
+                            # Cột chữ trong DataFrame cache đã điền '': đổi lại None để không ghi '' đè NULL trong DB
+                            image_url = shipment.get('image_url') or None
                             if uploaded_image_detail:
-                                urls = []
-                                for idx, f in enumerate(uploaded_image_detail, start=1):
-                                    file_bytes = f.getvalue()
-                                    mime = f.type or "image/jpeg"
-                                    orig_name = f.name or "image.jpg"
-                                    ext = ""
-                                    if "." in orig_name:
-                                        ext = orig_name.split(".")[-1]
-                                    if not ext:
-                                        ext = "jpg"
-                                    sanitized_qr = shipment.get('qr_code', '').strip().replace(" ", "_").replace("/", "_") or "qr_image"
-                                    sanitized_status = new_status.replace(" ", "_").replace("/", "_") if new_status else "unknown"
-                                    drive_filename = f"{sanitized_qr}_{sanitized_status}_{idx}.{ext}"
-                                    upload_res = upload_file_to_drive(file_bytes, drive_filename, mime)
-                                    if upload_res['success']:
-                                        urls.append(upload_res['url'])
-                                    else:
-                                        st.error(f"❌ Upload ảnh {idx} thất bại: {upload_res['error']}")
-                                        st.stop()
+                                # Upload song song, giữ thứ tự; báo lỗi sau khi tất cả hoàn tất
+                                urls = upload_images_or_stop(uploaded_image_detail, shipment.get('qr_code', ''), new_status, "unknown")
                                 if urls:
-                                    if image_url:
-                                        image_url = f"{image_url};{';'.join(urls)}"
-                                    else:
-                                        image_url = ";".join(urls)
+                                    image_url = encode_image_urls(image_url, urls)
                             
                             # Xử lý ghi chú
-                            final_notes = shipment.get('notes', '')
+                            final_notes = shipment.get('notes') or None
                             if update_notes.strip():
                                 add_note_to_history(shipment_id, update_notes.strip(), current_user)
                                 final_notes = update_notes.strip()
@@ -3158,79 +3493,82 @@ def show_suppliers_list():
     st.subheader("📋 Danh Sách Nhà Cung Cấp")
     
     # Get all suppliers
-    df = get_all_suppliers()
+    df = _get_all_suppliers_cached()
     
     if df.empty:
         st.info("📭 Chưa có nhà cung cấp nào trong hệ thống")
         return
     
     # Display suppliers
-    for idx, row in df.iterrows():
+    for row in df.itertuples(index=False):
         col1, col2, col3, col4, col5 = st.columns([3, 2, 2, 1, 1])
         
         with col1:
-            status_icon = "✅" if row['is_active'] else "❌"
-            st.write(f"**{status_icon} {row['name']}**")
+            status_icon = "✅" if row.is_active else "❌"
+            st.write(f"**{status_icon} {row.name}**")
         
         with col2:
-            st.write(f"📞 {row['contact'] or 'N/A'}")
+            st.write(f"📞 {row.contact or 'N/A'}")
         
         with col3:
-            st.write(f"📍 {row['address'] or 'N/A'}")
+            st.write(f"📍 {row.address or 'N/A'}")
         
         with col4:
-            if st.button("✏️ Sửa", key=f"edit_{row['id']}"):
-                st.session_state[f'edit_supplier_{row["id"]}'] = True
+            if st.button("✏️ Sửa", key=f"edit_{row.id}"):
+                st.session_state[f'edit_supplier_{row.id}'] = True
                 st.rerun()
         
         with col5:
-            if row['is_active']:
-                if st.button("🗑️ Xóa", key=f"delete_{row['id']}"):
-                    result = delete_supplier(row['id'])
+            if row.is_active:
+                if st.button("🗑️ Xóa", key=f"delete_{row.id}"):
+                    result = delete_supplier(row.id)
                     if result['success']:
-                        st.success(f"✅ Đã xóa nhà cung cấp: {row['name']}")
+                        _clear_supplier_caches()
+                        st.success(f"✅ Đã xóa nhà cung cấp: {row.name}")
                         st.rerun()
                     else:
                         st.error(f"❌ {result['error']}")
             else:
-                if st.button("♻️ Khôi phục", key=f"restore_{row['id']}"):
-                    result = update_supplier(row['id'], is_active=True)
+                if st.button("♻️ Khôi phục", key=f"restore_{row.id}"):
+                    result = update_supplier(row.id, is_active=True)
                     if result['success']:
-                        st.success(f"✅ Đã khôi phục nhà cung cấp: {row['name']}")
+                        _clear_supplier_caches()
+                        st.success(f"✅ Đã khôi phục nhà cung cấp: {row.name}")
                         st.rerun()
                     else:
                         st.error(f"❌ {result['error']}")
         
         # Edit form (if edit button clicked)
-        if st.session_state.get(f'edit_supplier_{row["id"]}', False):
-            with st.expander(f"✏️ Sửa thông tin: {row['name']}", expanded=True):
-                with st.form(f"edit_form_{row['id']}"):
-                    new_name = st.text_input("Tên nhà cung cấp:", value=row['name'], key=f"edit_name_{row['id']}")
-                    new_contact = st.text_input("Liên hệ:", value=row['contact'] or '', key=f"edit_contact_{row['id']}")
-                    new_address = st.text_input("Địa chỉ:", value=row['address'] or '', key=f"edit_address_{row['id']}")
-                    new_active = st.checkbox("Đang hoạt động", value=bool(row['is_active']), key=f"edit_active_{row['id']}")
+        if st.session_state.get(f'edit_supplier_{row.id}', False):
+            with st.expander(f"✏️ Sửa thông tin: {row.name}", expanded=True):
+                with st.form(f"edit_form_{row.id}"):
+                    new_name = st.text_input("Tên nhà cung cấp:", value=row.name, key=f"edit_name_{row.id}")
+                    new_contact = st.text_input("Liên hệ:", value=row.contact or '', key=f"edit_contact_{row.id}")
+                    new_address = st.text_input("Địa chỉ:", value=row.address or '', key=f"edit_address_{row.id}")
+                    new_active = st.checkbox("Đang hoạt động", value=bool(row.is_active), key=f"edit_active_{row.id}")
                     
                     col_submit1, col_submit2 = st.columns(2)
                     with col_submit1:
                         if st.form_submit_button("💾 Lưu thay đổi", type="primary"):
                             result = update_supplier(
-                                row['id'],
+                                row.id,
                                 name=new_name.strip() if new_name.strip() else None,
                                 contact=new_contact.strip() if new_contact.strip() else None,
                                 address=new_address.strip() if new_address.strip() else None,
                                 is_active=new_active
                             )
                             if result['success']:
+                                _clear_supplier_caches()
                                 st.success("✅ Đã cập nhật thành công!")
-                                st.session_state[f'edit_supplier_{row["id"]}'] = False
+                                st.session_state[f'edit_supplier_{row.id}'] = False
                                 st.rerun()
                             else:
                                 st.error(f"❌ {result['error']}")
                     
                     with col_submit2:
                         if st.form_submit_button("❌ Hủy"):
-                            st.session_state[f'edit_supplier_{row["id"]}'] = False
-            st.rerun()
+                            st.session_state[f'edit_supplier_{row.id}'] = False
+                            st.rerun()
         
         st.divider()
 
@@ -3255,6 +3593,7 @@ def show_add_supplier_form():
                 )
                 
                 if result['success']:
+                    _clear_supplier_caches()
                     st.success(f"✅ Đã thêm nhà cung cấp: {name} (ID: {result['id']})")
                     st.balloons()
                     st.rerun()
@@ -3262,6 +3601,7 @@ def show_add_supplier_form():
                     st.error(f"❌ {result['error']}")
 
 
+@_fragment()
 def show_user_management():
     """Allow admin to create/update user passwords"""
     st.subheader("🔑 Quản Lý Tài Khoản")
@@ -3280,12 +3620,13 @@ def show_user_management():
                     else:
                         res = create_store(store_name.strip(), store_address.strip() if store_address else None, store_note.strip() if store_note else None)
                         if res['success']:
+                            _clear_store_caches()
                             st.success(f"✅ Đã tạo cửa hàng: {store_name}")
                             st.rerun()
                         else:
                             st.error(f"❌ {res['error']}")
         with store_tab2:
-            stores_df = get_all_stores()
+            stores_df = _get_all_stores_cached()
             if stores_df.empty:
                 st.info("Chưa có cửa hàng nào.")
             else:
@@ -3301,9 +3642,7 @@ def show_user_management():
         password = st.text_input("Mật khẩu mới *", type="password")
         confirm = st.text_input("Nhập lại mật khẩu *", type="password")
         
-        stores_df = get_all_stores()
-        store_names = ["Không gán"] + stores_df['name'].tolist() if not stores_df.empty else ["Không gán"]
-        store_choice = st.selectbox("Gán vào cửa hàng", store_names)
+        store_choice = st.selectbox("Gán vào cửa hàng", _store_choice_options())
         
         col_check1, col_check2 = st.columns(2)
         with col_check1:
@@ -3337,29 +3676,29 @@ def show_user_management():
 
     st.divider()
     st.subheader("📋 Danh sách tài khoản")
-    users_df = get_all_users()
+    users_df = get_all_users_cached()
     if users_df.empty:
         st.info("📭 Chưa có tài khoản nào")
         return
 
-    # Hide real password, show masked
-    users_df = users_df.copy()
-    users_df['password'] = users_df['password'].apply(lambda x: '******' if x else '')
-    users_df['is_admin'] = users_df['is_admin'].apply(lambda x: "Admin" if x else "User")
-    
-    # Format is_store column
-    if 'is_store' in users_df.columns:
-        users_df['is_store'] = users_df['is_store'].apply(lambda x: "Cửa hàng" if x else "Không")
-    else:
-        users_df['is_store'] = "Không"
-
-    if 'store_name' in users_df.columns:
-        users_df.rename(columns={'store_name': 'Cửa hàng'}, inplace=True)
-    else:
-        users_df['Cửa hàng'] = ""
+    # Bảng hiển thị dựng một lần từ các mảng numpy (ẩn mật khẩu, đổi cờ sang chữ);
+    # users_df gốc giữ nguyên cho phần chỉnh sửa bên dưới
+    n_users = len(users_df)
+    flags = {
+        col: users_df[col].fillna(0).to_numpy(dtype=bool) if col in users_df.columns else np.zeros(n_users, dtype=bool)
+        for col in ('is_admin', 'is_store')
+    }
+    display_df = pd.DataFrame({
+        'username': users_df['username'].to_numpy(),
+        'password': np.where(users_df['password'].fillna('').astype(bool).to_numpy(), '******', ''),
+        'is_admin': np.where(flags['is_admin'], "Admin", "User"),
+        'is_store': np.where(flags['is_store'], "Cửa hàng", "Không"),
+        **{col: users_df[col].to_numpy() for col in ('is_kt_sr', 'is_kt_kho') if col in users_df.columns},
+        'Cửa hàng': users_df['store_name'].to_numpy() if 'store_name' in users_df.columns else np.full(n_users, ""),
+    })
 
     st.dataframe(
-        users_df,
+        display_df,
         use_container_width=True,
         hide_index=True
     )
@@ -3370,7 +3709,7 @@ def show_user_management():
         st.info("📭 Chưa có tài khoản nào để chỉnh sửa")
         return
 
-    selected_user = st.selectbox("Chọn tài khoản", users_df['username'].tolist(), key="edit_user_select")
+    selected_user = st.selectbox("Chọn tài khoản", users_df['username'].to_numpy().tolist(), key="edit_user_select")
     
     with st.expander("🗑️ Xóa tài khoản", expanded=False):
         if selected_user == 'admin':
@@ -3394,11 +3733,10 @@ def show_user_management():
             st.write(f"Đang chỉnh sửa: **{selected_user}**")
             new_password = st.text_input("Mật khẩu mới (bỏ trống nếu không đổi)", type="password")
 
-            stores_df = get_all_stores()
-            store_names = ["Không gán"] + stores_df['name'].tolist() if not stores_df.empty else ["Không gán"]
+            store_names = _store_choice_options()
             current_store = user_info.get('store_name') or "Không gán"
             if current_store not in store_names:
-                store_names.append(current_store)
+                store_names += (current_store,)
             store_choice_edit = st.selectbox("Gán vào cửa hàng", store_names, index=store_names.index(current_store))
 
             col_flags1, col_flags2 = st.columns(2)
@@ -3432,6 +3770,7 @@ def show_user_management():
                     st.error(f"❌ {res['error']}")
 
 
+@_fragment()
 def show_database_management():
     """Database management - chỉ admin mới có quyền"""
     st.subheader("🗑️ Quản Lý Database")
@@ -3442,10 +3781,10 @@ def show_database_management():
     st.markdown("### Thống kê Database hiện tại")
     
     try:
-        df_shipments = get_all_shipments()
-        df_transfers = get_all_transfer_slips()
-        df_suppliers = get_all_suppliers()
-        df_users = get_all_users()
+        df_shipments = get_all_shipments_cached()
+        df_transfers = get_all_transfer_slips_cached()
+        df_suppliers = _get_all_suppliers_cached()
+        df_users = get_all_users_cached()
         
         col1, col2, col3, col4 = st.columns(4)
         with col1:
@@ -3490,10 +3829,17 @@ def show_database_management():
                     st.success("✅ Đã xóa toàn bộ dữ liệu thành công!")
                     st.info("Database đã được khôi phục về trạng thái ban đầu với dữ liệu mặc định.")
                     st.balloons()
+                    # Xóa cache QR / dữ liệu của các bản ghi cũ
+                    generate_qr_svg.clear()
+                    _clear_supplier_caches()
+                    _clear_store_caches()
+                    _get_audit_log_cached.clear()
+                    _get_audit_log_csv.clear()
                     # Clear session state để reload
-                    for key in list(st.session_state.keys()):
-                        if key != 'username':  # Giữ lại thông tin đăng nhập
-                            del st.session_state[key]
+                    username = st.session_state.get('username')  # Giữ lại thông tin đăng nhập
+                    st.session_state.clear()
+                    if username is not None:
+                        st.session_state['username'] = username
                     st.rerun()
                 else:
                     st.error(f"❌ Lỗi khi xóa database: {result['error']}")
@@ -3504,6 +3850,9 @@ def show_database_management():
 
 def show_google_sheets_settings():
     """Show Google Sheets settings and test connection"""
+    # gspread/google-auth chỉ cần ở màn này: không import lúc khởi động app
+    from google_sheets import push_shipments_to_sheets, test_connection
+    
     st.subheader("☁️ Cài Đặt Google Sheets")
     
     st.info("""
@@ -3548,7 +3897,7 @@ def show_google_sheets_settings():
     
     if st.button("📤 Push tất cả dữ liệu lên Google Sheets", type="primary", key="push_all_data"):
         with st.spinner("Đang push tất cả dữ liệu lên Google Sheets..."):
-            df = get_all_shipments()
+            df = get_all_shipments_cached()
             if df.empty:
                 st.warning("⚠️ Không có dữ liệu để push")
             else:
@@ -3575,8 +3924,12 @@ def show_transfer_slip_screen():
         show_manage_transfer_slips()
 
 
+@_fragment()
 def show_transfer_slip_scan(current_user):
-    """Screen for scanning QR codes and adding to transfer slip"""
+    """
+    Screen for scanning QR codes and adding to transfer slip
+    Chạy dạng fragment: chụp ảnh / bật tắt camera chỉ chạy lại phần này, không chạy lại cả app.
+    """
     # Get or create active transfer slip
     active_slip = get_active_transfer_slip(current_user)
     
@@ -3609,20 +3962,19 @@ def show_transfer_slip_scan(current_user):
         
         if st.button("Bắt đầu quét", type="primary", key="start_scan_transfer"):
             st.session_state['show_camera_transfer'] = True
-            st.rerun()
+            st.rerun(scope="fragment")
         
         if st.session_state['show_camera_transfer']:
             if st.button("Dừng quét", key="stop_scan_transfer"):
                 st.session_state['show_camera_transfer'] = False
-                st.rerun()
+                st.rerun(scope="fragment")
             
             picture = st.camera_input("Quét mã QR", key="transfer_camera")
             
             if picture is not None:
                 with st.spinner("Đang xử lý..."):
                     try:
-                        image = Image.open(picture)
-                        qr_text = decode_qr_from_image(image)
+                        qr_text = decode_qr_from_bytes(picture.getvalue())
                         
                         if qr_text:
                             # Chỉ lấy mã QR (toàn bộ chuỗi quét được)
@@ -3648,15 +4000,17 @@ def show_transfer_slip_scan(current_user):
         st.subheader(f"Danh sách máy ({len(items_df)} máy)")
         
         if not items_df.empty:
-            for idx, row in items_df.iterrows():
-                st.write(f"• {row['qr_code']} - {row['device_name']}")
+            # Một khối văn bản ghép sẵn bằng pandas thay vì một st.write cho mỗi máy;
+            # st.text không diễn giải markdown nên mã QR/tên máy có *, _, # hiển thị nguyên dạng
+            item_lines = "• " + items_df['qr_code'].astype(str) + " - " + items_df['device_name'].astype(str)
+            st.text("\n".join(item_lines))
         
         # Show image if transfer slip has one
         # Chỉ tải ảnh khi đang xem phiếu chuyển này
         if active_slip.get('image_url'):
             st.divider()
             st.subheader("Ảnh phiếu chuyển")
-            display_drive_image(active_slip['image_url'], width=250, caption="Ảnh phiếu chuyển")
+            show_image_urls(parse_image_urls(active_slip['image_url']), width=250, caption_prefix="Ảnh phiếu chuyển")
         
         st.divider()
         
@@ -3667,26 +4021,21 @@ def show_transfer_slip_scan(current_user):
             batch_status = st.selectbox(
                 "Trạng thái mới cho tất cả máy trong phiếu:",
                 STATUS_VALUES,
-                index=STATUS_VALUES.index('Đã nhận') if 'Đã nhận' in STATUS_VALUES else 0,
+                index=STATUS_IDX_RECEIVED,
                 key="batch_status"
             )
             
             if st.button("✅ Cập nhật tất cả thành 'Đã nhận'", type="primary", key="batch_receive"):
                 current_user = get_current_user()
-                success_count = 0
-                error_count = 0
-                
-                for idx, row in items_df.iterrows():
-                    result = update_shipment_status(
-                        qr_code=row['qr_code'],
-                        new_status='Đã nhận',
-                        updated_by=current_user,
-                        notes=f"Cập nhật từ phiếu chuyển {transfer_code}"
-                    )
-                    if result['success']:
-                        success_count += 1
-                    else:
-                        error_count += 1
+                # Một transaction cho cả phiếu (một UPDATE + một lần ghi audit) thay vì cập nhật từng máy
+                result = update_shipments_status_bulk(
+                    items_df['qr_code'].tolist(),
+                    new_status='Đã nhận',
+                    updated_by=current_user,
+                    notes=f"Cập nhật từ phiếu chuyển {transfer_code}"
+                )
+                success_count = result['updated_count']
+                error_count = len(result['missing']) if result['success'] else len(items_df)
                 
                 if success_count > 0:
                     st.success(f"✅ Đã cập nhật {success_count} phiếu thành 'Đã nhận'")
@@ -3702,7 +4051,7 @@ def show_transfer_slip_scan(current_user):
     new_status = st.selectbox(
         "Trạng thái mới cho các máy khi hoàn thành:",
         STATUS_VALUES,
-        index=STATUS_VALUES.index('Chuyển kho') if 'Chuyển kho' in STATUS_VALUES else 0,
+        index=STATUS_IDX_TRANSFER,
         key="transfer_status"
     )
     
@@ -3721,26 +4070,9 @@ def show_transfer_slip_scan(current_user):
                         else:
                             image_files = [uploaded_image]
                         
-                        urls = []
-                        for idx, img in enumerate(image_files, start=1):
-                            file_bytes = img.getvalue()
-                            mime = img.type or "image/jpeg"
-                            ext = img.name.split(".")[-1] if "." in img.name else "jpg"
-                            # Tên file: tên phiếu chuyển + trạng thái + stt
-                            sanitized_code = transfer_code.replace(" ", "_").replace("/", "_")
-                            sanitized_status = new_status.replace(" ", "_").replace("/", "_")
-                            drive_filename = f"{sanitized_code}_{sanitized_status}_{idx}.{ext}"
-                            upload_res = upload_file_to_transfer_folder(file_bytes, drive_filename, mime)
-                            if upload_res['success']:
-                                urls.append(upload_res['url'])
-                            else:
-                                st.error(f"Upload ảnh {idx} thất bại: {upload_res['error']}")
-                                st.stop()
-                        
-                        if urls:
-                            image_url = ";".join(urls)
-                        else:
-                            image_url = None
+                        # Tên file: tên phiếu chuyển + trạng thái + stt; upload song song vào thư mục phiếu chuyển
+                        urls = upload_images_or_stop(image_files, transfer_code, new_status, transfer_folder=True)
+                        image_url = encode_image_urls(urls)
                 
                 # Update transfer slip
                 update_result = update_transfer_slip(
@@ -3773,28 +4105,45 @@ def show_transfer_slip_scan(current_user):
                     st.error(f"Lỗi: {update_result['error']}")
 
 
+@_fragment()
 def show_manage_transfer_slips():
     """Show all transfer slips for management"""
     st.header("Quản Lý Phiếu Chuyển")
     
-    df = get_all_transfer_slips()
+    df = get_all_transfer_slips_cached()
     
     if df.empty:
         st.info("Chưa có phiếu chuyển nào")
         return
     
-    st.dataframe(
+    # Bảng hỗ trợ chọn dòng sẵn (không tự dựng bảng HTML để đánh dấu dòng đang chọn)
+    table_event = st.dataframe(
         df,
-            use_container_width=True,
+        use_container_width=True,
         hide_index=True,
-        height=400
+        height=400,
+        on_select="rerun",
+        selection_mode="single-row",
+        key="transfer_slip_table"
     )
     
-    # View details
+    # Bấm chọn một dòng trong bảng -> mở chi tiết phiếu đó ở ô chọn bên dưới
+    picked_rows = table_event.selection.rows
+    picked_id = int(df['id'].iloc[picked_rows[0]]) if picked_rows else None
+    if picked_id is not None and picked_id != st.session_state.get('transfer_slip_table_picked'):
+        st.session_state['transfer_slip_select'] = picked_id
+    st.session_state['transfer_slip_table_picked'] = picked_id
+    
+    # View details (nhãn dựng sẵn theo id: tra dict thay vì lọc DataFrame cho mỗi lựa chọn)
+    slip_labels = dict(zip(
+        df['id'].to_numpy().tolist(),
+        (df['transfer_code'].astype(str) + " - " + df['item_count'].astype(str) + " máy").tolist()
+    ))
     selected_id = st.selectbox(
         "Chọn phiếu chuyển để xem chi tiết:",
-        df['id'].tolist(),
-        format_func=lambda x: f"{df[df['id']==x]['transfer_code'].iloc[0]} - {df[df['id']==x]['item_count'].iloc[0]} máy"
+        list(slip_labels),
+        key="transfer_slip_select",
+        format_func=slip_labels.get
     )
     
     if selected_id:
@@ -3814,7 +4163,7 @@ def show_manage_transfer_slips():
                 st.write(f"**Thời gian hoàn thành:** {slip['completed_at']}")
             if slip['image_url']:
                 # Tải ảnh ngay khi xem chi tiết phiếu chuyển (không lazy load)
-                display_drive_image(slip['image_url'], width=300, caption="Ảnh phiếu chuyển")
+                show_image_urls(parse_image_urls(slip['image_url']), width=300, caption_prefix="Ảnh phiếu chuyển")
         
         st.subheader(f"Danh sách máy ({len(items_df)} máy)")
         st.dataframe(items_df[['qr_code', 'imei', 'device_name', 'capacity', 'status']], use_container_width=True, hide_index=True)
@@ -3857,8 +4206,7 @@ st.set_page_config(
 )
 
 # Apply styles
-inject_sidebar_styles()
-inject_main_styles()
+inject_styles()
 
 # Ensure service account file exists (for Streamlit Cloud)
 ensure_service_account_file()
@@ -3872,6 +4220,9 @@ if 'db_initialized' not in st.session_state:
 if not require_login():
     st.stop()
 
+# Dọn AuditLog định kỳ ở thread nền (khởi động một lần mỗi process)
+_start_audit_cleanup()
+
 # Auto-update status after 1 hour (run on every page load)
 try:
     auto_result = auto_update_status_after_1hour()
@@ -3884,89 +4235,7 @@ except Exception as e:
     print(f"Error auto-updating status: {e}")
 
 # Add loading animation CSS and optimize performance
-st.markdown("""
-<style>
-    /* Loading overlay animation */
-    @keyframes spin {
-        0% { transform: rotate(0deg); }
-        100% { transform: rotate(360deg); }
-    }
-    
-    @keyframes fadeIn {
-        from { 
-            opacity: 0; 
-            transform: translateY(10px); 
-        }
-        to { 
-            opacity: 1; 
-            transform: translateY(0); 
-        }
-    }
-    
-    @keyframes slideIn {
-        from {
-            opacity: 0;
-            transform: translateX(-20px);
-        }
-        to {
-            opacity: 1;
-            transform: translateX(0);
-        }
-    }
-    
-    .page-content {
-        animation: fadeIn 0.4s ease-out;
-        will-change: opacity, transform;
-    }
-    
-    .loading-spinner {
-        border: 4px solid #f3f3f3;
-        border-top: 4px solid #3498db;
-        border-radius: 50%;
-        width: 40px;
-        height: 40px;
-        animation: spin 1s linear infinite;
-        margin: 20px auto;
-    }
-    
-    /* Smooth transition for navigation buttons */
-    .stButton > button {
-        transition: all 0.2s ease-in-out;
-        will-change: transform, box-shadow;
-    }
-    
-    .stButton > button:hover {
-        transform: translateY(-2px);
-        box-shadow: 0 4px 8px rgba(0,0,0,0.2);
-    }
-    
-    .stButton > button:active {
-        transform: translateY(0);
-    }
-    
-    /* Optimize rendering */
-    .main .block-container {
-        padding-top: 2rem;
-        padding-bottom: 2rem;
-    }
-    
-    /* Smooth transitions for expanders */
-    .streamlit-expanderHeader {
-        transition: background-color 0.2s ease;
-    }
-    
-    /* Loading state */
-    .page-loading {
-        opacity: 0.6;
-        pointer-events: none;
-    }
-    
-    /* Prevent layout shift */
-    [data-testid="stAppViewContainer"] {
-        min-height: 100vh;
-    }
-</style>
-""", unsafe_allow_html=True)
+st.markdown(_PAGE_CSS, unsafe_allow_html=True)
 
 # Main layout
 st.sidebar.markdown('<div class="sidebar-title">Quản Lý Giao Nhận</div>', unsafe_allow_html=True)
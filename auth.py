@@ -14,7 +14,7 @@ try:
     from settings import USERS  # type: ignore
 except ModuleNotFoundError:
     from config import USERS  # type: ignore
-from database import get_user
+from database import get_user, get_data_version
 
 REMEMBER_FILE = "remember_tokens.json"
 
@@ -110,6 +110,28 @@ def get_current_user():
     return st.session_state.get('username', None)
 
 
+def _get_current_user_record():
+    """
+    Bản ghi DB của user đang đăng nhập, nhớ trong session để các hàm kiểm tra
+    quyền (is_store_user, is_kt_sr, is_kt_kho...) không truy vấn DB mỗi lần rerun.
+    Tự làm mới khi user đăng nhập thay đổi hoặc DB vừa được ghi (get_data_version),
+    nên quyền bị admin thu hồi/đổi có hiệu lực ngay ở lần rerun kế tiếp.
+    
+    Returns:
+        dict: Thông tin user hoặc None
+    """
+    username = get_current_user()
+    if not username:
+        return None
+    version = get_data_version()
+    cached = st.session_state.get('current_user_record')
+    if cached and cached[0] == username and cached[1] == version:
+        return cached[2]
+    user = get_user(username)
+    st.session_state['current_user_record'] = (username, version, user)
+    return user
+
+
 def is_logged_in():
     """
     Check if user is logged in
@@ -151,6 +173,8 @@ def logout():
     # Clear session
     if 'username' in st.session_state:
         del st.session_state['username']
+    st.session_state.pop('store_context', None)
+    st.session_state.pop('current_user_record', None)
 
 
 def is_admin():
@@ -178,8 +202,7 @@ def is_store_user():
     
     # Check database first
     try:
-        from database import get_user
-        user = get_user(username)
+        user = _get_current_user_record()
         if user and user.get('is_store'):
             return True
     except Exception as e:
@@ -203,7 +226,7 @@ def is_kt_sr():
     
     # Check database first
     try:
-        user = get_user(username)
+        user = _get_current_user_record()
         if user and user.get('is_kt_sr'):
             return True
     except Exception as e:
@@ -227,7 +250,7 @@ def is_kt_kho():
     
     # Check database first
     try:
-        user = get_user(username)
+        user = _get_current_user_record()
         if user and user.get('is_kt_kho'):
             return True
     except Exception as e:
@@ -256,7 +279,7 @@ def get_store_name_from_username(username):
     
     # Try DB first
     try:
-        user = get_user(username)
+        user = _get_current_user_record() if username == get_current_user() else get_user(username)
         if user and user.get('store_name'):
             return user.get('store_name')
     except Exception:
@@ -274,6 +297,26 @@ def get_store_name_from_username(username):
     return username
 
 
+def get_store_context():
+    """
+    Thông tin cửa hàng của user hiện tại, nhớ trong session để không
+    truy vấn DB mỗi lần rerun. Tự làm mới khi user đăng nhập thay đổi
+    hoặc DB vừa được ghi (get_data_version).
+    
+    Returns:
+        tuple: (is_store_user, store_name)
+    """
+    username = get_current_user()
+    version = get_data_version()
+    cached = st.session_state.get('store_context')
+    if cached and cached[0] == username and cached[1] == version:
+        return cached[2], cached[3]
+    store_user = is_store_user()
+    store_name = get_store_name_from_username(username) if store_user else None
+    st.session_state['store_context'] = (username, version, store_user, store_name)
+    return store_user, store_name
+
+
 def require_login():
     """
     Show login form if user is not logged in
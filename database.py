@@ -4,7 +4,9 @@ Handles all SQLite database operations for shipment management
 """
 
 import sqlite3
+import json
 import os
+from functools import lru_cache
 import sys
 from datetime import datetime
 import pandas as pd
@@ -25,6 +27,71 @@ def get_connection():
     return sqlite3.connect(DB_PATH)
 
 
+def get_data_version():
+    """
+    Token rẻ cho biết DB đã thay đổi chưa (dùng làm key cache ở UI)
+    
+    Returns:
+        tuple: (mtime_ns, size) của file DB và file -wal (nếu có); đổi sau mỗi lần ghi
+    """
+    version = []
+    for path in (DB_PATH, f"{DB_PATH}-wal"):
+        try:
+            stat = os.stat(path)
+            version.extend((stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            version.extend((0, 0))
+    return tuple(version)
+
+
+def parse_image_urls(value):
+    """
+    Đọc danh sách link ảnh từ cột image_url / repair_image_url
+    
+    Args:
+        value: Mảng JSON (định dạng mới), chuỗi nối bằng ';' (dữ liệu cũ) hoặc list
+        
+    Returns:
+        list: Danh sách URL (bỏ phần tử rỗng)
+    """
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        return [str(url).strip() for url in value if url and str(url).strip()]
+    if pd.isna(value):
+        return []
+    # Cùng một chuỗi được đọc lại ở mỗi lần rerun: nhớ kết quả, trả bản sao list
+    return list(_parse_image_urls_text(str(value).strip()))
+
+
+@lru_cache(maxsize=2048)
+def _parse_image_urls_text(text):
+    """Tách chuỗi image_url (JSON hoặc ';') thành tuple URL; cache theo nội dung chuỗi."""
+    urls = None
+    if text.startswith('['):
+        try:
+            urls = json.loads(text)
+        except ValueError:
+            urls = None
+    if not isinstance(urls, list):
+        urls = text.split(';')
+    return tuple(str(url).strip() for url in urls if url and str(url).strip())
+
+
+def encode_image_urls(*parts):
+    """
+    Gộp các danh sách link ảnh và mã hóa thành mảng JSON để lưu DB
+    
+    Args:
+        *parts: Mỗi phần là list URL hoặc giá trị cột cũ (JSON / ';')
+        
+    Returns:
+        str or None: Mảng JSON, None nếu không có ảnh
+    """
+    urls = [url for part in parts for url in parse_image_urls(part)]
+    return json.dumps(urls, ensure_ascii=False) if urls else None
+
+
 def init_database():
     """
     Initialize database with tables and seed default data
@@ -128,6 +195,12 @@ def init_database():
         )
         ''')
 
+        # Index cho lịch sử theo phiếu: lọc shipment_id và sắp xếp timestamp bằng index
+        cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_auditlog_shipment_time
+        ON AuditLog (shipment_id, timestamp DESC)
+        ''')
+
         # Create Users table for authentication
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS Users (
@@ -279,6 +352,19 @@ def init_database():
             )
             ''')
         
+        # Migration: Chuyển link ảnh dạng 'a;b;c' (cũ) sang mảng JSON
+        for column in ('image_url', 'repair_image_url'):
+            cursor.execute(f"""
+            SELECT id, {column} FROM ShipmentDetails
+            WHERE {column} IS NOT NULL AND {column} != '' AND {column} NOT LIKE '[%'
+            """)
+            legacy_rows = cursor.fetchall()
+            if legacy_rows:
+                cursor.executemany(
+                    f"UPDATE ShipmentDetails SET {column} = ? WHERE id = ?",
+                    [(encode_image_urls(value), row_id) for row_id, value in legacy_rows]
+                )
+        
         conn.commit()
         return True
     except Exception as e:
@@ -359,6 +445,96 @@ def save_shipment(qr_code, imei, device_name, capacity, supplier, created_by, no
         conn.close()
 
 
+def save_shipments_bulk(records, created_by, status=None, store_name=None, request_type=None, reception_location=None):
+    """
+    Save many new shipments in one transaction (bulk Excel import)
+    
+    Args:
+        records: List of dicts with qr_code, imei, device_name, capacity
+        created_by: Username who created
+        status: Optional status (defaults to DEFAULT_STATUS)
+        store_name: Optional store name (for store users)
+        request_type: Optional request type
+        reception_location: Optional reception location
+        
+    Returns:
+        dict: {'success': bool, 'ids': {qr_code: id} of inserted rows, 'error': str or None}
+              QR codes missing from 'ids' already existed (or were repeated in records)
+    """
+    if not records:
+        return {'success': True, 'ids': {}, 'error': None}
+    if not request_type:
+        request_type = 'Sửa chữa dịch vụ'  # Default
+    
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('SELECT COALESCE(MAX(id), 0) FROM ShipmentDetails')
+        last_id = cursor.fetchone()[0]
+        
+        # Một lệnh executemany cho cả file; mã QR trùng bị bỏ qua thay vì làm hỏng cả lô
+        cursor.executemany('''
+        INSERT OR IGNORE INTO ShipmentDetails 
+        (qr_code, imei, device_name, capacity, supplier, status, request_type, created_by, store_name, reception_location, last_updated)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+        ''', [
+            (
+                rec['qr_code'],
+                rec['imei'],
+                rec['device_name'],
+                rec['capacity'],
+                "Chưa chọn",
+                status if status else DEFAULT_STATUS,
+                request_type,
+                created_by,
+                store_name,
+                reception_location
+            )
+            for rec in records
+        ])
+        
+        cursor.execute('''
+        SELECT id, qr_code, imei, device_name FROM ShipmentDetails WHERE id > ? ORDER BY id
+        ''', (last_id,))
+        inserted = cursor.fetchall()
+        
+        # Log audit (cùng transaction)
+        cursor.executemany('''
+        INSERT INTO AuditLog (shipment_id, action, old_value, new_value, changed_by)
+        VALUES (?, ?, ?, ?, ?)
+        ''', [
+            (shipment_id, 'CREATED', None, f"Đã tạo phiếu: {qr_code} - {device_name} (IMEI: {imei})", created_by)
+            for shipment_id, qr_code, imei, device_name in inserted
+        ])
+        
+        # Dữ liệu cho Google Sheets (đọc trong transaction để chỉ lấy đúng các dòng vừa thêm)
+        new_df = pd.read_sql_query('''
+        SELECT id, qr_code, imei, device_name, capacity, supplier, 
+               status, sent_time, received_time, created_by, updated_by, notes
+        FROM ShipmentDetails WHERE id > ? ORDER BY id
+        ''', conn, params=(last_id,))
+        
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        return {'success': False, 'ids': {}, 'error': str(e)}
+    finally:
+        conn.close()
+    
+    # Auto-sync to Google Sheets: một lần append cho cả lô
+    if not new_df.empty:
+        try:
+            from google_sheets import push_shipments_to_sheets
+            push_shipments_to_sheets(new_df, append_mode=True)
+        except Exception as e:
+            # Don't fail the save operation if Google Sheets sync fails
+            print(f"Warning: Failed to sync to Google Sheets: {e}")
+    
+    return {'success': True, 'ids': {qr_code: shipment_id for shipment_id, qr_code, _, _ in inserted}, 'error': None}
+
+
 def update_shipment(shipment_id, qr_code=None, imei=None, device_name=None, capacity=None, 
                    supplier=None, status=None, notes=None, updated_by=None, image_url=None,
                    telegram_message_id=None, store_name=None, request_type=None, completed_time=None, reception_location=None,
@@ -556,6 +732,15 @@ def update_shipment(shipment_id, qr_code=None, imei=None, device_name=None, capa
         conn.close()
 
 
+# Cột trả về cho một phiếu (get_shipment_by_qr_code / update_shipment_status)
+SHIPMENT_COLUMNS = '''id, qr_code, imei, device_name, capacity, supplier, 
+               status, request_type, sent_time, received_time, completed_time, created_by, updated_by, notes, image_url, telegram_message_id, store_name, reception_location, last_updated,
+               device_status_on_reception, repairer, repair_start_date, repair_completion_date, ycsc_completion_date, repair_notes, quality_check_notes, repair_image_url, quotation_notes'''
+
+# UPDATE ... RETURNING có từ SQLite 3.35
+SQLITE_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+
 def update_shipment_status(qr_code, new_status, updated_by, notes=None, image_url=None):
     """
     Update shipment status
@@ -568,12 +753,14 @@ def update_shipment_status(qr_code, new_status, updated_by, notes=None, image_ur
         image_url: Optional image URL (can append to existing images)
         
     Returns:
-        dict: {'success': bool, 'error': str or None}
+        dict: {'success': bool, 'error': str or None, 'shipment': dict of the updated row}
     """
     conn = get_connection()
     cursor = conn.cursor()
     
     try:
+        # Đọc - cập nhật - ghi audit trong một transaction (một lần commit)
+        cursor.execute('BEGIN IMMEDIATE')
         # Get current shipment data
         cursor.execute('''
         SELECT id, status, image_url FROM ShipmentDetails WHERE qr_code = ?
@@ -581,6 +768,7 @@ def update_shipment_status(qr_code, new_status, updated_by, notes=None, image_ur
         result = cursor.fetchone()
         
         if not result:
+            conn.rollback()
             return {'success': False, 'error': 'Phiếu không tồn tại'}
         
         shipment_id, old_status, current_image_url = result
@@ -609,14 +797,9 @@ def update_shipment_status(qr_code, new_status, updated_by, notes=None, image_ur
         if notes:
             update_fields['notes'] = notes
         
-        # Handle image_url: append to existing if both exist, otherwise use new or keep existing
+        # Handle image_url: append new images to existing ones (JSON array)
         if image_url:
-            if current_image_url:
-                # Append new images to existing ones
-                update_fields['image_url'] = f"{current_image_url};{image_url}"
-            else:
-                # Set new image URL
-                update_fields['image_url'] = image_url
+            update_fields['image_url'] = encode_image_urls(current_image_url, image_url)
         
         # Handle last_updated separately (SQL function)
         fields_without_timestamp = {k: v for k, v in update_fields.items() if k != 'last_updated'}
@@ -624,16 +807,31 @@ def update_shipment_status(qr_code, new_status, updated_by, notes=None, image_ur
         set_clause += ', last_updated = CURRENT_TIMESTAMP'
         values = list(fields_without_timestamp.values()) + [qr_code]
         
-        cursor.execute(f'''
-        UPDATE ShipmentDetails
-        SET {set_clause}
-        WHERE qr_code = ?
-        ''', values)
+        # Lấy luôn dòng sau cập nhật để caller không phải query lại
+        if SQLITE_HAS_RETURNING:
+            cursor.execute(f'''
+            UPDATE ShipmentDetails
+            SET {set_clause}
+            WHERE qr_code = ?
+            RETURNING {SHIPMENT_COLUMNS}
+            ''', values)
+        else:
+            cursor.execute(f'''
+            UPDATE ShipmentDetails
+            SET {set_clause}
+            WHERE qr_code = ?
+            ''', values)
+            cursor.execute(f'''
+            SELECT {SHIPMENT_COLUMNS} FROM ShipmentDetails WHERE id = ?
+            ''', (shipment_id,))
+        row = cursor.fetchone()
+        columns = [desc[0] for desc in cursor.description]
+        updated_shipment = dict(zip(columns, row)) if row else None
         
-        conn.commit()
+        # Log audit - Thay đổi trạng thái (cùng transaction)
+        log_audit(shipment_id, 'STATUS_CHANGED', old_status, new_status, updated_by, cursor=cursor)
         
-        # Log audit - Thay đổi trạng thái
-        log_audit(shipment_id, 'STATUS_CHANGED', old_status, new_status, updated_by)
+        conn.commit()
         
         # Auto-sync to Google Sheets
         try:
@@ -643,7 +841,7 @@ def update_shipment_status(qr_code, new_status, updated_by, notes=None, image_ur
             # Don't fail the update operation if Google Sheets sync fails
             print(f"Warning: Failed to sync to Google Sheets: {e}")
         
-        return {'success': True, 'error': None}
+        return {'success': True, 'error': None, 'shipment': updated_shipment}
     except Exception as e:
         conn.rollback()
         return {'success': False, 'error': str(e)}
@@ -651,6 +849,92 @@ def update_shipment_status(qr_code, new_status, updated_by, notes=None, image_ur
         conn.close()
 
 
+def update_shipments_status_bulk(qr_codes, new_status, updated_by, notes=None):
+    """
+    Update status of many shipments in one transaction (e.g. every item of a transfer slip)
+
+    Args:
+        qr_codes: Iterable of QR codes
+        new_status: New status value
+        updated_by: Username who updated
+        notes: Optional notes
+
+    Returns:
+        dict: {'success': bool, 'updated_count': int, 'missing': list of QR codes not found, 'error': str or None}
+    """
+    qr_codes = list(dict.fromkeys(c for c in qr_codes if c))
+    if not qr_codes:
+        return {'success': True, 'updated_count': 0, 'missing': [], 'error': None}
+
+    # Cùng quy tắc ngày tự động như update_shipment_status
+    now = datetime.now().isoformat()
+    update_fields = {'status': new_status, 'updated_by': updated_by}
+    if new_status == 'Đã nhận':
+        update_fields['received_time'] = now
+    if new_status == 'Đang sửa chữa':
+        update_fields['repair_start_date'] = now
+    elif new_status == 'Hoàn thành sửa chữa':
+        update_fields['repair_completion_date'] = now
+    elif new_status == 'Hoàn thành YCSC':
+        update_fields['ycsc_completion_date'] = now
+        update_fields['completed_time'] = now
+    if notes:
+        update_fields['notes'] = notes
+    set_clause = ', '.join(f"{k} = ?" for k in update_fields) + ', last_updated = CURRENT_TIMESTAMP'
+    set_values = list(update_fields.values())
+
+    conn = get_connection()
+    cursor = conn.cursor()
+
+    try:
+        cursor.execute('BEGIN IMMEDIATE')
+        found = []
+        # Chia lô để không vượt giới hạn số tham số của SQLite
+        for start in range(0, len(qr_codes), 500):
+            chunk = qr_codes[start:start + 500]
+            placeholders = ','.join('?' * len(chunk))
+            cursor.execute(f'SELECT id, qr_code, status FROM ShipmentDetails WHERE qr_code IN ({placeholders})', chunk)
+            found.extend(cursor.fetchall())
+            cursor.execute(f'''
+            UPDATE ShipmentDetails
+            SET {set_clause}
+            WHERE qr_code IN ({placeholders})
+            ''', set_values + chunk)
+
+        # Log audit (một executemany, cùng transaction)
+        cursor.executemany('''
+        INSERT INTO AuditLog (shipment_id, action, old_value, new_value, changed_by)
+        VALUES (?, ?, ?, ?, ?)
+        ''', [
+            (shipment_id, 'STATUS_CHANGED', old_status, new_status, updated_by)
+            for shipment_id, _, old_status in found
+        ])
+
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        return {'success': False, 'updated_count': 0, 'missing': [], 'error': str(e)}
+    finally:
+        conn.close()
+
+    # Auto-sync to Google Sheets
+    try:
+        from google_sheets import sync_shipment_to_sheets
+        for shipment_id, _, _ in found:
+            sync_shipment_to_sheets(shipment_id, is_new=False)
+    except Exception as e:
+        # Don't fail the update operation if Google Sheets sync fails
+        print(f"Warning: Failed to sync to Google Sheets: {e}")
+
+    found_codes = {qr_code for _, qr_code, _ in found}
+    return {
+        'success': True,
+        'updated_count': len(found),
+        'missing': [c for c in qr_codes if c not in found_codes],
+        'error': None
+    }
+
+
 def get_shipment_by_id(shipment_id):
     """
     Get shipment by ID
@@ -686,6 +970,39 @@ def get_shipment_by_id(shipment_id):
         conn.close()
 
 
+def existing_qr_codes(codes):
+    """
+    Find which of the given QR codes already exist (one query per 500 codes)
+    
+    Args:
+        codes: Iterable of QR codes
+        
+    Returns:
+        set: QR codes already present in ShipmentDetails
+    """
+    codes = list(dict.fromkeys(c for c in codes if c))
+    if not codes:
+        return set()
+    
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        found = set()
+        # Chia lô để không vượt giới hạn số tham số của SQLite
+        for start in range(0, len(codes), 500):
+            chunk = codes[start:start + 500]
+            placeholders = ','.join('?' * len(chunk))
+            cursor.execute(f'SELECT qr_code FROM ShipmentDetails WHERE qr_code IN ({placeholders})', chunk)
+            found.update(row[0] for row in cursor.fetchall())
+        return found
+    except Exception as e:
+        print(f"Error checking QR codes: {e}")
+        return set()
+    finally:
+        conn.close()
+
+
 def get_shipment_by_qr_code(qr_code):
     """
     Get shipment by QR code
@@ -700,10 +1017,8 @@ def get_shipment_by_qr_code(qr_code):
     cursor = conn.cursor()
     
     try:
-        cursor.execute('''
-        SELECT id, qr_code, imei, device_name, capacity, supplier, 
-               status, request_type, sent_time, received_time, completed_time, created_by, updated_by, notes, image_url, telegram_message_id, store_name, reception_location, last_updated,
-               device_status_on_reception, repairer, repair_start_date, repair_completion_date, ycsc_completion_date, repair_notes, quality_check_notes, repair_image_url, quotation_notes
+        cursor.execute(f'''
+        SELECT {SHIPMENT_COLUMNS}
         FROM ShipmentDetails
         WHERE qr_code = ?
         ''', (qr_code,))
@@ -1175,7 +1490,7 @@ def delete_supplier(supplier_id):
         conn.close()
 
 
-def log_audit(shipment_id, action, old_value, new_value, changed_by):
+def log_audit(shipment_id, action, old_value, new_value, changed_by, cursor=None):
     """
     Log audit trail
     
@@ -1185,7 +1500,16 @@ def log_audit(shipment_id, action, old_value, new_value, changed_by):
         old_value: Old value
         new_value: New value
         changed_by: Username who made change
+        cursor: Optional cursor of an open transaction; the insert then joins
+                that transaction and the caller commits
     """
+    if cursor is not None:
+        cursor.execute('''
+        INSERT INTO AuditLog (shipment_id, action, old_value, new_value, changed_by)
+        VALUES (?, ?, ?, ?, ?)
+        ''', (shipment_id, action, old_value, new_value, changed_by))
+        return
+    
     conn = get_connection()
     cursor = conn.cursor()
     
@@ -1203,20 +1527,22 @@ def log_audit(shipment_id, action, old_value, new_value, changed_by):
         conn.close()
 
 
-def get_audit_log(limit=100):
+def get_audit_log(limit=100, shipment_id=None, offset=0):
     """
     Get audit log entries
     
     Args:
-        limit: Maximum number of entries to return
+        limit: Maximum number of entries to return (None = no limit)
+        shipment_id: Only return entries of this shipment (filtered in SQL)
+        offset: Number of newest entries to skip (for pagination, needs limit)
         
     Returns:
-        pandas.DataFrame: Audit log entries
+        pandas.DataFrame: Audit log entries, newest first
     """
     conn = get_connection()
     
     try:
-        df = pd.read_sql_query('''
+        query = '''
         SELECT 
             al.id,
             al.shipment_id,
@@ -1228,9 +1554,17 @@ def get_audit_log(limit=100):
             al.timestamp
         FROM AuditLog al
         LEFT JOIN ShipmentDetails sd ON al.shipment_id = sd.id
-        ORDER BY al.timestamp DESC
-        LIMIT ?
-        ''', conn, params=(limit,))
+        '''
+        params = []
+        if shipment_id is not None:
+            query += ' WHERE al.shipment_id = ?'
+            params.append(int(shipment_id))
+        query += ' ORDER BY al.timestamp DESC'
+        if limit is not None:
+            query += ' LIMIT ? OFFSET ?'
+            params.extend([int(limit), int(offset or 0)])
+        
+        df = pd.read_sql_query(query, conn, params=tuple(params))
         
         return df
     except Exception as e:
@@ -1575,15 +1909,34 @@ def update_transfer_slip_shipments_status(transfer_slip_id, new_status):
         if not shipment_ids:
             return {'success': False, 'updated_count': 0, 'error': 'Không có máy nào trong phiếu chuyển'}
         
-        # Update status for all shipments
-        updated_count = 0
-        for shipment_id in shipment_ids:
-            cursor.execute('''
-            UPDATE ShipmentDetails 
-            SET status = ?, updated_by = (SELECT created_by FROM TransferSlips WHERE id = ?)
-            WHERE id = ?
-            ''', (new_status, transfer_slip_id, shipment_id))
-            updated_count += cursor.rowcount
+        cursor.execute('''
+        SELECT created_by FROM TransferSlips WHERE id = ?
+        ''', (transfer_slip_id,))
+        row = cursor.fetchone()
+        updated_by = row[0] if row else None
+        
+        cursor.execute('''
+        SELECT id, status FROM ShipmentDetails
+        WHERE id IN (SELECT shipment_id FROM TransferSlipItems WHERE transfer_slip_id = ?)
+        ''', (transfer_slip_id,))
+        old_statuses = cursor.fetchall()
+        
+        # Update status for all shipments (một lệnh UPDATE cho cả phiếu)
+        cursor.execute('''
+        UPDATE ShipmentDetails 
+        SET status = ?, updated_by = ?
+        WHERE id IN (SELECT shipment_id FROM TransferSlipItems WHERE transfer_slip_id = ?)
+        ''', (new_status, updated_by, transfer_slip_id))
+        updated_count = cursor.rowcount
+        
+        # Log audit (một executemany, cùng transaction)
+        cursor.executemany('''
+        INSERT INTO AuditLog (shipment_id, action, old_value, new_value, changed_by)
+        VALUES (?, ?, ?, ?, ?)
+        ''', [
+            (shipment_id, 'STATUS_CHANGED', old_status, new_status, updated_by)
+            for shipment_id, old_status in old_statuses
+        ])
         
         conn.commit()
         return {'success': True, 'updated_count': updated_count, 'error': None}
@@ -9,6 +9,16 @@ from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaIoBaseUpload
 
+# Try to import aiohttp for concurrent uploads on one event loop, fallback to threads
+try:
+    import asyncio
+    import aiohttp
+    from google.auth.transport.requests import Request as GoogleAuthRequest
+    AIOHTTP_AVAILABLE = True
+except ImportError as e:
+    AIOHTTP_AVAILABLE = False
+    print(f"Warning: aiohttp not available, using thread pool uploads: {e}")
+
 SERVICE_ACCOUNT_FILE = "service_account.json"
 # Upload to specific folder (Shared Drive folder you shared with the service account)
 try:
@@ -27,6 +37,12 @@ SCOPES = [
     "https://www.googleapis.com/auth/drive"
 ]
 
+# Ảnh lớn hơn ngưỡng này upload theo giao thức resumable, từng chunk 5MB
+RESUMABLE_CHUNK_SIZE = 5 * 1024 * 1024
+
+DRIVE_UPLOAD_URL = "https://www.googleapis.com/upload/drive/v3/files"
+DRIVE_FILES_URL = "https://www.googleapis.com/drive/v3/files"
+
 
 def _get_drive_service():
     if not os.path.exists(SERVICE_ACCOUNT_FILE):
@@ -41,9 +57,25 @@ def _get_drive_service():
         return None, f"Lỗi khởi tạo Google Drive: {e}"
 
 
-def upload_file_to_drive(file_bytes: bytes, filename: str, mime_type: str):
+def _make_media(file_bytes, mime_type: str):
+    """
+    Build the upload body: small files go in one request, large files use a
+    resumable session with 5MB chunks (a dropped connection only resends one chunk).
+    file_bytes may be bytes or any bytes-like buffer (e.g. UploadedFile.getbuffer()).
+    """
+    if len(file_bytes) > RESUMABLE_CHUNK_SIZE:
+        media = MediaIoBaseUpload(
+            io.BytesIO(file_bytes), mimetype=mime_type,
+            chunksize=RESUMABLE_CHUNK_SIZE, resumable=True
+        )
+        return media, 3
+    return MediaIoBaseUpload(io.BytesIO(file_bytes), mimetype=mime_type, resumable=False), 0
+
+
+def upload_file_to_drive(file_bytes, filename: str, mime_type: str):
     """
     Upload a file to Google Drive and return webViewLink.
+    file_bytes: bytes or a bytes-like buffer (e.g. UploadedFile.getbuffer()).
     """
     service, err = _get_drive_service()
     if err:
@@ -53,7 +85,7 @@ def upload_file_to_drive(file_bytes: bytes, filename: str, mime_type: str):
     if DRIVE_FOLDER_ID:
         metadata["parents"] = [DRIVE_FOLDER_ID]
 
-    media = MediaIoBaseUpload(io.BytesIO(file_bytes), mimetype=mime_type, resumable=False)
+    media, num_retries = _make_media(file_bytes, mime_type)
 
     try:
         file = (
@@ -64,7 +96,7 @@ def upload_file_to_drive(file_bytes: bytes, filename: str, mime_type: str):
                 fields="id, webViewLink, webContentLink, parents",
                 supportsAllDrives=True,
             )
-            .execute()
+            .execute(num_retries=num_retries)
         )
 
         file_id = file.get("id")
@@ -97,7 +129,7 @@ def upload_file_to_drive(file_bytes: bytes, filename: str, mime_type: str):
         return {"success": False, "error": str(e), "url": None}
 
 
-def upload_file_to_transfer_folder(file_bytes: bytes, filename: str, mime_type: str):
+def upload_file_to_transfer_folder(file_bytes, filename: str, mime_type: str):
     """
     Upload a file to Google Drive transfer folder (for transfer slips).
     """
@@ -109,7 +141,7 @@ def upload_file_to_transfer_folder(file_bytes: bytes, filename: str, mime_type:
     if DRIVE_TRANSFER_FOLDER_ID:
         metadata["parents"] = [DRIVE_TRANSFER_FOLDER_ID]
 
-    media = MediaIoBaseUpload(io.BytesIO(file_bytes), mimetype=mime_type, resumable=False)
+    media, num_retries = _make_media(file_bytes, mime_type)
 
     try:
         file = (
@@ -120,7 +152,7 @@ def upload_file_to_transfer_folder(file_bytes: bytes, filename: str, mime_type:
                 fields="id, webViewLink, parents",
                 supportsAllDrives=True,
             )
-            .execute()
+            .execute(num_retries=num_retries)
         )
 
         file_id = file.get("id")
@@ -149,21 +181,132 @@ def upload_file_to_transfer_folder(file_bytes: bytes, filename: str, mime_type:
         return {"success": False, "error": str(e), "url": None}
 
 
-def upload_multiple_files_to_drive(files_data, max_workers=5):
+def _get_access_token():
+    """Get an OAuth access token for the service account (for direct REST uploads)."""
+    if not os.path.exists(SERVICE_ACCOUNT_FILE):
+        return None, f"File {SERVICE_ACCOUNT_FILE} không tồn tại"
+    try:
+        creds = Credentials.from_service_account_file(
+            SERVICE_ACCOUNT_FILE, scopes=SCOPES
+        )
+        creds.refresh(GoogleAuthRequest())
+        return creds.token, None
+    except Exception as e:
+        return None, f"Lỗi khởi tạo Google Drive: {e}"
+
+
+async def _upload_one(session, data, token, folder_id, export="view"):
+    """
+    Upload one file via Drive REST multipart upload, then make it public.
+    export: link format of the returned uc?export=... URL ("view" for shipments,
+            "download" for transfer slips, matching the single-file uploaders)
+    """
+    headers = {"Authorization": f"Bearer {token}"}
+    metadata = {"name": data['filename']}
+    if folder_id:
+        metadata["parents"] = [folder_id]
+    try:
+        with aiohttp.MultipartWriter("related") as writer:
+            writer.append_json(metadata)
+            writer.append(data['file_bytes'], {"Content-Type": data['mime_type']})
+
+        params = {"uploadType": "multipart", "supportsAllDrives": "true", "fields": "id"}
+        async with session.post(DRIVE_UPLOAD_URL, params=params, data=writer, headers=headers) as resp:
+            if resp.status >= 400:
+                error = await resp.text()
+                print(f"❌ Error uploading to Drive: {error}")
+                return {"success": False, "error": error, "url": None, "id": None, "index": data['index']}
+            file_id = (await resp.json()).get("id")
+
+        # Make file publicly readable (anyone with link)
+        try:
+            async with session.post(
+                f"{DRIVE_FILES_URL}/{file_id}/permissions",
+                params={"supportsAllDrives": "true", "fields": "id"},
+                json={"role": "reader", "type": "anyone"},
+                headers=headers,
+            ) as resp:
+                if resp.status >= 400:
+                    print(f"Warning: cannot set public permission: {await resp.text()}")
+        except Exception as e:
+            print(f"Warning: cannot set public permission: {e}")
+
+        direct_link = f"https://drive.google.com/uc?export={export}&id={file_id}"
+        print(f"📤 Uploaded file to Drive: {direct_link} (File ID: {file_id})")
+        return {"success": True, "error": None, "url": direct_link, "id": file_id, "index": data['index']}
+    except Exception as e:
+        print(f"❌ Error uploading to Drive: {str(e)}")
+        return {"success": False, "error": str(e), "url": None, "id": None, "index": data['index']}
+
+
+async def _upload_all(files_data, token, folder_id, export="view"):
+    """Upload all files concurrently over one keep-alive connection pool."""
+    connector = aiohttp.TCPConnector(limit=20, keepalive_timeout=60)
+    timeout = aiohttp.ClientTimeout(total=300)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        return await asyncio.gather(*[
+            _upload_one(session, data, token, folder_id, export) for data in files_data
+        ])
+
+
+def _upload_multiple_async(files_data, folder_id, export="view"):
+    """Run the aiohttp uploads; returns None if an event loop can't be started here."""
+    token, err = _get_access_token()
+    if err:
+        return [
+            {"success": False, "error": err, "url": None, "id": None, "index": data['index']}
+            for data in files_data
+        ]
+    try:
+        return list(asyncio.run(_upload_all(files_data, token, folder_id, export)))
+    except RuntimeError as e:
+        # Đã có event loop chạy trong thread này -> dùng thread pool
+        print(f"Warning: cannot run async uploads here ({e}), using thread pool")
+        return None
+
+
+def upload_multiple_files_to_drive(files_data, max_workers=5, transfer_folder=False):
     """
     Upload multiple files to Google Drive in parallel.
+    Uses asyncio + aiohttp (one event loop, shared keep-alive connections) when
+    available, otherwise a thread pool with the googleapiclient uploader.
+    Files larger than RESUMABLE_CHUNK_SIZE always take the googleapiclient path
+    so they get the resumable, chunked upload.
     
     Args:
         files_data: List of dicts with keys: 'file_bytes', 'filename', 'mime_type', 'index'
-        max_workers: Maximum number of parallel uploads (default: 5)
+        max_workers: Maximum number of parallel uploads for the thread pool fallback (default: 5)
+        transfer_folder: Upload to the transfer-slip folder instead of the shipment folder
     
     Returns:
         List of results in the same order as input, each with keys:
         'success', 'error', 'url', 'id', 'index'
     """
+    if not files_data:
+        return []
+
+    folder_id = DRIVE_TRANSFER_FOLDER_ID if transfer_folder else DRIVE_FOLDER_ID
+    upload_one = upload_file_to_transfer_folder if transfer_folder else upload_file_to_drive
+    # Cùng định dạng link với uploader đơn lẻ tương ứng (phiếu chuyển: export=download)
+    export = "download" if transfer_folder else "view"
+
+    results = []
+    if AIOHTTP_AVAILABLE:
+        # aiohttp chỉ gửi một request multipart: file lớn hơn RESUMABLE_CHUNK_SIZE đi đường
+        # googleapiclient bên dưới (resumable, từng chunk 5MB), file nhỏ upload async
+        small_files = [data for data in files_data if len(data['file_bytes']) <= RESUMABLE_CHUNK_SIZE]
+        large_files = [data for data in files_data if len(data['file_bytes']) > RESUMABLE_CHUNK_SIZE]
+        async_results = _upload_multiple_async(small_files, folder_id, export) if small_files else []
+        if async_results is not None:
+            results.extend(async_results)
+            files_data = large_files
+            if not files_data:
+                results.sort(key=lambda x: x['index'])
+                return results
+
     def upload_single_file(data):
         """Upload a single file and return result with index"""
-        result = upload_file_to_drive(
+        result = upload_one(
             data['file_bytes'],
             data['filename'],
             data['mime_type']
@@ -171,7 +314,6 @@ def upload_multiple_files_to_drive(files_data, max_workers=5):
         result['index'] = data['index']
         return result
     
-    results = []
     with ThreadPoolExecutor(max_workers=max_workers) as executor:
         # Submit all upload tasks
         future_to_data = {
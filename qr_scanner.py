@@ -4,9 +4,16 @@ Handles QR code decoding from images and parsing QR string data
 Uses OpenCV QRCodeDetector as primary method, with pyzbar as fallback
 """
 
+import threading
+from io import BytesIO
 from PIL import Image, ImageEnhance, ImageFilter
 import numpy as np
 
+# Longest side used for decoding camera frames (larger frames are downscaled first)
+MAX_DECODE_SIDE = 1280
+# Longest side for the quick pyzbar scan in decode_qr_from_image
+PYZBAR_MAX_SIDE = 1600
+
 # Try to import cv2 (OpenCV) - primary method
 try:
     import cv2
@@ -27,19 +34,74 @@ except ImportError as e:
         return []
 
 
-def decode_qr_from_image(image):
+_detector_local = threading.local()
+
+
+def _get_qr_detector():
+    """
+    OpenCV QRCodeDetector dùng lại cho mọi lần giải mã (mỗi thread một bản,
+    vì các phiên Streamlit chạy song song trên nhiều thread)
+    """
+    detector = getattr(_detector_local, 'detector', None)
+    if detector is None:
+        detector = cv2.QRCodeDetector()
+        _detector_local.detector = detector
+    return detector
+
+
+def _pyzbar_fast_decode(image):
+    """
+    Quick libzbar (C) scan on a grayscale view, long side capped at PYZBAR_MAX_SIDE
+    
+    Args:
+        image: PIL Image or numpy array
+        
+    Returns:
+        str: Decoded QR code text, or None if not found
+    """
+    if not PYZBAR_AVAILABLE:
+        return None
+    try:
+        if isinstance(image, Image.Image):
+            gray_image = image.convert('L')
+            gray_image.thumbnail((PYZBAR_MAX_SIDE, PYZBAR_MAX_SIDE))
+            gray = np.asarray(gray_image)
+        else:
+            gray = image
+            if CV2_AVAILABLE:
+                if len(gray.shape) == 3:
+                    gray = cv2.cvtColor(gray, cv2.COLOR_RGB2GRAY)
+                longest = max(gray.shape[:2])
+                if longest > PYZBAR_MAX_SIDE:
+                    scale = PYZBAR_MAX_SIDE / longest
+                    gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        decoded_objects = pyzbar_decode(gray)
+        if decoded_objects:
+            return decoded_objects[0].data.decode('utf-8')
+    except Exception as e:
+        print(f"pyzbar fast path error: {e}")
+    return None
+
+
+def decode_qr_from_image(image, fast_path=True):
     """
     Decode QR code from image with multiple preprocessing methods
     Optimized for iPhone cameras (works well from distance, handles close-up blur)
-    Uses OpenCV QRCodeDetector as primary method, pyzbar as fallback
+    Tries a quick pyzbar scan first, then OpenCV QRCodeDetector with preprocessing
     
     Args:
         image: PIL Image or numpy array
+        fast_path: Try the quick pyzbar grayscale scan first
         
     Returns:
         str: Decoded QR code text, or None if not found
     """
     try:
+        if fast_path:
+            result = _pyzbar_fast_decode(image)
+            if result:
+                return result
+        
         # Convert PIL Image to numpy array if needed
         if isinstance(image, Image.Image):
             image_array = np.array(image)
@@ -142,6 +204,65 @@ def decode_qr_from_image(image):
         return None
 
 
+def _decode_with_pillow(image_bytes):
+    """Fallback decode through Pillow, downscaled to MAX_DECODE_SIDE"""
+    image = Image.open(BytesIO(image_bytes))
+    image.thumbnail((MAX_DECODE_SIDE, MAX_DECODE_SIDE), Image.BILINEAR)
+    return decode_qr_from_image(image)
+
+
+def decode_qr_from_bytes(image_bytes):
+    """
+    Decode QR code straight from encoded image bytes (e.g. camera JPEG)
+    Decodes to a single-channel grayscale array with OpenCV (no Pillow decode),
+    tries QRCodeDetector first, then pyzbar, then the full preprocessing pipeline
+    
+    Args:
+        image_bytes: bytes of an encoded image (JPEG/PNG)
+        
+    Returns:
+        str: Decoded QR code text, or None if not found
+    """
+    if not image_bytes:
+        return None
+    
+    if not CV2_AVAILABLE:
+        return _decode_with_pillow(image_bytes)
+    
+    try:
+        buf = np.frombuffer(image_bytes, np.uint8)
+        gray = cv2.imdecode(buf, cv2.IMREAD_GRAYSCALE)
+    except Exception as e:
+        print(f"Error decoding image bytes: {e}")
+        gray = None
+    
+    if gray is None:
+        # OpenCV không đọc được định dạng này -> dùng Pillow
+        return _decode_with_pillow(image_bytes)
+    
+    # Ảnh camera thường 2-4MP; detector chỉ cần <= 1280px cạnh dài
+    longest = max(gray.shape[:2])
+    if longest > MAX_DECODE_SIDE:
+        scale = MAX_DECODE_SIDE / longest
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    
+    # Fast path: OpenCV QRCodeDetector trên ảnh xám
+    result = try_opencv_decode(gray)
+    if result:
+        return result
+    
+    if PYZBAR_AVAILABLE:
+        try:
+            decoded_objects = pyzbar_decode(gray)
+            if decoded_objects:
+                return decoded_objects[0].data.decode('utf-8')
+        except:
+            pass
+    
+    # Slow path: upscale + preprocessing variants (pyzbar đã thử ở trên)
+    return decode_qr_from_image(gray, fast_path=False)
+
+
 def try_opencv_decode(image_array):
     """Try OpenCV QRCodeDetector on image"""
     if not CV2_AVAILABLE:
@@ -153,7 +274,7 @@ def try_opencv_decode(image_array):
         else:
             gray = image_array
         
-        detector = cv2.QRCodeDetector()
+        detector = _get_qr_detector()
         
         # Try multi decode first
         retval, decoded_info, points, straight_qrcode = detector.detectAndDecodeMulti(gray)
@@ -223,7 +344,7 @@ def decode_grayscale_opencv(image_array):
         else:
             gray = image_array
         
-        detector = cv2.QRCodeDetector()
+        detector = _get_qr_detector()
         data, bbox, rectified = detector.detectAndDecode(gray)
         if data:
             return data
@@ -253,7 +374,7 @@ def decode_resized_opencv(image_array):
                 resized = cv2.resize(image_array, (width * scale, height * scale), 
                                     interpolation=cv2.INTER_LANCZOS4)
                 
-                detector = cv2.QRCodeDetector()
+                detector = _get_qr_detector()
                 data, bbox, rectified = detector.detectAndDecode(resized)
                 if data:
                     return data
@@ -275,7 +396,7 @@ def decode_binarized_opencv(image_array):
         else:
             gray = image_array
         
-        detector = cv2.QRCodeDetector()
+        detector = _get_qr_detector()
         
         # Method 1: Simple binary threshold (multiple thresholds)
         thresholds = [127, 100, 150, 80, 180]
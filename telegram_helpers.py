@@ -1,5 +1,5 @@
 from datetime import datetime
-from database import update_telegram_message, get_shipment_by_id, get_transfer_slip, get_transfer_slip_items
+from database import update_telegram_message, get_shipment_by_id, get_transfer_slip, get_transfer_slip_items, parse_image_urls
 from telegram_notify import send_text, send_photo
 
 
@@ -62,8 +62,8 @@ def notify_shipment_if_received(shipment_id, force=False, is_update_image=False)
     # Try photo first if available; fallback to text if photo fails or no image
     res = None
     if image_url:
-        # Handle multiple images (separated by ;)
-        image_urls = [url.strip() for url in image_url.split(';') if url.strip()]
+        # Handle multiple images (JSON array, legacy values separated by ;)
+        image_urls = parse_image_urls(image_url)
         print(f"📸 Sending {len(image_urls)} images to Telegram")
         if image_urls:
             success_count = 0
@@ -155,11 +155,11 @@ def send_transfer_slip_notification(transfer_slip_id):
     if slip.get('notes'):
         message_text += f"\n\nGhi chú: {slip['notes']}"
     
-    image_url = slip.get('image_url')
+    image_urls = parse_image_urls(slip.get('image_url'))
     
     # Send with photo if available, otherwise text only
-    if image_url:
-        res = send_photo(image_url, message_text)
+    if image_urls:
+        res = send_photo(image_urls[0], message_text)
     else:
         res = send_text(message_text)
     